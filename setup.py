@@ -16,8 +16,10 @@ setup(
     install_requires=[
         "pysam",
         "pandas",
+        "pyarrow",
         "numpy",
         "dnaio",
+        "cutadapt",
         "xopen",
         "tqdm",
         "snakemake",
@@ -0,0 +1,331 @@
+"""
+Cluster DBS sequences within an edit distance using count-weighted message passing.
+
+Alternative to starcode clustering. Each sequence is merged into the most abundant sequence within the given edit
+distance having at least `--cluster-ratio` times as many reads, and clusters are formed by following these links to
+the root sequence. This corresponds to the message passing clustering used by starcode.
+
+Neighbors are found using a pigeonhole index where sequences are split into distance + 1 segments. Any sequence
+within the edit distance must share one of these segments exactly, shifted by at most distance bases. Candidates
+are generated and verified in batches of bounded size for each segment and shift, and only the best parent found so
+far is kept for each sequence, so memory use does not grow with the number of sequences sharing a segment. The index
+is built once over the possible parents, taking about 16 * (distance + 1) bytes per possible parent, and saved to a
+temporary directory from where workers memory-map it.
+
+Output is a binary array with the packed raw sequence, the packed canonical sequence and the read count for each
+raw sequence, sorted by raw sequence. Use as input to `dbspro correctfastq`.
+"""
+import logging
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from dbspro.cli.countdbs import load_counts
+from dbspro.utils import Summary, tqdm, parallel_map, pack_codes, unpack_codes, packed_lengths
+
+logger = logging.getLogger(__name__)
+
+CLUSTERS_DTYPE = np.dtype([("raw", np.uint64), ("canonical", np.uint64), ("count", np.uint64)])
+BATCH_SIZE = 20_000
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        "input", type=Path,
+        help="DBS counts from `dbspro countdbs`, either as TSV or binary .npy array."
+    )
+    parser.add_argument(
+        "-o", "--output", type=Path, required=True,
+        help="Output binary .npy array with raw sequence, canonical sequence and read count."
+    )
+    parser.add_argument(
+        "-d", "--distance", type=int, default=2,
+        help="Maximum edit distance for clustering. Default: %(default)s"
+    )
+    parser.add_argument(
+        "-r", "--cluster-ratio", type=float, default=5,
+        help="Minimum ratio between read counts of the parent and the merged sequence. Default: %(default)s"
+    )
+    parser.add_argument(
+        "--tmpdir",
+        help="Directory for temporary files. Default: system default"
+    )
+    parser.add_argument(
+        "-j", "--threads", type=int, default=1,
+        help="Number of worker processes. Default: %(default)s"
+    )
+
+
+def main(args):
+    run_clusterdbs(
+        input=args.input,
+        output=args.output,
+        distance=args.distance,
+        cluster_ratio=args.cluster_ratio,
+        tmpdir=args.tmpdir,
+        threads=args.threads,
+    )
+
+
+def run_clusterdbs(
+    input: str,
+    output: str,
+    distance: int = 2,
+    cluster_ratio: float = 5,
+    tmpdir: str = None,
+    threads: int = 1,
+):
+    logger.info("Starting")
+    logger.info(f"Processing file: {input}")
+
+    if cluster_ratio < 1:
+        raise ValueError("Cluster ratio must be at least 1.")
+
+    summary = Summary()
+    counts = load_counts(input)
+    keys = counts["sequence"]
+    summary["Unique DBS"] = len(keys)
+    summary["Reads total"] = int(counts["count"].sum())
+
+    logger.info(f"Finding parents for {len(keys):,} sequences using {threads} worker(s).")
+    parents = find_parents(keys, counts["count"], distance, cluster_ratio, threads, tmpdir=tmpdir)
+    summary["DBS merged into parent"] = int((parents != np.arange(len(keys))).sum())
+
+    roots = find_roots(parents)
+    summary["Clusters"] = len(np.unique(roots))
+
+    clusters = np.empty(len(keys), dtype=CLUSTERS_DTYPE)
+    clusters["raw"] = keys
+    clusters["canonical"] = keys[roots]
+    clusters["count"] = counts["count"]
+
+    logger.info(f"Writing clusters to {output}")
+    with open(output, "wb") as file:
+        np.save(file, clusters)
+
+    summary.print_stats(name=__name__)
+
+    logger.info("Finished")
+
+
+def find_parents(keys: np.ndarray, counts: np.ndarray, distance: int, cluster_ratio: float,
+                 threads: int = 1, tmpdir: str = None) -> np.ndarray:
+    """
+    Return index of the parent for each sequence, i.e. the sequence with the highest count within the edit distance
+    that has at least cluster_ratio times the count. Ties are broken by taking the first sequence in sorted order.
+    Sequences without parent are their own parent.
+    """
+    parents = np.arange(len(keys))
+    if len(keys) == 0:
+        return parents
+
+    # Only sequences with enough reads can be parents and only sequences with few enough reads can have parents.
+    parent_ids = np.flatnonzero(counts >= cluster_ratio)
+    child_ids = np.flatnonzero(counts * cluster_ratio <= counts.max())
+    if len(parent_ids) == 0 or len(child_ids) == 0:
+        return parents
+
+    # Keys are sorted by length first so batches are split on length changes.
+    child_lengths = packed_lengths(keys[child_ids])
+    batches = []
+    for length in np.unique(child_lengths):
+        ids = child_ids[child_lengths == length]
+        batches.extend(ids[i:i + BATCH_SIZE] for i in range(0, len(ids), BATCH_SIZE))
+
+    with TemporaryDirectory(dir=tmpdir) as tmp:
+        # Workers memory-map the index and parent arrays from disk instead of each receiving a copy.
+        PigeonholeIndex(keys[parent_ids], distance).save(tmp)
+        np.save(Path(tmp) / "parent_counts.npy", counts[parent_ids])
+        np.save(Path(tmp) / "parent_ids.npy", parent_ids)
+
+        batch_items = ((ids, keys[ids], counts[ids]) for ids in batches)
+        results = parallel_map(_find_batch_parents, batch_items, threads=threads, initializer=_init_worker,
+                               initargs=(tmp, cluster_ratio))
+        for children, batch_parents in tqdm(results, desc="Finding neighbors", total=len(batches)):
+            parents[children] = batch_parents
+    return parents
+
+
+def find_roots(parents: np.ndarray) -> np.ndarray:
+    """Follow parent links to the root by pointer jumping"""
+    roots = parents.copy()
+    while True:
+        grandparents = roots[roots]
+        if np.array_equal(grandparents, roots):
+            return roots
+        roots = grandparents
+
+
+_index = None
+_parent_counts = None
+_parent_ids = None
+_cluster_ratio = None
+
+
+def _init_worker(directory: str, cluster_ratio: float):
+    global _index, _parent_counts, _parent_ids, _cluster_ratio
+    _index = PigeonholeIndex.load(directory)
+    _parent_counts = np.load(Path(directory) / "parent_counts.npy", mmap_mode="r")
+    _parent_ids = np.load(Path(directory) / "parent_ids.npy", mmap_mode="r")
+    _cluster_ratio = cluster_ratio
+
+
+def _find_batch_parents(item: Tuple[np.ndarray, np.ndarray, np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    """Return child ids and the id of their parent for children with a parent in the batch"""
+    ids, keys, counts = item
+    max_count = _parent_counts.max()
+
+    def accept(queries: np.ndarray, hits: np.ndarray) -> np.ndarray:
+        # The key comparison avoids cycles among sequences with equal counts when the cluster ratio is 1.
+        parent_counts = _parent_counts[hits]
+        return (parent_counts >= _cluster_ratio * counts[queries]) & \
+            ((parent_counts > counts[queries]) | (_index.keys[hits] < keys[queries]))
+
+    # Keep the parent with the highest count, then lowest key for each child as neighbors are found.
+    best = np.full(len(keys), -1)
+    for queries, hits in _index.neighbors(keys, accept):
+        found = np.flatnonzero(best >= 0)
+        queries = np.concatenate([found, queries])
+        hits = np.concatenate([best[found], hits])
+        order = np.lexsort((_index.keys[hits], max_count - _parent_counts[hits], queries))
+        queries = queries[order]
+        first = np.concatenate([[True], queries[1:] != queries[:-1]])
+        best[queries[first]] = hits[order][first]
+
+    found = np.flatnonzero(best >= 0)
+    return ids[found], _parent_ids[best[found]]
+
+
+class PigeonholeIndex:
+    """
+    Index for finding sequences within an edit distance. Sequences are split into distance + 1 segments and each
+    segment is indexed separately. A sequence within the edit distance must contain at least one of the segments
+    without errors, shifted by at most distance positions.
+    """
+    BATCH_SIZE = 100_000
+
+    def __init__(self, keys: np.ndarray, distance: int):
+        self.keys = np.asarray(keys, dtype=np.uint64)
+        self.distance = distance
+        self._segments: Dict[int, List[Tuple[int, int, np.ndarray, np.ndarray]]] = {}
+        lengths = packed_lengths(self.keys)
+        for length in np.unique(lengths).tolist():
+            ids = np.flatnonzero(lengths == length)
+            codes = unpack_codes(self.keys[ids], length)
+            self._segments[length] = []
+            for start, stop in self._bounds(length):
+                segment_keys = pack_codes(codes[:, start:stop])
+                order = np.argsort(segment_keys, kind="stable")
+                self._segments[length].append((start, stop, segment_keys[order], ids[order]))
+
+    def _bounds(self, length: int) -> List[Tuple[int, int]]:
+        bounds = np.linspace(0, length, self.distance + 2).astype(int).tolist()
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def save(self, directory: str):
+        """Save index as .npy arrays in directory"""
+        directory = Path(directory)
+        np.save(directory / "keys.npy", self.keys)
+        np.save(directory / "distance.npy", np.array([self.distance]))
+        for length, segments in self._segments.items():
+            np.save(directory / f"segment_keys.{length}.npy", np.stack([segment[2] for segment in segments]))
+            np.save(directory / f"segment_ids.{length}.npy", np.stack([segment[3] for segment in segments]))
+
+    @classmethod
+    def load(cls, directory: str) -> "PigeonholeIndex":
+        """Load index saved to directory. Arrays are memory-mapped so that processes loading it share its memory."""
+        directory = Path(directory)
+        index = cls.__new__(cls)
+        index.keys = np.load(directory / "keys.npy", mmap_mode="r")
+        index.distance = int(np.load(directory / "distance.npy")[0])
+        index._segments = {}
+        for length in sorted(int(file.name.split(".")[1]) for file in directory.glob("segment_keys.*.npy")):
+            segment_keys = np.load(directory / f"segment_keys.{length}.npy", mmap_mode="r")
+            segment_ids = np.load(directory / f"segment_ids.{length}.npy", mmap_mode="r")
+            index._segments[length] = [
+                (start, stop, keys, ids) for (start, stop), keys, ids
+                in zip(index._bounds(length), segment_keys, segment_ids)
+            ]
+        return index
+
+    def neighbors(self, keys: np.ndarray,
+                  accept: Optional[Callable[[np.ndarray, np.ndarray], np.ndarray]] = None
+                  ) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Yield batches of pairs within the edit distance as arrays of query positions and indexed positions. All
+        queries must have the same length. Candidates sharing a segment are generated and verified in batches of at
+        most BATCH_SIZE pairs. If given, accept is called with the query and indexed positions of each batch and
+        returns a boolean array marking pairs to verify. Pairs sharing several segments are found more than once.
+        """
+        query_length = int(packed_lengths(keys[:1])[0])
+        codes = unpack_codes(keys, query_length)
+        for length, segments in self._segments.items():
+            if abs(length - query_length) > self.distance:
+                continue
+
+            for start, stop, segment_keys, ids in segments:
+                for shift in range(-self.distance, self.distance + 1):
+                    if start + shift < 0 or stop + shift > query_length:
+                        continue
+                    query_keys = pack_codes(codes[:, start + shift:stop + shift])
+                    left = np.searchsorted(segment_keys, query_keys, side="left")
+                    nr_hits = np.searchsorted(segment_keys, query_keys, side="right") - left
+                    ends = np.cumsum(nr_hits)
+                    total = int(ends[-1])
+                    for batch_start in range(0, total, self.BATCH_SIZE):
+                        positions = np.arange(batch_start, min(batch_start + self.BATCH_SIZE, total))
+                        queries = np.searchsorted(ends, positions, side="right")
+                        hits = ids[left[queries] + positions - (ends[queries] - nr_hits[queries])]
+                        if accept is not None:
+                            keep = accept(queries, hits)
+                            queries = queries[keep]
+                            hits = hits[keep]
+                        keep = self.verify(keys[queries], self.keys[hits])
+                        if keep.any():
+                            yield queries[keep], hits[keep]
+
+    def query(self, keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Return all pairs within the edit distance as arrays of query positions and indexed positions. All queries
+        must have the same length.
+        """
+        found = list(self.neighbors(keys))
+        if not found:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+        pairs = np.unique(np.concatenate([queries * len(self.keys) + hits for queries, hits in found]))
+        return pairs // len(self.keys), pairs % len(self.keys)
+
+    def verify(self, query_keys: np.ndarray, keys: np.ndarray) -> np.ndarray:
+        """Return boolean array marking pairs of packed sequences within the edit distance"""
+        within = np.zeros(len(keys), dtype=bool)
+        query_lengths = packed_lengths(query_keys)
+        lengths = packed_lengths(keys)
+        for query_length, length in set(zip(query_lengths.tolist(), lengths.tolist())):
+            selected = (query_lengths == query_length) & (lengths == length)
+            distances = edit_distances(unpack_codes(query_keys[selected], query_length),
+                                       unpack_codes(keys[selected], length), self.distance)
+            within[selected] = distances <= self.distance
+        return within
+
+
+def edit_distances(a: np.ndarray, b: np.ndarray, max_distance: int) -> np.ndarray:
+    """
+    Compute Levenshtein distances between rows of code arrays a and b within a band of max_distance around the
+    diagonal. Distances above max_distance are reported as max_distance + 1.
+    """
+    nr_pairs, len_a = a.shape
+    len_b = b.shape[1]
+    limit = max_distance + 1
+    previous = np.minimum(np.arange(len_b + 1), limit)[None, :].repeat(nr_pairs, axis=0)
+    for i in range(1, len_a + 1):
+        current = np.full_like(previous, limit)
+        current[:, 0] = min(i, limit)
+        for j in range(max(1, i - max_distance), min(len_b, i + max_distance) + 1):
+            substitution = previous[:, j - 1] + (a[:, i - 1] != b[:, j - 1])
+            current[:, j] = np.minimum(np.minimum(previous[:, j] + 1, current[:, j - 1] + 1), substitution)
+        np.minimum(current, limit, out=current)
+        previous = current
+    return previous[:, len_b]
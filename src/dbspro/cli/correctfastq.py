@@ -1,17 +1,23 @@
 """
-Correct FASTQ/FASTA with the corrected sequences from starcode clustering
+Correct FASTQ/FASTA with the corrected sequences from starcode clustering or `dbspro clusterdbs`
+
+With --barcode-pattern, corrected sequences that do not match the IUPAC pattern are handled as reads without corrected
+sequence.
 """
-from collections import defaultdict
+from collections import Counter
+from itertools import islice
 import logging
 import os
-import statistics
 from pathlib import Path
-from typing import Iterator, Tuple, List, Dict
+from tempfile import TemporaryDirectory
+from typing import Iterable, Iterator, Tuple, List, Optional, Sequence
 
 import dnaio
+import numpy as np
 from xopen import xopen
 
-from dbspro.utils import Summary, tqdm
+from dbspro.utils import Summary, tqdm, read_chunks, parse_chunk, format_records, parallel_map, \
+    encode_variable_length, decode_variable_length, BarcodePattern
 
 logger = logging.getLogger(__name__)
 
@@ -24,12 +30,30 @@ def add_arguments(parser):
     parser.add_argument(
         "corrections", type=Path,
         help="Starcode output in format, tab-separate entries: <corrected sequnence>, <read count>, <comma-separated"
-             "uncorrected sequences>."
+             "uncorrected sequences>. Output from `dbspro clusterdbs` is used if the file ends with .npy"
     )
     parser.add_argument(
         "-o", "--output-fasta", type=Path,
         help="Output FASTA with corrected sequences."
     )
+    parser.add_argument(
+        "--positional", action="store_true", default=False,
+        help="Write empty records for reads without corrected sequence to keep the order of records from input, "
+             "e.g. for positional output from `dbspro extract`."
+    )
+    parser.add_argument(
+        "-b", "--barcode-pattern",
+        help="IUPAC string with bases forming pattern that corrected sequences must match. Reads with other corrected "
+             "sequences are discarded. Default: keep all sequences"
+    )
+    parser.add_argument(
+        "--tmpdir",
+        help="Directory for the temporary correction table. Default: system default"
+    )
+    parser.add_argument(
+        "-j", "--threads", type=int, default=1,
+        help="Number of worker processes. Default: %(default)s"
+    )
 
 
 def main(args):
@@ -37,6 +61,10 @@ def main(args):
         uncorrected_file=args.input,
         corrections_file=args.corrections,
         corrected_fasta=args.output_fasta,
+        positional=args.positional,
+        barcode_pattern=args.barcode_pattern,
+        tmpdir=args.tmpdir,
+        threads=args.threads,
     )
 
 
@@ -44,6 +72,10 @@ def run_correctfastq(
     uncorrected_file: str,
     corrections_file: str,
     corrected_fasta: str,
+    positional: bool = False,
+    barcode_pattern: Optional[str] = None,
+    tmpdir: str = None,
+    threads: int = 1,
 ):
     logger.info("Starting analysis")
     logger.info(f"Processing file: {corrections_file}")
@@ -53,25 +85,126 @@ def run_correctfastq(
     if os.stat(corrections_file).st_size == 0:
         logging.warning(f"File {corrections_file} is empty.")
 
-    corr_map = get_corrections(corrections_file, summary)
+    with TemporaryDirectory(dir=tmpdir) as tmp:
+        table = get_corrections(corrections_file, summary, Path(tmp) / "corrections.npy")
+
+        logger.info(f"Correcting sequences using {threads} worker(s) and writing to output file.")
+
+        # Workers memory-map the same correction table from disk.
+        with xopen(corrected_fasta, mode="wb", threads=threads) as writer:
+            chunks = read_chunks(uncorrected_file, threads=threads)
+            results = parallel_map(_correct_chunk, chunks, threads=threads, initializer=_init_worker,
+                                   initargs=(table.path, positional, barcode_pattern))
+            for corrected_chunk, chunk_summary in tqdm(results, desc="Parsing chunks"):
+                writer.write(corrected_chunk)
+                summary.update(chunk_summary)
+
+    summary.print_stats(name=__name__)
+
+    logger.info("Finished")
+
+
+_table = None
+_positional = False
+_pattern = None
+
+
+def _init_worker(table_path: Path, positional: bool = False, barcode_pattern: Optional[str] = None):
+    global _table, _positional, _pattern
+    _table = CorrectionTable(table_path)
+    _positional = positional
+    _pattern = BarcodePattern(barcode_pattern) if barcode_pattern is not None else None
+
+
+def _correct_chunk(chunk: bytes) -> Tuple[bytes, Summary]:
+    summary = Summary()
+    corrected = list(correct_records(parse_chunk(chunk), _table, summary, positional=_positional, pattern=_pattern))
+    return format_records(corrected), summary
+
 
-    logger.info("Correcting sequences and writing to output file.")
+def correct_records(records: Iterable[dnaio.SequenceRecord], table: "CorrectionTable", summary: Summary,
+                    positional: bool = False, batch_size: int = 10_000,
+                    pattern: Optional[BarcodePattern] = None) -> Iterator[dnaio.SequenceRecord]:
+    """
+    Correct records in batches and yield the records that have a corrected sequence. If positional, all records are
+    yielded and records without corrected sequence are emptied. Empty records are then not counted. If a pattern is
+    given, corrected sequences not matching it are handled as missing.
+    """
+    records = iter(records)
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            return
+
+        corrected = table.correct([read.sequence for read in batch])
+        if pattern is not None:
+            matches = pattern.match([sequence or "" for sequence in corrected])
+            for i in np.flatnonzero(~matches).tolist():
+                if corrected[i] is not None:
+                    summary["Reads with corrected sequence not matching pattern"] += 1
+                    corrected[i] = None
+
+        for read, sequence in zip(batch, corrected):
+            if positional and not read.sequence:
+                yield read
+                continue
 
-    with dnaio.open(uncorrected_file, mode="r") as reader, \
-            dnaio.open(corrected_fasta, mode="w") as writer:
-        for read in tqdm(reader, desc="Parsing reads"):
             summary["Reads total"] += 1
-            if read.sequence in corr_map:
-                read.sequence = corr_map[read.sequence]
+            if sequence is not None:
+                read.sequence = sequence
 
-                writer.write(read)
                 summary["Reads corrected"] += 1
+                yield read
             else:
                 summary["Reads without corrected sequence"] += 1
+                if positional:
+                    read.sequence = ""
+                    yield read
 
-    summary.print_stats(name=__name__)
 
-    logger.info("Finished")
+class CorrectionTable:
+    """
+    Table of 2-bit packed raw sequences and their corrected sequence. The table is stored as a .npy array with sorted
+    raw sequences in the first row and corrected sequences in the second row and is memory-mapped, so that processes
+    opening the same file share its memory.
+    """
+    def __init__(self, path: Path):
+        self.path = path
+        table = np.load(path, mmap_mode="r")
+        self.raw = table[0]
+        self.corrected = table[1]
+
+    def __len__(self):
+        return len(self.raw)
+
+    @classmethod
+    def write(cls, path: Path, raw: np.ndarray, corrected: np.ndarray) -> "CorrectionTable":
+        """Write table from packed sequences. For duplicate raw sequences the last correction is kept."""
+        order = np.argsort(raw, kind="stable")
+        raw = raw[order]
+        last = np.append(raw[1:] != raw[:-1], True) if len(raw) else np.empty(0, dtype=bool)
+        with open(path, "wb") as file:
+            np.save(file, np.stack([raw[last], corrected[order][last]]).astype(np.uint64))
+        return cls(path)
+
+    def lookup(self, keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Return corrected keys for packed raw keys and boolean array marking keys found in the table"""
+        if len(self.raw) == 0:
+            return np.zeros_like(keys), np.zeros(len(keys), dtype=bool)
+
+        positions = np.minimum(np.searchsorted(self.raw, keys), len(self.raw) - 1)
+        found = self.raw[positions] == keys
+        return np.where(found, self.corrected[positions], 0), found
+
+    def correct(self, sequences: Sequence[str]) -> List[Optional[str]]:
+        """Return corrected sequence for each sequence or None if not in the table"""
+        keys, valid = encode_variable_length(sequences)
+        corrected_keys, found = self.lookup(keys)
+        found &= valid
+        result = [None] * len(sequences)
+        for i, sequence in zip(np.flatnonzero(found).tolist(), decode_variable_length(corrected_keys[found])):
+            result[i] = sequence
+        return result
 
 
 def parse_starcode_file(filename: Path) -> Iterator[Tuple[str, int, List[str]]]:
@@ -86,19 +219,104 @@ def parse_starcode_file(filename: Path) -> Iterator[Tuple[str, int, List[str]]]:
             yield cluster_seq, int(num_reads), raw_seqs
 
 
-def get_corrections(corrections_file: Path, summary: Summary) -> Dict[str, str]:
-    corr_map = {}
-    stats = defaultdict(list)
-    for cluster_seq, num_reads, raw_seqs in tqdm(parse_starcode_file(corrections_file), desc="Parsing clusters"):
-        summary["Clusters"] += 1
-        stats["read"].append(num_reads)
-        stats["sequence"].append(len(raw_seqs))
-        corr_map.update({raw_seq: cluster_seq for raw_seq in raw_seqs})
+def get_corrections(corrections_file: Path, summary: Summary, table_path: Path) -> CorrectionTable:
+    """
+    Write correction table to table_path from the starcode output or the binary clusters from `dbspro clusterdbs`.
+    """
+    stats = {"read": Histogram(), "sequence": Histogram()}
+    if str(corrections_file).endswith(".npy"):
+        clusters = np.load(corrections_file, mmap_mode="r")
+        canonical, index, sizes = np.unique(clusters["canonical"], return_inverse=True, return_counts=True)
+        summary["Clusters"] += len(canonical)
+        stats["read"].update(np.bincount(index, weights=clusters["count"], minlength=len(canonical)).astype(int))
+        stats["sequence"].update(sizes)
+        raw = np.asarray(clusters["raw"])
+        corrected = np.asarray(clusters["canonical"])
+    else:
+        raw_batches = []
+        corrected_batches = []
+        raw_seqs_batch = []
+        cluster_seqs_batch = []
+        for cluster_seq, num_reads, raw_seqs in tqdm(parse_starcode_file(corrections_file), desc="Parsing clusters"):
+            summary["Clusters"] += 1
+            stats["read"].add(num_reads)
+            stats["sequence"].add(len(raw_seqs))
+            raw_seqs_batch.extend(raw_seqs)
+            cluster_seqs_batch.extend([cluster_seq] * len(raw_seqs))
+            if len(raw_seqs_batch) >= 1_000_000:
+                _encode_batch(raw_seqs_batch, cluster_seqs_batch, raw_batches, corrected_batches)
+
+        _encode_batch(raw_seqs_batch, cluster_seqs_batch, raw_batches, corrected_batches)
+        raw = np.concatenate(raw_batches)
+        corrected = np.concatenate(corrected_batches)
 
     # Add statistics
-    for stat, values in stats.items():
-        summary[f"Max {stat}s per cluster"] = max(values)
-        summary[f"Mean {stat}s per cluster"] = statistics.mean(values)
-        summary[f"Median {stat}s per cluster"] = statistics.median(values)
-        summary[f"Clusters with one {stat}"] = sum(1 for v in values if v == 1)
-    return corr_map
+    for stat, histogram in stats.items():
+        if not histogram:
+            continue
+        summary[f"Max {stat}s per cluster"] = histogram.max()
+        summary[f"Mean {stat}s per cluster"] = histogram.mean()
+        summary[f"Median {stat}s per cluster"] = histogram.median()
+        summary[f"Clusters with one {stat}"] = histogram.count(1)
+    return CorrectionTable.write(table_path, raw, corrected)
+
+
+class Histogram:
+    """
+    Counts of integer values used to compute statistics without keeping each value. Results have the same types as
+    from the statistics module for a list of the values, i.e. mean and median are integers if exact.
+    """
+    def __init__(self):
+        self.counts = Counter()
+
+    def __len__(self):
+        return sum(self.counts.values())
+
+    def add(self, value: int):
+        self.counts[value] += 1
+
+    def update(self, values: np.ndarray):
+        """Add array of values"""
+        unique, counts = np.unique(values, return_counts=True)
+        for value, count in zip(unique.tolist(), counts.tolist()):
+            self.counts[value] += count
+
+    def count(self, value: int) -> int:
+        return self.counts[value]
+
+    def max(self) -> int:
+        return max(self.counts)
+
+    def mean(self):
+        total = sum(value * count for value, count in self.counts.items())
+        n = len(self)
+        return total // n if total % n == 0 else total / n
+
+    def median(self):
+        # Find values at positions (n - 1) // 2 and n // 2 in sorted order
+        n = len(self)
+        positions = [(n - 1) // 2, n // 2]
+        values = []
+        seen = 0
+        for value in sorted(self.counts):
+            seen += self.counts[value]
+            while positions and positions[0] < seen:
+                values.append(value)
+                positions.pop(0)
+            if not positions:
+                break
+        return values[0] if n % 2 == 1 else (values[0] + values[1]) / 2
+
+
+def _encode_batch(raw_seqs: List[str], cluster_seqs: List[str], raw_batches: List[np.ndarray],
+                  corrected_batches: List[np.ndarray]):
+    """Encode batch of raw and corrected sequences, skipping pairs that cannot be packed, and clear the batch"""
+    raw, raw_valid = encode_variable_length(raw_seqs)
+    corrected, corrected_valid = encode_variable_length(cluster_seqs)
+    valid = raw_valid & corrected_valid
+    if not valid.all():
+        logger.warning(f"Skipping {(~valid).sum():,} sequences that could not be encoded.")
+    raw_batches.append(raw[valid])
+    corrected_batches.append(corrected[valid])
+    raw_seqs.clear()
+    cluster_seqs.clear()
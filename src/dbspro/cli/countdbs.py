@@ -0,0 +1,200 @@
+"""
+Count DBS sequences and write TSV with sequence and read count for clustering with starcode.
+
+Sequences are 2-bit packed into 64-bit integers and counted in sorted arrays. Counts are merged in memory until
+reaching the memory limit after which they are spilled to disk and merged at the end. If the output ends with .npy
+the packed sequences and counts are saved as a binary array for `dbspro clusterdbs` instead.
+"""
+import logging
+import os
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import List, Tuple
+
+import numpy as np
+from xopen import xopen
+
+from dbspro.utils import Summary, tqdm, read_chunks, parse_chunk, parallel_map, encode_variable_length, \
+    decode_variable_length
+
+logger = logging.getLogger(__name__)
+
+COUNTS_DTYPE = np.dtype([("sequence", np.uint64), ("count", np.uint64)])
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        "input", type=Path,
+        help="FASTQ/FASTA with DBS sequences."
+    )
+    parser.add_argument(
+        "-o", "--output", default="-",
+        help="Output TSV with DBS sequence and read count. Saved as binary array if ending with .npy. Default: "
+             "write to stdout"
+    )
+    parser.add_argument(
+        "-m", "--max-memory", type=int, default=4096,
+        help="Approximate memory in MB used for counts before spilling to disk. Default: %(default)s"
+    )
+    parser.add_argument(
+        "--tmpdir",
+        help="Directory for temporary files. Default: system default"
+    )
+    parser.add_argument(
+        "-j", "--threads", type=int, default=1,
+        help="Number of worker processes. Default: %(default)s"
+    )
+
+
+def main(args):
+    run_countdbs(
+        input=args.input,
+        output=args.output,
+        max_memory=args.max_memory,
+        tmpdir=args.tmpdir,
+        threads=args.threads,
+    )
+
+
+def run_countdbs(
+    input: str,
+    output: str,
+    max_memory: int = 4096,
+    tmpdir: str = None,
+    threads: int = 1,
+):
+    logger.info("Starting")
+    logger.info(f"Processing file: {input}")
+
+    summary = Summary()
+    # Half of the memory is used to collect counts and the other half when merging them.
+    max_entries = max(max_memory * 1024 ** 2 // (2 * COUNTS_DTYPE.itemsize), 1)
+
+    with TemporaryDirectory(dir=tmpdir) as tmp:
+        spilled = []
+        runs = []
+        nr_entries = 0
+        results = parallel_map(_count_chunk, read_chunks(input, threads=threads), threads=threads)
+        for counts, chunk_summary in tqdm(results, desc="Parsing chunks"):
+            summary.update(chunk_summary)
+            runs.append(counts)
+            nr_entries += len(counts)
+            if nr_entries > max_entries:
+                counts = merge_counts(runs)
+                runs = [counts]
+                nr_entries = len(counts)
+                # Spill to disk if merging did not free enough memory
+                if nr_entries > max_entries // 2:
+                    spilled.append(spill_counts(counts, tmp, len(spilled)))
+                    runs = []
+                    nr_entries = 0
+
+        if spilled:
+            if runs:
+                spilled.append(spill_counts(merge_counts(runs), tmp, len(spilled)))
+            logger.info(f"Merging {len(spilled)} runs spilled to disk")
+            summary["Runs spilled to disk"] = len(spilled)
+            blocks = iter_merged_blocks([np.load(file, mmap_mode="r") for file in spilled], max_entries)
+        else:
+            blocks = [merge_counts(runs)]
+
+        logger.info(f"Writing counts to {output}")
+        if str(output).endswith(".npy"):
+            counts = np.concatenate(list(blocks))
+            summary["Unique DBS"] += len(counts)
+            np.save(output, counts)
+        else:
+            with xopen(str(output), mode="wb", threads=threads) as writer:
+                for block in blocks:
+                    summary["Unique DBS"] += len(block)
+                    writer.write(format_counts(block))
+
+    summary.print_stats(name=__name__)
+
+    logger.info("Finished")
+
+
+def _count_chunk(chunk: bytes) -> Tuple[np.ndarray, Summary]:
+    summary = Summary()
+    # Empty records are placeholders for reads without DBS in positional output from `dbspro extract`.
+    sequences = [read.sequence for read in parse_chunk(chunk) if read.sequence]
+    summary["Reads total"] += len(sequences)
+    keys, valid = encode_variable_length(sequences)
+    summary["Reads with invalid DBS"] += int((~valid).sum())
+    unique, counts = np.unique(keys[valid], return_counts=True)
+    return make_counts(unique, counts), summary
+
+
+def make_counts(sequences: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    result = np.empty(len(sequences), dtype=COUNTS_DTYPE)
+    result["sequence"] = sequences
+    result["count"] = counts
+    return result
+
+
+def load_counts(file: str) -> np.ndarray:
+    """Load counts saved as binary array or in starcode input format"""
+    if str(file).endswith(".npy"):
+        return np.load(file)
+
+    sequences = []
+    counts = []
+    with xopen(file) as reader:
+        for line in reader:
+            sequence, count = line.split()
+            sequences.append(sequence)
+            counts.append(int(count))
+
+    keys, valid = encode_variable_length(sequences)
+    if not valid.all():
+        logger.warning(f"Skipping {(~valid).sum():,} sequences that could not be encoded.")
+    return merge_counts([make_counts(keys[valid], np.array(counts, dtype=np.uint64)[valid])])
+
+
+def merge_counts(runs: List[np.ndarray]) -> np.ndarray:
+    """Merge arrays of packed sequences and counts summing the counts of identical sequences"""
+    if not runs:
+        return np.empty(0, dtype=COUNTS_DTYPE)
+
+    merged = np.concatenate(runs)
+    merged = merged[np.argsort(merged["sequence"], kind="stable")]
+    if len(merged) == 0:
+        return merged
+
+    starts = np.flatnonzero(np.concatenate([[True], merged["sequence"][1:] != merged["sequence"][:-1]]))
+    return make_counts(merged["sequence"][starts], np.add.reduceat(merged["count"], starts))
+
+
+def spill_counts(counts: np.ndarray, directory: str, index: int) -> str:
+    file = os.path.join(directory, f"run{index}.npy")
+    logger.info(f"Spilling {len(counts):,} counts to {file}")
+    np.save(file, counts)
+    return file
+
+
+def iter_merged_blocks(runs: List[np.ndarray], max_entries: int):
+    """
+    Merge sorted count arrays by splitting the packed sequence space into blocks of roughly max_entries entries
+    across all runs. Runs may be memory-mapped so that only one block is held in memory at a time.
+    """
+    total = sum(len(run) for run in runs)
+    nr_blocks = max(total // max_entries + 1, 1)
+    # Sample sequences from all runs to select boundaries between blocks.
+    step = max(total // (nr_blocks * 100), 1)
+    sample = np.sort(np.concatenate([run["sequence"][::step] for run in runs]))
+    boundaries = np.unique(sample[np.linspace(0, len(sample), nr_blocks, endpoint=False, dtype=int)[1:]])
+
+    starts = [0] * len(runs)
+    for boundary in list(boundaries) + [None]:
+        block = []
+        for i, run in enumerate(runs):
+            stop = len(run) if boundary is None else int(np.searchsorted(run["sequence"], boundary))
+            block.append(np.asarray(run[starts[i]:stop]))
+            starts[i] = stop
+        yield merge_counts(block)
+
+
+def format_counts(counts: np.ndarray) -> bytes:
+    """Format counts as TSV lines in starcode input format"""
+    sequences = decode_variable_length(counts["sequence"])
+    return "".join(f"{seq}\t{count}\n" for seq, count in zip(sequences, counts["count"].tolist())).encode()
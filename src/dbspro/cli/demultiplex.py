@@ -0,0 +1,366 @@
+"""
+Demultiplex reads by anchored ABC sequence and write the trimmed reads to one file per target.
+
+Replaces running `cutadapt -g file:ABC-sequences.fasta --no-indels`. All ABCs have the same length, so each ABC and
+all sequences within the allowed number of mismatches are put in a lookup table that classifies a read with a single
+lookup on its prefix. As for cutadapt, a sequence matching several ABCs with the same number of errors is ambiguous
+and not assigned to any ABC.
+
+If the output path does not contain '{name}', all reads are instead written to a single file with the target name
+inserted as the second last word of the header, e.g. 'ABC01 DBS'. This target-tagged output is used to cluster UMIs
+for all targets of a sample at once with `dbspro splitcluster --panel`.
+
+A report in the same format as cutadapt is written to stdout so that MultiQC and `dbspro summary` can parse it.
+"""
+from contextlib import ExitStack
+import json
+import logging
+import math
+from pathlib import Path
+import platform
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+import cutadapt
+import numpy as np
+from xopen import xopen
+
+from dbspro.utils import Summary, tqdm, read_chunks, parse_chunk, format_records, parallel_map, get_abcs, IUPAC_MAP
+
+logger = logging.getLogger(__name__)
+
+# Lookup tables larger than this are not built to limit memory usage.
+MAX_TABLE_SIZE = 20_000_000
+UNKNOWN = "unknown"
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        "input", type=Path,
+        help="Input FASTA/FASTQ with ABC+UMI sequences."
+    )
+    parser.add_argument(
+        "-a", "--abc-file", type=Path, required=True,
+        help="FASTA with anchored ABC sequences and target names."
+    )
+    parser.add_argument(
+        "-o", "--output", required=True,
+        help="Output path for trimmed reads where '{name}' is replaced by the target name. Reads without ABC are "
+             f"written to the '{UNKNOWN}' output. Without '{{name}}', all reads are written to this file with the "
+             "target name added to the header."
+    )
+    parser.add_argument(
+        "-e", "--error-rate", type=float, default=0.1,
+        help="Maximum allowed error rate for matching ABCs. Default: %(default)s"
+    )
+    parser.add_argument(
+        "--discard-untrimmed", action="store_true", default=False,
+        help="Discard reads without ABC instead of writing them to the unknown output."
+    )
+    parser.add_argument(
+        "--json", type=Path,
+        help="Write report in cutadapt JSON format to this file."
+    )
+    parser.add_argument(
+        "-j", "--threads", type=int, default=1,
+        help="Number of worker processes. Default: %(default)s"
+    )
+
+
+def main(args):
+    run_demultiplex(
+        input=args.input,
+        abc_file=args.abc_file,
+        output=args.output,
+        error_rate=args.error_rate,
+        discard_untrimmed=args.discard_untrimmed,
+        json_report=args.json,
+        threads=args.threads,
+    )
+
+
+def run_demultiplex(
+    input: str,
+    abc_file: str,
+    output: str,
+    error_rate: float = 0.1,
+    discard_untrimmed: bool = False,
+    json_report: Optional[str] = None,
+    threads: int = 1,
+):
+    logger.info("Starting")
+    logger.info(f"Processing file: {input}")
+    start_time = time.time()
+
+    abcs = get_abcs(abc_file)
+    names = abcs["Target"].tolist()
+    sequences = [sequence.lstrip("^") for sequence in abcs["Sequence"]]
+    demultiplexer = ABCDemultiplexer(sequences, error_rate)
+    logger.info(f"Built lookup table with {len(demultiplexer.table):,} sequences for {len(names)} ABCs.")
+    if demultiplexer.ambiguous:
+        logger.warning(f"The ABCs are too similar. {demultiplexer.ambiguous:,} sequences would match several ABCs "
+                       f"equally well and reads with these will not be assigned.")
+
+    tagged = "{name}" not in output
+    if tagged:
+        logger.info(f"Writing reads tagged with target name to {output}")
+        outputs = [output]
+    else:
+        outputs = [output.replace("{name}", name) for name in names]
+        if not discard_untrimmed:
+            outputs.append(output.replace("{name}", UNKNOWN))
+
+    summary = Summary()
+    error_counts = np.zeros((len(names), demultiplexer.max_errors + 1), dtype=np.int64)
+    with ExitStack() as stack:
+        writers = [stack.enter_context(xopen(path, mode="wb", compresslevel=1, threads=0)) for path in outputs]
+        chunks = read_chunks(input, threads=threads)
+        results = parallel_map(_demultiplex_chunk, chunks, threads=threads, initializer=_init_worker,
+                               initargs=(sequences, error_rate, discard_untrimmed, names if tagged else None))
+        for target_chunks, chunk_summary, chunk_error_counts in tqdm(results, desc="Parsing chunks"):
+            for writer, target_chunk in zip(writers, target_chunks):
+                writer.write(target_chunk)
+            summary.update(chunk_summary)
+            error_counts += chunk_error_counts
+
+    elapsed = time.time() - start_time
+    print_report(summary, names, sequences, error_counts, elapsed, threads)
+    if json_report is not None:
+        write_json_report(json_report, input, summary, names, sequences, error_rate, error_counts, threads)
+
+    logger.info("Finished")
+
+
+_demultiplexer = None
+_discard_untrimmed = False
+_tag_names = None
+
+
+def _init_worker(sequences: List[str], error_rate: float, discard_untrimmed: bool,
+                 tag_names: Optional[List[str]] = None):
+    global _demultiplexer, _discard_untrimmed, _tag_names
+    _demultiplexer = ABCDemultiplexer(sequences, error_rate)
+    _discard_untrimmed = discard_untrimmed
+    _tag_names = tag_names + [UNKNOWN] if tag_names is not None else None
+
+
+def _demultiplex_chunk(chunk: bytes) -> Tuple[List[bytes], Summary, np.ndarray]:
+    summary = Summary()
+    nr_targets = len(_demultiplexer.sequences)
+    records = [[] for _ in range(nr_targets + 1)]
+    error_counts = np.zeros((nr_targets, _demultiplexer.max_errors + 1), dtype=np.int64)
+    for read in parse_chunk(chunk):
+        summary["Total reads processed"] += 1
+        summary["Total basepairs processed"] += len(read.sequence)
+        target, errors = _demultiplexer(read.sequence)
+        if target is None:
+            if _discard_untrimmed:
+                summary["Reads discarded as untrimmed"] += 1
+                continue
+            target = nr_targets
+        else:
+            summary["Reads with adapters"] += 1
+            error_counts[target, errors] += 1
+            read = read[_demultiplexer.length:]
+
+        if _tag_names is not None:
+            read.name = tag_name(read.name, _tag_names[target])
+            target = 0
+
+        records[target].append(read)
+        summary["Reads written (passing filters)"] += 1
+        summary["Total written (filtered)"] += len(read.sequence)
+
+    if _tag_names is not None:
+        records = records[:1]
+    elif _discard_untrimmed:
+        records.pop()
+
+    return [format_records(target_records) for target_records in records], summary, error_counts
+
+
+def tag_name(name: str, target: str) -> str:
+    """Insert target before the last word, i.e. the DBS, of the read name"""
+    prefix, _, dbs = name.rpartition(" ")
+    return f"{prefix} {target} {dbs}" if prefix else f"{target} {dbs}"
+
+
+class ABCDemultiplexer:
+    """
+    Assign sequences to the ABC matching its prefix with the fewest mismatches using a lookup table of all sequences
+    within the allowed number of errors from each ABC.
+    """
+    def __init__(self, sequences: List[str], error_rate: float):
+        self.sequences = sequences
+        self.length = len(sequences[0])
+        self.max_errors = int(error_rate * self.length)
+        self.table: Dict[str, Tuple[int, int]] = {}
+        self.ambiguous = 0
+
+        table_size = len(sequences) * sum(math.comb(self.length, errors) * 3 ** errors
+                                          for errors in range(self.max_errors + 1))
+        if table_size > MAX_TABLE_SIZE:
+            raise ValueError(f"Lookup table for {len(sequences)} ABCs of length {self.length} with up to "
+                             f"{self.max_errors} errors would contain {table_size:,} sequences. Lower the error "
+                             f"rate.")
+
+        ambiguous = set()
+        for index, sequence in enumerate(sequences):
+            for neighbor, errors in hamming_neighbors(sequence, self.max_errors):
+                current = self.table.get(neighbor)
+                if current is None or errors < current[1]:
+                    self.table[neighbor] = (index, errors)
+                    ambiguous.discard(neighbor)
+                elif errors == current[1] and current[0] != index:
+                    ambiguous.add(neighbor)
+
+        for neighbor in ambiguous:
+            del self.table[neighbor]
+        self.ambiguous = len(ambiguous)
+
+    def __call__(self, sequence: str) -> Tuple[Optional[int], Optional[int]]:
+        """Return index of matching ABC and number of errors or None if no ABC matches"""
+        return self.table.get(sequence[:self.length], (None, None))
+
+
+def hamming_neighbors(pattern: str, max_errors: int) -> List[Tuple[str, int]]:
+    """Return all sequences matching IUPAC pattern with at most max_errors mismatches and their number of errors"""
+    neighbors = [("", 0)]
+    for base in pattern:
+        allowed = sorted(IUPAC_MAP.get(base, {base}))
+        other = [b for b in "ACGT" if b not in allowed]
+        neighbors = [(prefix + b, errors) for prefix, errors in neighbors for b in allowed] + \
+                    [(prefix + b, errors + 1) for prefix, errors in neighbors if errors < max_errors for b in other]
+    return neighbors
+
+
+def _percent(value: int, total: int) -> str:
+    return f"({100 * value / total:.1f}%)" if total else "(0.0%)"
+
+
+def print_report(summary: Summary, names: List[str], sequences: List[str], error_counts: np.ndarray, elapsed: float,
+                 threads: int, file=None):
+    """Print report in the same format as cutadapt"""
+    file = file if file is not None else sys.stdout
+    total_reads = summary["Total reads processed"]
+    total_bp = summary["Total basepairs processed"]
+    length = len(sequences[0])
+    per_read = 1e6 * elapsed / total_reads if total_reads else 0
+    print(f"This is cutadapt {cutadapt.__version__} with Python {platform.python_version()}", file=file)
+    print(f"Command line parameters: {' '.join(sys.argv[1:])}", file=file)
+    print(f"Processing single-end reads on {threads} core{'s' if threads > 1 else ''} ...", file=file)
+    print(f"Finished in {elapsed:.3f} s ({per_read:.3f} µs/read; "
+          f"{total_reads / elapsed / 1e6 * 60 if elapsed else 0:.2f} M reads/minute).", file=file)
+    print(file=file)
+    print("=== Summary ===", file=file)
+    print(file=file)
+    print(f"Total reads processed:           {total_reads:>13,}", file=file)
+    print(f"Reads with adapters:             {summary['Reads with adapters']:>13,} "
+          f"{_percent(summary['Reads with adapters'], total_reads)}", file=file)
+    print(file=file)
+    print("== Read fate breakdown ==", file=file)
+    discarded = summary["Reads discarded as untrimmed"]
+    print(f"Reads discarded as untrimmed:    {discarded:>13,} {_percent(discarded, total_reads)}", file=file)
+    written = summary["Reads written (passing filters)"]
+    print(f"Reads written (passing filters): {written:>13,} {_percent(written, total_reads)}", file=file)
+    print(file=file)
+    print(f"Total basepairs processed: {total_bp:>13,} bp", file=file)
+    written_bp = summary["Total written (filtered)"]
+    print(f"Total written (filtered):  {written_bp:>13,} bp {_percent(written_bp, total_bp)}", file=file)
+
+    max_errors = error_counts.shape[1] - 1
+    expect = total_reads * 0.25 ** length
+    for i, (name, sequence, counts) in enumerate(zip(names, sequences, error_counts)):
+        if i > 0:
+            print(file=file)
+        print(file=file)
+        print(f"=== Adapter {name} ===", file=file)
+        print(file=file)
+        print(f"Sequence: {sequence}; Type: anchored 5'; Length: {length}; Trimmed: {counts.sum()} times", file=file)
+        print(file=file)
+        print(f"No. of allowed errors: {max_errors}", file=file)
+        print(file=file)
+        print("Overview of removed sequences", file=file)
+        print("length\tcount\texpect\tmax.err\terror counts", file=file)
+        if counts.sum():
+            # Trailing zero error counts are not shown
+            shown = counts[:np.flatnonzero(counts).max() + 1]
+            print(f"{length}\t{counts.sum()}\t{expect:.1f}\t{max_errors}\t{' '.join(map(str, shown))}", file=file)
+
+
+def write_json_report(path: str, input: str, summary: Summary, names: List[str], sequences: List[str],
+                      error_rate: float, error_counts: np.ndarray, threads: int):
+    """Write report in the cutadapt JSON report format"""
+    length = len(sequences[0])
+    expect = summary["Total reads processed"] * 0.25 ** length
+    adapters = []
+    for name, sequence, counts in zip(names, sequences, error_counts):
+        trimmed_lengths = []
+        if counts.sum():
+            shown = counts[:np.flatnonzero(counts).max() + 1]
+            trimmed_lengths.append({"len": length, "expect": round(expect, 1), "counts": shown.tolist()})
+        adapters.append({
+            "name": name,
+            "total_matches": int(counts.sum()),
+            "on_reverse_complement": None,
+            "linked": False,
+            "five_prime_end": {
+                "type": "anchored_five_prime",
+                "sequence": sequence,
+                "error_rate": error_rate,
+                "indels": False,
+                "error_lengths": None,
+                "matches": int(counts.sum()),
+                "adjacent_bases": None,
+                "dominant_adjacent_base": None,
+                "trimmed_lengths": trimmed_lengths,
+            },
+            "three_prime_end": None,
+        })
+
+    report = {
+        "tag": "Cutadapt report",
+        "schema_version": [0, 3],
+        "cutadapt_version": cutadapt.__version__,
+        "python_version": platform.python_version(),
+        "command_line_arguments": sys.argv[1:],
+        "cores": threads,
+        "input": {"path1": str(input), "path2": None, "paired": False},
+        "read_counts": {
+            "input": summary["Total reads processed"],
+            "filtered": {
+                "too_short": None,
+                "too_long": None,
+                "too_many_n": None,
+                "too_many_expected_errors": None,
+                "casava_filtered": None,
+                "discard_trimmed": None,
+                "discard_untrimmed": summary["Reads discarded as untrimmed"],
+            },
+            "output": summary["Reads written (passing filters)"],
+            "reverse_complemented": None,
+            "read1_with_adapter": summary["Reads with adapters"],
+            "read2_with_adapter": None,
+        },
+        "basepair_counts": {
+            "input": summary["Total basepairs processed"],
+            "input_read1": summary["Total basepairs processed"],
+            "input_read2": None,
+            "quality_trimmed": None,
+            "quality_trimmed_read1": None,
+            "quality_trimmed_read2": None,
+            "poly_a_trimmed": None,
+            "poly_a_trimmed_read1": None,
+            "poly_a_trimmed_read2": None,
+            "output": summary["Total written (filtered)"],
+            "output_read1": summary["Total written (filtered)"],
+            "output_read2": None,
+        },
+        "adapters_read1": adapters,
+        "adapters_read2": None,
+        "poly_a_trimmed_read1": None,
+        "poly_a_trimmed_read2": None,
+    }
+    with open(path, "w") as file:
+        json.dump(report, file, indent=2)
@@ -0,0 +1,330 @@
+"""
+Extract DBS and ABC+UMI sequences from reads in a single pass.
+
+Locates the handles h1, h2 and h3 in each read and writes the DBS and the ABC+UMI segments to separate FASTA files.
+Adapter matching uses the same semantics as cutadapt, so this replaces trimming the outer handles followed by a
+separate DBS extraction step.
+
+With --positional, both outputs contain one record per input read in the input order. Discarded segments are written
+as empty records and read names are omitted, so the outputs can be joined by position using `dbspro tagfastq
+--positional`.
+
+With --barcode-pattern, reads where the DBS does not match the IUPAC pattern are discarded already here so that they
+are not included in DBS clustering.
+
+A report for the outer handle trimming is written to stdout in the cutadapt format so that it can be parsed by MultiQC.
+"""
+import logging
+from pathlib import Path
+import platform
+import sys
+import time
+from typing import Optional, Tuple
+
+import cutadapt
+import dnaio
+from cutadapt.parser import make_adapter
+import numpy as np
+from xopen import xopen
+
+from dbspro.utils import Summary, tqdm, read_chunks, parse_chunk, format_records, parallel_map, BarcodePattern
+
+logger = logging.getLogger(__name__)
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        "input", type=Path,
+        help="Input FASTQ/FASTA with raw reads."
+    )
+    parser.add_argument(
+        "--dbs-output", type=Path, required=True,
+        help="Output FASTA with DBS sequences."
+    )
+    parser.add_argument(
+        "--abc-umi-output", type=Path, required=True,
+        help="Output FASTA with ABC+UMI sequences."
+    )
+    parser.add_argument(
+        "--h1",
+        help="Sequence of h1 handle preceding the DBS. Omit for constructs without h1, e.g. PBA."
+    )
+    parser.add_argument(
+        "--h2", required=True,
+        help="Sequence of h2 handle between DBS and ABC."
+    )
+    parser.add_argument(
+        "--h3", required=True,
+        help="Sequence of h3 handle following the UMI."
+    )
+    parser.add_argument(
+        "--dbs-len", type=int, required=True,
+        help="Length of DBS sequence."
+    )
+    parser.add_argument(
+        "--abc-umi-len", type=int, required=True,
+        help="Required length of ABC+UMI sequence. Reads with other lengths are discarded."
+    )
+    parser.add_argument(
+        "-e", "--error-rate", type=float, default=0.2,
+        help="Maximum allowed error rate when matching outer handles. Default: %(default)s"
+    )
+    parser.add_argument(
+        "--dbs-error-rate", type=float, default=0.1,
+        help="Maximum allowed error rate when matching DBS and h2 handle. Default: %(default)s"
+    )
+    parser.add_argument(
+        "-m", "--min-len", type=int, default=0,
+        help="Discard reads shorter than this after removing outer handles. Default: %(default)s"
+    )
+    parser.add_argument(
+        "-M", "--max-len", type=int,
+        help="Discard reads longer than this after removing outer handles. Default: no limit"
+    )
+    parser.add_argument(
+        "-O", "--overlap", type=int, default=5,
+        help="Minimum overlap between read and non-anchored handle h3. Default: %(default)s"
+    )
+    parser.add_argument(
+        "-b", "--barcode-pattern",
+        help="IUPAC string with bases forming pattern that the DBS must match. Reads with other DBS are discarded. "
+             "Default: keep all DBS"
+    )
+    parser.add_argument(
+        "--positional", action="store_true", default=False,
+        help="Write one record without name per input read to both outputs, using empty records for discarded "
+             "segments."
+    )
+    parser.add_argument(
+        "-j", "--threads", type=int, default=1,
+        help="Number of worker processes. Default: %(default)s"
+    )
+
+
+def main(args):
+    run_extract(
+        input=args.input,
+        dbs_output=args.dbs_output,
+        abc_umi_output=args.abc_umi_output,
+        h1=args.h1,
+        h2=args.h2,
+        h3=args.h3,
+        dbs_len=args.dbs_len,
+        abc_umi_len=args.abc_umi_len,
+        error_rate=args.error_rate,
+        dbs_error_rate=args.dbs_error_rate,
+        min_len=args.min_len,
+        max_len=args.max_len,
+        overlap=args.overlap,
+        barcode_pattern=args.barcode_pattern,
+        positional=args.positional,
+        threads=args.threads,
+    )
+
+
+def run_extract(
+    input: str,
+    dbs_output: str,
+    abc_umi_output: str,
+    h1: Optional[str],
+    h2: str,
+    h3: str,
+    dbs_len: int,
+    abc_umi_len: int,
+    error_rate: float,
+    dbs_error_rate: float,
+    min_len: int,
+    max_len: Optional[int],
+    overlap: int,
+    barcode_pattern: Optional[str] = None,
+    positional: bool = False,
+    threads: int = 1,
+):
+    logger.info("Starting")
+    logger.info(f"Processing file: {input}")
+
+    summary = Summary()
+    extractor_kwargs = dict(
+        h1=h1, h2=h2, h3=h3, dbs_len=dbs_len, abc_umi_len=abc_umi_len, error_rate=error_rate,
+        dbs_error_rate=dbs_error_rate, min_len=min_len, max_len=max_len, overlap=overlap,
+    )
+
+    logger.info(f"Extracting DBS and ABC+UMI sequences using {threads} worker(s) and writing to output files.")
+    start_time = time.time()
+    with xopen(dbs_output, mode="wb", threads=threads) as dbs_writer, \
+            xopen(abc_umi_output, mode="wb", threads=threads) as abc_umi_writer:
+        chunks = read_chunks(input, threads=threads)
+        results = parallel_map(_extract_chunk, chunks, threads=threads, initializer=_init_worker,
+                               initargs=(extractor_kwargs, positional, barcode_pattern))
+        for dbs_chunk, abc_umi_chunk, chunk_summary in tqdm(results, desc="Parsing chunks"):
+            dbs_writer.write(dbs_chunk)
+            abc_umi_writer.write(abc_umi_chunk)
+            summary.update(chunk_summary)
+
+    elapsed = time.time() - start_time
+    print_report(summary, elapsed, threads, max_len=max_len)
+
+    summary.print_stats(name=__name__)
+
+    logger.info("Finished")
+
+
+def _percent(value: int, total: int) -> str:
+    return f"({100 * value / total:.1f}%)" if total else "(0.0%)"
+
+
+def print_report(summary: Summary, elapsed: float, threads: int, max_len: Optional[int] = None, file=None):
+    """
+    Print report for the outer handle trimming in the same format as cutadapt. As for cutadapt, reads that were too
+    long are only reported if there is a maximum length.
+    """
+    file = file if file is not None else sys.stdout
+    total_reads = summary["Reads total"]
+    total_bp = summary["Total basepairs processed"]
+    per_read = 1e6 * elapsed / total_reads if total_reads else 0
+    print(f"This is cutadapt {cutadapt.__version__} with Python {platform.python_version()}", file=file)
+    print(f"Command line parameters: {' '.join(sys.argv[1:])}", file=file)
+    print(f"Processing single-end reads on {threads} core{'s' if threads > 1 else ''} ...", file=file)
+    print(f"Finished in {elapsed:.3f} s ({per_read:.3f} µs/read; "
+          f"{total_reads / elapsed / 1e6 * 60 if elapsed else 0:.2f} M reads/minute).", file=file)
+    print(file=file)
+    print("=== Summary ===", file=file)
+    print(file=file)
+    print(f"Total reads processed:           {total_reads:>13,}", file=file)
+    trimmed = summary["Reads with outer handles"]
+    print(f"Reads with adapters:             {trimmed:>13,} {_percent(trimmed, total_reads)}", file=file)
+    print(file=file)
+    print("== Read fate breakdown ==", file=file)
+    fates = [("Reads that were too short:", "Reads too short")]
+    if max_len is not None:
+        fates.append(("Reads that were too long:", "Reads too long"))
+    fates.extend([
+        ("Reads with too many N:", "Reads with N"),
+        ("Reads written (passing filters):", "Reads written (passing filters)"),
+    ])
+    for label, key in fates:
+        print(f"{label:<33}{summary[key]:>13,} {_percent(summary[key], total_reads)}", file=file)
+    print(file=file)
+    print(f"Total basepairs processed: {total_bp:>13,} bp", file=file)
+    written_bp = summary["Total written (filtered)"]
+    print(f"Total written (filtered):  {written_bp:>13,} bp {_percent(written_bp, total_bp)}", file=file)
+
+
+_extractor = None
+_positional = False
+_pattern = None
+
+
+def _init_worker(extractor_kwargs, positional: bool = False, barcode_pattern: Optional[str] = None):
+    global _extractor, _positional, _pattern
+    _extractor = DBSExtractor(**extractor_kwargs)
+    _positional = positional
+    _pattern = BarcodePattern(barcode_pattern) if barcode_pattern is not None else None
+
+
+def _extract_chunk(chunk: bytes) -> Tuple[bytes, bytes, Summary]:
+    _extractor.summary = Summary()
+    reads = list(parse_chunk(chunk))
+    extracted = [_extractor(read.sequence) for read in reads]
+    if _pattern is not None:
+        matches = _pattern.match([dbs or "" for dbs, _ in extracted])
+        for i in np.flatnonzero(~matches).tolist():
+            if extracted[i][0] is not None:
+                _extractor.summary["Reads with DBS not matching pattern"] += 1
+                extracted[i] = (None, None)
+
+    dbs_records = []
+    abc_umi_records = []
+    for read, (dbs, abc_umi) in zip(reads, extracted):
+        if _positional:
+            dbs_records.append(dnaio.SequenceRecord("", dbs or ""))
+            abc_umi_records.append(dnaio.SequenceRecord("", abc_umi or ""))
+            continue
+
+        if dbs is not None:
+            dbs_records.append(dnaio.SequenceRecord(read.id, dbs))
+
+        if abc_umi is not None:
+            abc_umi_records.append(dnaio.SequenceRecord(read.id, abc_umi))
+
+    return format_records(dbs_records), format_records(abc_umi_records), _extractor.summary
+
+
+class DBSExtractor:
+    """
+    Locate handles in read and return the DBS and ABC+UMI sequences. Adapters are created through cutadapt to keep the
+    same matching semantics as running
+
+        cutadapt -g ^H1...H3 -e ERR -m MIN -M MAX --max-n 0 -O OVERLAP
+
+    followed by
+
+        cutadapt -g ^NNN...H2 -e DBS_ERR -m ABC_UMI_LEN -M ABC_UMI_LEN --discard-untrimmed --wildcard-file
+
+    where the DBS corresponds to the wildcard bases. As for the cutadapt wildcard file, the DBS is returned for all
+    reads with a DBS handle, also those where the ABC+UMI is discarded due to its length.
+    """
+    def __init__(self, h1: Optional[str], h2: str, h3: str, dbs_len: int, abc_umi_len: int, error_rate: float,
+                 dbs_error_rate: float = 0.1, min_len: int = 0, max_len: Optional[int] = None, overlap: int = 5,
+                 summary: Summary = None):
+        search_parameters = {
+            "max_errors": error_rate,
+            "min_overlap": overlap,
+            "read_wildcards": False,
+            "adapter_wildcards": True,
+            "indels": True,
+        }
+        if h1 is None:
+            self._outer = make_adapter(h3, "back", search_parameters)
+        else:
+            self._outer = make_adapter(f"^{h1}...{h3}", "front", search_parameters)
+
+        # Cutadapt default minimum overlap is used for the anchored DBS handle
+        search_parameters["max_errors"] = dbs_error_rate
+        search_parameters["min_overlap"] = 3
+        self._inner = make_adapter(f"^{'N' * dbs_len}{h2}", "front", search_parameters)
+
+        self._abc_umi_len = abc_umi_len
+        self._min_len = min_len
+        self._max_len = max_len
+        self.summary = summary if summary is not None else Summary()
+
+    def __call__(self, sequence: str) -> Tuple[Optional[str], Optional[str]]:
+        """Return DBS and ABC+UMI for sequence. Discarded segments are returned as None"""
+        self.summary["Reads total"] += 1
+        self.summary["Total basepairs processed"] += len(sequence)
+
+        match = self._outer.match_to(sequence)
+        if match is not None:
+            self.summary["Reads with outer handles"] += 1
+            start, stop = match.remainder_interval()
+            sequence = sequence[start:stop]
+
+        if len(sequence) < self._min_len:
+            self.summary["Reads too short"] += 1
+            return None, None
+
+        if self._max_len is not None and len(sequence) > self._max_len:
+            self.summary["Reads too long"] += 1
+            return None, None
+
+        if "N" in sequence:
+            self.summary["Reads with N"] += 1
+            return None, None
+
+        self.summary["Reads written (passing filters)"] += 1
+        self.summary["Total written (filtered)"] += len(sequence)
+
+        match = self._inner.match_to(sequence)
+        if match is None:
+            self.summary["Reads without DBS handle"] += 1
+            return None, None
+
+        self.summary["Reads with DBS"] += 1
+        abc_umi = sequence[match.rstop:]
+        if len(abc_umi) != self._abc_umi_len:
+            self.summary["Reads with wrong ABC+UMI length"] += 1
+            return match.wildcards(), None
+
+        self.summary["Reads with DBS and ABC+UMI"] += 1
+        return match.wildcards(), abc_umi
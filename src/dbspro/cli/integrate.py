@@ -4,36 +4,77 @@ Combines DBS and ABC-demultiplexed UMI FASTA file(s) into TSV file.
 Each TSV row has the following format:
 
     Barcode Target  UMI ReadCount   Sample
+
+With --panel, the input is a single file with reads for all targets, such as from `dbspro splitcluster --panel`, where
+the target is the second last word of each header instead of being taken from the file name.
+
+Input files ending with .tsv or .tsv.gz are read as collapsed output from `dbspro splitcluster --collapsed` with the
+columns Barcode, Target, UMI and ReadCount.
+
+All inputs must be sorted by barcode, as given by `dbspro tagfastq --sort-by-barcode`. The inputs are merged and read
+counts are aggregated in batches of complete barcode groups, with targets and UMIs encoded as integers, so that memory
+is bounded by the batch size rather than the sample size.
+
+If the output ends with .parquet, the data is written as a Parquet file instead of TSV. Barcode, Target and Sample are
+dictionary-encoded and UMIs are stored as 2-bit packed integers. Use `dbspro.notebook.load_data` to read either format.
+
+With --stats, QC aggregates of the output are written to a JSON file in the same pass. These are the total number of
+reads, constructs (rows) and barcodes, the reads and constructs per target and the histogram of read counts per
+construct in the format used by `preseq -H`.
 """
 
+from collections import Counter
+import heapq
+from itertools import groupby
+import json
 import logging
-from collections import defaultdict
+from operator import itemgetter
 import os
-import sys
-from typing import List, Dict, Tuple, Optional, Set
+from typing import List, Iterator, Optional, Tuple
 from pathlib import Path
 
 import dnaio
-import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from xopen import xopen
 
-from dbspro.utils import Summary, tqdm, IUPAC_MAP
+from dbspro.utils import Summary, tqdm, BarcodePattern, encode_variable_length
 
 logger = logging.getLogger(__name__)
 
+# Minimum number of rows aggregated at once
+BATCH_SIZE = 100_000
+
+RowType = Tuple[str, str, str, int]
+COLUMNS = ["Barcode", "Target", "UMI", "ReadCount", "Sample"]
+
 
 def add_arguments(parser):
     parser.add_argument(
         "target_files", nargs="+", type=Path,
-        help="Path to ABC-specific FASTAs with UMI sequences to combine with DBS. "
+        help="Path to ABC-specific FASTAs with UMI sequences to combine with DBS or TSVs with collapsed UMI counts."
     )
     parser.add_argument(
-        "-o", "--output", default=sys.stdout, type=Path,
-        help="Output TSV to file instead of stdout."
+        "-o", "--output", default="-",
+        help="Output TSV. Written as Parquet if ending with .parquet. Default: write to stdout"
     )
     parser.add_argument(
         "-b", "--barcode-pattern",
         help="IUPAC string with bases forming pattern to match each corrected sequence too."
     )
+    parser.add_argument(
+        "--stats", type=Path,
+        help="Write QC aggregates of the output to this JSON file."
+    )
+    parser.add_argument(
+        "--panel", action="store_true", default=False,
+        help="Input FASTAs contain reads for all targets with the target name as second last word of the header."
+    )
+    parser.add_argument(
+        "-j", "--threads", type=int, default=1,
+        help="Number of threads used for compressing output. Default: %(default)s"
+    )
 
 
 def main(args):
@@ -41,6 +82,9 @@ def main(args):
         target_files=args.target_files,
         output=args.output,
         barcode_pattern=args.barcode_pattern,
+        stats=args.stats,
+        panel=args.panel,
+        threads=args.threads,
     )
 
 
@@ -48,74 +92,241 @@ def run_analysis(
     target_files: List[str],
     output: str,
     barcode_pattern: Optional[str],
+    stats: Optional[str] = None,
+    panel: bool = False,
+    threads: int = 1,
 ):
     logger.info("Starting analysis")
     summary = Summary()
 
-    pattern = []
-    if barcode_pattern is not None:
-        pattern = [IUPAC_MAP[base] for base in barcode_pattern]
-
-    # Set names for ABCs. Creates dict with file names as keys and selected names as values.
-    target_file_to_name = {file: os.path.basename(file).split('.')[1] for file in target_files}
+    pattern = BarcodePattern(barcode_pattern) if barcode_pattern is not None else None
 
     sample_name = os.path.basename(target_files[0]).split(".")[0]
     logging.info(f"Found sample {sample_name}.")
 
-    # Counting UMI:s found in the different ABC:s for all barcodes.
-    logger.info("Calculating stats")
-    results = get_results(target_files, target_file_to_name, summary)
-
-    summary["Total DBS count"] = len(results)
-
-    df = make_dataframe(results)
-
-    # Attach sample info
-    df["Sample"] = sample_name
-
-    # Filter by barcode pattern
-    if pattern:
-        logger.info("Filtering by barcode pattern")
-        df = df[df.index.map(lambda x: match_pattern(x, pattern))]
-
-    logger.info("Sorting data")
-    df = df.sort_values(["Barcode", "Target", "UMI"])
-
-    logging.info("Writing output")
-    df.to_csv(output, sep="\t")
+    readers = []
+    for file in target_files:
+        if is_collapsed(file):
+            rows = read_collapsed_file(file)
+        elif panel:
+            rows = read_target_file(file)
+        else:
+            # Name of ABC is taken from the file name
+            rows = read_target_file(file, target=os.path.basename(file).split('.')[1])
+        readers.append(check_sorted(rows, file))
+
+    # Merge inputs sorted by barcode
+    rows = readers[0] if len(readers) == 1 else heapq.merge(*readers, key=itemgetter(0))
+
+    data_stats = DataStats(sample_name)
+    logger.info("Counting reads and writing output")
+    writer_class = ParquetWriter if str(output).endswith(".parquet") else TSVWriter
+    with writer_class(output, sample_name, threads=threads) as writer:
+        for batch in iter_batches(rows, BATCH_SIZE):
+            barcodes, targets, umis, counts = aggregate_batch(batch)
+            summary["Total target reads"] += int(counts.sum())
+            summary["Total DBS count"] += len(counts)
+
+            # Filter by barcode pattern
+            if pattern is not None:
+                barcodes, targets, umis, counts = filter_rows(barcodes, targets, umis, counts, pattern)
+
+            writer.write(barcodes, targets, umis, counts)
+            data_stats.update(barcodes, targets, counts)
+
+    if stats is not None:
+        logger.info(f"Writing QC aggregates to {stats}")
+        data_stats.write(stats)
 
     summary.print_stats(name=__name__)
 
     logger.info("Finished")
 
 
-def get_results(target_files: List[Path], target_file_to_name: Dict[Path, str],
-                summary: Dict[str, int]) -> Dict[Tuple[str, str, str], int]:
-    results = defaultdict(int)
-    for current_target in target_files:
-        logger.info(f"Reading file: {current_target}")
-
-        with dnaio.open(current_target, mode="r", fileformat="fasta") as reader:
-            # Loop over reads in file, where read.seq = umi
-            for read in tqdm(reader, desc=f"Parsing {target_file_to_name[current_target]} reads"):
-                summary["Total target reads"] += 1
-                dbs = read.name.split(" ")[-1]
-                results[(dbs, target_file_to_name[current_target], read.sequence)] += 1
-
-        logger.info(f"Finished reading file: {current_target}")
-
-    return results
-
-
-def make_dataframe(results: Dict[Tuple[str, str, str], int]) -> pd.DataFrame:
-    output = [(*dbs_target_umi, count) for dbs_target_umi, count in tqdm(results.items(), desc="Parsing results")]
-    # Create dataframe with barcode as index and columns with ABC data.
-    cols = ["Barcode", "Target", "UMI", "ReadCount"]
-    return pd.DataFrame(output, columns=cols).set_index("Barcode", drop=True)
-
-
-def match_pattern(sequence: str, pattern: List[Set[str]]) -> bool:
-    if len(sequence) != len(pattern):
-        return False
-
-    return all([base in allowed_bases for base, allowed_bases in zip(sequence, pattern)])
+def is_collapsed(file: Path) -> bool:
+    return str(file).endswith((".tsv", ".tsv.gz"))
+
+
+def read_collapsed_file(file: Path) -> Iterator[RowType]:
+    """Yield barcode, target, UMI and read count from TSV with collapsed UMI counts"""
+    logger.info(f"Reading file: {file}")
+    with xopen(str(file)) as reader:
+        header = next(reader).split()
+        if header != ["Barcode", "Target", "UMI", "ReadCount"]:
+            raise ValueError(f"Unexpected header in {file}: {' '.join(header)}")
+
+        for line in tqdm(reader, desc="Parsing UMI counts"):
+            dbs, target, umi, count = line.split("\t")
+            yield dbs, target, umi, int(count)
+
+
+def read_target_file(file: Path, target: Optional[str] = None) -> Iterator[RowType]:
+    """
+    Yield barcode, target, UMI and a read count of one for each read in FASTA. If target is not given it is taken from
+    the second last word of the header.
+    """
+    logger.info(f"Reading file: {file}")
+    with dnaio.open(file, mode="r", fileformat="fasta") as reader:
+        # Loop over reads in file, where read.seq = umi
+        for read in tqdm(reader, desc=f"Parsing {target or 'panel'} reads"):
+            if target is None:
+                read_target, dbs = read.name.split(" ")[-2:]
+                yield dbs, read_target, read.sequence, 1
+            else:
+                yield read.name.split(" ")[-1], target, read.sequence, 1
+
+
+def check_sorted(rows: Iterator[RowType], file: Path) -> Iterator[RowType]:
+    """Pass through rows and raise ValueError if the barcodes are not sorted"""
+    previous = ""
+    for row in rows:
+        if row[0] < previous:
+            raise ValueError(f"Input file {file} is not sorted by barcode, found {row[0]} after {previous}.")
+        previous = row[0]
+        yield row
+
+
+def iter_batches(rows: Iterator[RowType], batch_size: int) -> Iterator[List[RowType]]:
+    """Yield lists of rows with complete barcode groups and at least batch_size rows except for the last"""
+    batch = []
+    for _, group in groupby(rows, key=itemgetter(0)):
+        batch.extend(group)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def aggregate_batch(batch: List[RowType]) -> Tuple[List[str], List[str], List[str], np.ndarray]:
+    """
+    Sum read counts for each barcode, target and UMI combination. Columns are encoded as integers that sort in the
+    same order as the strings to aggregate and sort the rows using NumPy.
+    """
+    barcodes, targets, umis, counts = zip(*batch)
+    barcode_names, barcode_codes = np.unique(np.array(barcodes), return_inverse=True)
+    target_names, target_codes = np.unique(np.array(targets), return_inverse=True)
+    umi_names, umi_codes = np.unique(np.array(umis), return_inverse=True)
+    counts = np.array(counts, dtype=np.int64)
+
+    order = np.lexsort((umi_codes, target_codes, barcode_codes))
+    barcode_codes = barcode_codes[order]
+    target_codes = target_codes[order]
+    umi_codes = umi_codes[order]
+    starts = np.flatnonzero(np.concatenate([
+        [True],
+        (barcode_codes[1:] != barcode_codes[:-1]) | (target_codes[1:] != target_codes[:-1]) |
+        (umi_codes[1:] != umi_codes[:-1])
+    ]))
+    return (barcode_names[barcode_codes[starts]].tolist(), target_names[target_codes[starts]].tolist(),
+            umi_names[umi_codes[starts]].tolist(), np.add.reduceat(counts[order], starts))
+
+
+def filter_rows(barcodes: List[str], targets: List[str], umis: List[str], counts: np.ndarray,
+                pattern: BarcodePattern) -> Tuple[List[str], List[str], List[str], np.ndarray]:
+    """Return rows with barcodes matching pattern"""
+    keep = pattern.match(barcodes)
+    return ([barcode for barcode, ok in zip(barcodes, keep) if ok],
+            [target for target, ok in zip(targets, keep) if ok],
+            [umi for umi, ok in zip(umis, keep) if ok],
+            counts[keep])
+
+
+class DataStats:
+    """Aggregate QC statistics over the rows written"""
+    def __init__(self, sample_name: str):
+        self.sample_name = sample_name
+        self.barcodes = 0
+        self.target_reads = Counter()
+        self.target_constructs = Counter()
+        self.histogram = Counter()
+
+    def update(self, barcodes: List[str], targets: List[str], counts: np.ndarray):
+        # Batches contain complete barcode groups so barcodes are counted once.
+        self.barcodes += len(set(barcodes))
+
+        names, codes = np.unique(np.array(targets, dtype=str), return_inverse=True)
+        reads = np.bincount(codes, weights=counts, minlength=len(names)).astype(np.int64)
+        constructs = np.bincount(codes, minlength=len(names))
+        for name, nr_reads, nr_constructs in zip(names.tolist(), reads.tolist(), constructs.tolist()):
+            self.target_reads[name] += nr_reads
+            self.target_constructs[name] += nr_constructs
+
+        values, value_counts = np.unique(counts, return_counts=True)
+        self.histogram.update(dict(zip(values.tolist(), value_counts.tolist())))
+
+    def to_dict(self):
+        return {
+            "sample": self.sample_name,
+            "reads": sum(self.target_reads.values()),
+            "constructs": sum(self.target_constructs.values()),
+            "barcodes": self.barcodes,
+            "targets": {name: {"reads": self.target_reads[name], "constructs": self.target_constructs[name]}
+                        for name in sorted(self.target_reads)},
+            "read_count_histogram": sorted(self.histogram.items()),
+        }
+
+    def write(self, file: str):
+        with open(file, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+class TSVWriter:
+    """Write rows as TSV with header"""
+    def __init__(self, output: str, sample_name: str, threads: int = 1):
+        self._file = xopen(str(output), mode="w", threads=threads)
+        self._sample_name = sample_name
+        print(*COLUMNS, sep="\t", file=self._file)
+
+    def write(self, barcodes: List[str], targets: List[str], umis: List[str], counts: np.ndarray):
+        self._file.write("".join(f"{barcode}\t{target}\t{umi}\t{count}\t{self._sample_name}\n"
+                                 for barcode, target, umi, count in zip(barcodes, targets, umis, counts.tolist())))
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ParquetWriter:
+    """Write rows as Parquet with one row group per batch. UMIs are stored packed using `encode_variable_length`."""
+    def __init__(self, output: str, sample_name: str, threads: int = 1):
+        self.schema = pa.schema([
+            ("Barcode", pa.dictionary(pa.int32(), pa.string())),
+            ("Target", pa.dictionary(pa.int32(), pa.string())),
+            ("UMI", pa.uint64()),
+            ("ReadCount", pa.int64()),
+            ("Sample", pa.dictionary(pa.int32(), pa.string())),
+        ])
+        pa.set_cpu_count(threads)
+        self._writer = pq.ParquetWriter(str(output), self.schema)
+        self._sample_name = sample_name
+
+    def write(self, barcodes: List[str], targets: List[str], umis: List[str], counts: np.ndarray):
+        umi_keys, valid = encode_variable_length(umis)
+        if not valid.all():
+            invalid = umis[int(np.flatnonzero(~valid)[0])]
+            raise ValueError(f"UMI {invalid} cannot be packed for Parquet output, use TSV output instead.")
+
+        table = pa.table([
+            pa.array(barcodes, type=pa.string()).dictionary_encode(),
+            pa.array(targets, type=pa.string()).dictionary_encode(),
+            pa.array(umi_keys, type=pa.uint64()),
+            pa.array(counts, type=pa.int64()),
+            pa.DictionaryArray.from_arrays(np.zeros(len(counts), dtype=np.int32), [self._sample_name]),
+        ], schema=self.schema)
+        self._writer.write_table(table)
+
+    def close(self):
+        self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
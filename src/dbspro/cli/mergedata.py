@@ -0,0 +1,99 @@
+"""
+Merge data files from `dbspro integrate` for several samples into one file.
+
+Files are streamed one at a time and appended to the output so that memory usage does not depend on the number or
+size of the samples. TSV files are copied block-wise after checking that the headers are identical. Parquet files are
+copied one row group at a time.
+"""
+import logging
+import shutil
+from pathlib import Path
+from typing import List
+
+import pyarrow.parquet as pq
+from xopen import xopen
+
+from dbspro.utils import Summary, tqdm
+
+logger = logging.getLogger(__name__)
+
+# Size of blocks copied between TSV files
+BLOCK_SIZE = 2 ** 20
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        "data_files", nargs="+", type=Path,
+        help="Data files from `dbspro integrate`, either all TSV or all Parquet."
+    )
+    parser.add_argument(
+        "-o", "--output", type=Path, required=True,
+        help="Output file. Must have the same format as the input files."
+    )
+    parser.add_argument(
+        "-j", "--threads", type=int, default=1,
+        help="Number of threads used for compressing output. Default: %(default)s"
+    )
+
+
+def main(args):
+    run_mergedata(
+        data_files=args.data_files,
+        output=args.output,
+        threads=args.threads,
+    )
+
+
+def run_mergedata(
+    data_files: List[str],
+    output: str,
+    threads: int = 1,
+):
+    logger.info("Starting")
+    summary = Summary()
+
+    is_parquet = [str(file).endswith(".parquet") for file in data_files]
+    if any(is_parquet) != all(is_parquet) or str(output).endswith(".parquet") != any(is_parquet):
+        raise ValueError("Input and output files must either all be Parquet or all be TSV.")
+
+    logger.info(f"Merging {len(data_files)} files into {output}")
+    if all(is_parquet):
+        merge_parquet(data_files, output, summary)
+    else:
+        merge_tsv(data_files, output, summary, threads)
+
+    summary.print_stats(name=__name__)
+
+    logger.info("Finished")
+
+
+def merge_tsv(data_files: List[str], output: str, summary: Summary, threads: int = 1):
+    """Concatenate TSV files keeping the header of the first file"""
+    header = None
+    with xopen(str(output), mode="wb", threads=threads) as writer:
+        for file in tqdm(data_files, desc="Merging files"):
+            with xopen(str(file), mode="rb") as reader:
+                file_header = reader.readline()
+                if header is None:
+                    header = file_header
+                    writer.write(header)
+                elif file_header != header:
+                    raise ValueError(f"Header of {file} differs from that of {data_files[0]}.")
+
+                shutil.copyfileobj(reader, writer, BLOCK_SIZE)
+            summary["Files merged"] += 1
+
+
+def merge_parquet(data_files: List[str], output: str, summary: Summary):
+    """Copy row groups from Parquet files with identical schemas"""
+    schema = pq.read_schema(str(data_files[0]))
+    with pq.ParquetWriter(str(output), schema) as writer:
+        for file in tqdm(data_files, desc="Merging files"):
+            reader = pq.ParquetFile(str(file))
+            if not reader.schema_arrow.equals(schema):
+                raise ValueError(f"Schema of {file} differs from that of {data_files[0]}.")
+
+            for i in range(reader.num_row_groups):
+                writer.write_table(reader.read_row_group(i))
+            summary["Files merged"] += 1
+            summary["Rows total"] += reader.metadata.num_rows
@@ -0,0 +1,202 @@
+"""
+Estimate library complexity as the expected number of distinct constructs at increasing sequencing depths.
+
+Replaces `preseq lc_extrap` and writes output in the same format for MultiQC. Input is the histogram of read counts
+per construct, taken from the JSON written by `dbspro integrate --stats`, a data file from `dbspro integrate` or a
+text file with read count and number of constructs per line as used by `preseq -H`.
+
+Up to the observed number of reads, the expected number of distinct constructs is computed exactly by rarefaction
+using the hypergeometric probability that a construct is not sampled. Beyond that the curve is extrapolated using
+the estimator of Chao et al. (2014, Ecological Monographs 84:45-67), which converges to the Chao1 estimate of the
+total number of constructs. Confidence intervals are percentiles over curves computed for bootstrap replicates of
+the histogram.
+"""
+import json
+import logging
+from pathlib import Path
+from typing import Tuple
+
+import numpy as np
+from xopen import xopen
+
+from dbspro.utils import Summary
+
+logger = logging.getLogger(__name__)
+
+# Terms smaller than exp(-MAX_EXPONENT) are neglected in rarefaction.
+MAX_EXPONENT = 50
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        "input", type=Path,
+        help="Histogram of read counts per construct, either as JSON from `dbspro integrate --stats`, a data file "
+             "from `dbspro integrate` (.tsv.gz/.parquet) or a text file with read count and number of constructs."
+    )
+    parser.add_argument(
+        "-o", "--output", default="-",
+        help="Output file in preseq lc_extrap format. Default: write to stdout"
+    )
+    parser.add_argument(
+        "-e", "--extrapolate", type=float, default=1e10,
+        help="Maximum number of reads to extrapolate to. Default: %(default)s"
+    )
+    parser.add_argument(
+        "-s", "--step", type=float, default=1e6,
+        help="Step size in number of reads between estimates. Default: %(default)s"
+    )
+    parser.add_argument(
+        "-b", "--bootstraps", type=int, default=100,
+        help="Number of bootstrap replicates for confidence intervals. Default: %(default)s"
+    )
+    parser.add_argument(
+        "--seed", type=int, default=1,
+        help="Seed for random generator used in bootstraps. Default: %(default)s"
+    )
+
+
+def main(args):
+    run_saturation(
+        input=args.input,
+        output=args.output,
+        extrapolate=args.extrapolate,
+        step=args.step,
+        bootstraps=args.bootstraps,
+        seed=args.seed,
+    )
+
+
+def run_saturation(
+    input: str,
+    output: str,
+    extrapolate: float = 1e10,
+    step: float = 1e6,
+    bootstraps: int = 100,
+    seed: int = 1,
+):
+    logger.info("Starting")
+    logger.info(f"Processing file: {input}")
+
+    if step <= 0:
+        raise ValueError("Step size must be positive.")
+
+    summary = Summary()
+    read_counts, nr_constructs = read_histogram(input)
+    summary["Reads total"] = int(np.dot(read_counts, nr_constructs))
+    summary["Constructs total"] = int(nr_constructs.sum())
+    summary["Singleton constructs"] = int(nr_constructs[read_counts == 1].sum())
+
+    depths = np.arange(0, extrapolate + step / 2, step)
+    logger.info(f"Computing expected distinct constructs at {len(depths):,} depths")
+    expected = expected_distinct(read_counts, nr_constructs, depths)
+    summary["Estimated total constructs"] = int(round(chao1(read_counts, nr_constructs)))
+
+    logger.info(f"Computing confidence intervals from {bootstraps} bootstrap replicates")
+    rng = np.random.default_rng(seed)
+    if bootstraps > 0 and nr_constructs.sum() > 0:
+        total = int(nr_constructs.sum())
+        replicates = np.array([
+            expected_distinct(read_counts, rng.multinomial(total, nr_constructs / total), depths)
+            for _ in range(bootstraps)
+        ])
+        lower, upper = np.percentile(replicates, [2.5, 97.5], axis=0)
+        # Percentile intervals can exclude the estimate for skewed bootstrap distributions
+        lower = np.minimum(lower, expected)
+        upper = np.maximum(upper, expected)
+    else:
+        lower = upper = expected
+
+    logger.info(f"Writing output to {output}")
+    with xopen(str(output), mode="w") as writer:
+        print("TOTAL_READS", "EXPECTED_DISTINCT", "LOWER_0.95CI", "UPPER_0.95CI", sep="\t", file=writer)
+        for row in zip(depths.tolist(), expected.tolist(), lower.tolist(), upper.tolist()):
+            print(*(f"{value:.1f}" for value in row), sep="\t", file=writer)
+
+    summary.print_stats(name=__name__)
+
+    logger.info("Finished")
+
+
+def read_histogram(file: Path) -> Tuple[np.ndarray, np.ndarray]:
+    """Return arrays with read counts and the number of constructs having each read count"""
+    if str(file).endswith(".json"):
+        with open(file) as f:
+            histogram = json.load(f)["read_count_histogram"]
+        pairs = np.array(histogram, dtype=np.int64).reshape(-1, 2)
+        read_counts, nr_constructs = pairs[:, 0], pairs[:, 1]
+    elif str(file).endswith((".parquet", ".tsv", ".tsv.gz")):
+        from dbspro.notebook import load_data
+        read_counts, nr_constructs = np.unique(load_data(file, columns=["ReadCount"])["ReadCount"].to_numpy(),
+                                               return_counts=True)
+    else:
+        pairs = np.loadtxt(file, dtype=np.int64, ndmin=2)
+        read_counts, nr_constructs = pairs[:, 0], pairs[:, 1]
+
+    keep = (read_counts > 0) & (nr_constructs > 0)
+    read_counts = read_counts[keep]
+    nr_constructs = nr_constructs[keep]
+    order = np.argsort(read_counts)
+    return read_counts[order], nr_constructs[order]
+
+
+def expected_distinct(read_counts: np.ndarray, nr_constructs: np.ndarray, depths: np.ndarray) -> np.ndarray:
+    """
+    Return the expected number of distinct constructs when sampling the given number of reads. Depths up to the
+    number of observed reads are interpolated by rarefaction and larger depths are extrapolated.
+    """
+    nr_reads = int(np.dot(read_counts, nr_constructs))
+    observed = float(nr_constructs.sum())
+    expected = np.empty(len(depths), dtype=float)
+
+    within = depths <= nr_reads
+    for i in np.flatnonzero(within):
+        expected[i] = observed - np.dot(nr_constructs, prob_unsampled(read_counts, nr_reads, depths[i]))
+
+    if (~within).any():
+        f0 = chao1(read_counts, nr_constructs) - observed
+        f1 = float(nr_constructs[read_counts == 1].sum())
+        if f0 <= 0 or f1 == 0:
+            expected[~within] = observed
+        else:
+            extra = depths[~within] - nr_reads
+            expected[~within] = observed + f0 * -np.expm1(extra * np.log1p(-f1 / (nr_reads * f0 + f1)))
+
+    return expected
+
+
+def prob_unsampled(read_counts: np.ndarray, nr_reads: int, depth: float) -> np.ndarray:
+    """
+    Return the probability that a construct with the given read count is not included when sampling depth of the
+    nr_reads reads without replacement, i.e. C(nr_reads - read_count, depth) / C(nr_reads, depth).
+    """
+    if depth == 0:
+        return np.ones(len(read_counts))
+    if depth >= nr_reads:
+        return np.zeros(len(read_counts))
+
+    # The log-probability is a sum of one term per read of the construct. Terms beyond the point where the
+    # probability is negligible are not computed. The term is log(0) for constructs with more than nr_reads - depth
+    # reads, which are always sampled.
+    max_count = int(min(read_counts[-1], nr_reads - depth + 1, np.ceil(MAX_EXPONENT * nr_reads / depth) + 1))
+    with np.errstate(divide="ignore"):
+        log_terms = np.log1p(-depth / (nr_reads - np.arange(max_count, dtype=float)))
+    log_prob = np.concatenate([[0.0], np.cumsum(log_terms)])
+    counts = np.minimum(read_counts, max_count)
+    prob = np.exp(log_prob[counts])
+    prob[read_counts > max_count] = 0
+    return prob
+
+
+def chao1(read_counts: np.ndarray, nr_constructs: np.ndarray) -> float:
+    """Return the bias-corrected Chao1 estimate of the total number of constructs"""
+    nr_reads = int(np.dot(read_counts, nr_constructs))
+    observed = float(nr_constructs.sum())
+    if nr_reads == 0:
+        return observed
+
+    f1 = float(nr_constructs[read_counts == 1].sum())
+    f2 = float(nr_constructs[read_counts == 2].sum())
+    correction = (nr_reads - 1) / nr_reads
+    if f2 > 0:
+        return observed + correction * f1 ** 2 / (2 * f2)
+    return observed + correction * f1 * (f1 - 1) / 2
@@ -1,24 +1,37 @@
 """
-Split ABC FASTQ with UMIs based on DBS cluster and cluster UMIs for each partion using UMI-tools.
+Split ABC FASTA with UMIs based on DBS cluster and cluster UMIs for each partion using UMI-tools.
+
+With --panel, the input contains reads for all targets of a sample, as written by `dbspro demultiplex` when the output
+path lacks '{name}', with the target as the second last word of the header. UMIs are then clustered separately for
+each DBS and target combination, so a single process handles the whole antibody panel. Adding --collapsed writes a TSV
+with one row per DBS, target and corrected UMI and its read count instead of one record per read, which is the input
+format used by `dbspro integrate`.
+
+By default, UMIs are clustered with a built-in implementation of the UMI-tools methods that gives the same clusters.
+UMIs are 2-bit packed into integers and Hamming distances computed with XOR and popcount over NumPy arrays, using a
+precomputed table of neighbor masks for large groups. Use `--implementation umi_tools` to run UMI-tools instead.
 """
-from collections import defaultdict
+from collections import Counter, OrderedDict, defaultdict
+from itertools import combinations, product
 import logging
 from pathlib import Path
-from typing import Dict, List, Iterator
+from typing import Dict, List, Iterator, Iterable, Optional, Tuple
 
-import dnaio
 from dnaio import Sequence
+import numpy as np
 from umi_tools import UMIClusterer
+from xopen import xopen
 
-from dbspro.utils import Summary, tqdm
+from dbspro.utils import Summary, tqdm, read_chunks, parse_chunk, format_records, parallel_map, pack_codes, \
+    BASE_TO_CODE, MAX_PACKED_LENGTH
 
 logger = logging.getLogger(__name__)
 
 
 def add_arguments(parser):
     parser.add_argument(
-        "uncorrected_umi_fastq", type=Path,
-        help="Input FASTQ for demultiplexed ABC with uncorrected UMI sequences and corrected DBS sequence in header."
+        "uncorrected_umi_fasta", type=Path,
+        help="Input FASTA for demultiplexed ABC with uncorrected UMI sequences and corrected DBS sequence in header."
     )
     parser.add_argument(
         "-o", "--output-fasta", default="-", type=Path,
@@ -37,15 +50,44 @@ def add_arguments(parser):
         choices=["unique", "percentile", "cluster", "adjacency", "directional"],
         help="Select UMItools clustering method. Defaulf: %(default)s"
     )
+    parser.add_argument(
+        "--implementation", choices=["dbspro", "umi_tools"], default="dbspro",
+        help="Implementation of the clustering methods. 'dbspro' uses packed UMIs and gives the same clusters as "
+             "'umi_tools'. Default: %(default)s"
+    )
+    parser.add_argument(
+        "--cache-size", type=int, default=100_000,
+        help="Maximum number of clustering results for groups of UMIs and counts to cache for reuse. Set to 0 to "
+             "disable caching. Default: %(default)s"
+    )
+    parser.add_argument(
+        "--panel", action="store_true", default=False,
+        help="Input contains reads for all targets with the target name as second last word of the header. UMIs are "
+             "clustered separately for each target."
+    )
+    parser.add_argument(
+        "--collapsed", action="store_true", default=False,
+        help="Write TSV with columns Barcode, Target, UMI and ReadCount for each corrected UMI instead of FASTA with "
+             "each read. Requires --panel."
+    )
+    parser.add_argument(
+        "-j", "--threads", type=int, default=1,
+        help="Number of worker processes. Default: %(default)s"
+    )
 
 
 def main(args):
     run_splitcluster(
-        uncorrected_umis=args.uncorrected_umi_fastq,
+        uncorrected_umis=args.uncorrected_umi_fasta,
         output_fasta=args.output_fasta,
         dist_threshold=args.threshold,
         required_length=args.length,
         clustering_method=args.method,
+        implementation=args.implementation,
+        cache_size=args.cache_size,
+        panel=args.panel,
+        collapsed=args.collapsed,
+        threads=args.threads,
     )
 
 
@@ -55,50 +97,393 @@ def run_splitcluster(
     dist_threshold: int,
     required_length: int,
     clustering_method: str,
+    implementation: str = "dbspro",
+    cache_size: int = 100_000,
+    panel: bool = False,
+    collapsed: bool = False,
+    threads: int = 1,
 ):
+    if collapsed and not panel:
+        raise ValueError("Collapsed output requires --panel as the target is taken from the read names.")
+
     logger.info(f"Filtering reads not of length {required_length} bp.")
     summary = Summary()
 
     logger.info(f"Starting clustering of UMIs within each DBS clusters using method: {clustering_method}")
     logger.info(f"Writing corrected reads to {output_fasta}")
 
+    # Input is sorted by DBS so chunks are split between DBS groups to allow them to be processed independently.
+    with xopen(str(output_fasta), mode="wb", threads=threads) as writer:
+        if collapsed:
+            writer.write(b"Barcode\tTarget\tUMI\tReadCount\n")
+        chunks = group_chunks(read_chunks(uncorrected_umis, threads=threads))
+        process_chunk = _collapse_chunk if collapsed else _cluster_chunk
+        results = parallel_map(process_chunk, chunks, threads=threads, initializer=_init_worker,
+                               initargs=(clustering_method, dist_threshold, implementation, cache_size, panel))
+        for corrected_chunk, chunk_summary in tqdm(results, desc="Parsing chunks"):
+            writer.write(corrected_chunk)
+            summary.update(chunk_summary)
+
+    if summary["Cache hits"] + summary["Cache misses"] > 0:
+        summary["Cache hit rate"] = summary["Cache hits"] / (summary["Cache hits"] + summary["Cache misses"])
+
+    summary.print_stats(name=__name__)
+
+
+_clusterer = None
+_threshold = None
+_cache = None
+_panel = False
+
+
+def _init_worker(clustering_method: str, threshold: int, implementation: str = "dbspro", cache_size: int = 0,
+                 panel: bool = False):
+    global _clusterer, _threshold, _cache, _panel
     # Set clustering method
     # Based on https://umi-tools.readthedocs.io/en/latest/API.html
-    clusterer = UMIClusterer(cluster_method=clustering_method)
-
-    with dnaio.open(uncorrected_umis, mode="r") as reader, \
-            dnaio.open(output_fasta, fileformat="fasta", mode="w") as writer:
-
-        dbs_umis = defaultdict(list)
-        dbs_current = None
-        for read in tqdm(reader, desc="Parsing reads"):
-            # Get DBS sequence
-            dbs = read.name.split(" ")[-1]
-            # If new DBS sequence, cluster UMIs and write to output
-            if dbs != dbs_current:
-                if dbs_current:
-                    for read in correct_umis(dbs_umis, clusterer, dist_threshold, summary):
-                        writer.write(read)
-                dbs_current = dbs
-                dbs_umis = defaultdict(list)
-
-            dbs_umis[read.sequence].append(read.name)
+    if implementation == "umi_tools":
+        _clusterer = UMIClusterer(cluster_method=clustering_method)
+    else:
+        _clusterer = PackedUMIClusterer(cluster_method=clustering_method)
+    _threshold = threshold
+    _cache = ClusterCache(clustering_method, cache_size) if cache_size > 0 else None
+    _panel = panel
 
-    summary.print_stats(name=__name__)
+
+def _cluster_chunk(chunk: bytes) -> Tuple[bytes, Summary]:
+    summary = Summary()
+    corrected = []
+    dbs_reads = []
+    dbs_current = None
+    for read in parse_chunk(chunk):
+        # Get DBS sequence
+        dbs = read.name.split(" ")[-1]
+        # If new DBS sequence, cluster UMIs
+        if dbs != dbs_current:
+            if dbs_current:
+                corrected.extend(correct_reads(dbs_reads, _clusterer, _threshold, summary, _panel, _cache))
+            dbs_current = dbs
+            dbs_reads = []
+
+        dbs_reads.append(read)
+
+    if dbs_current:
+        corrected.extend(correct_reads(dbs_reads, _clusterer, _threshold, summary, _panel, _cache))
+
+    return format_records(corrected), summary
+
+
+def _collapse_chunk(chunk: bytes) -> Tuple[bytes, Summary]:
+    summary = Summary()
+    rows = []
+    target_umi_counts = defaultdict(Counter)
+    dbs_current = None
+    for read in parse_chunk(chunk):
+        target, dbs = read.name.split(" ")[-2:]
+        # If new DBS sequence, cluster UMIs
+        if dbs != dbs_current:
+            if dbs_current:
+                rows.extend(collapse_umis(dbs_current, target_umi_counts, _clusterer, _threshold, summary, _cache))
+            dbs_current = dbs
+            target_umi_counts = defaultdict(Counter)
+
+        target_umi_counts[target][read.sequence] += 1
+
+    if dbs_current:
+        rows.extend(collapse_umis(dbs_current, target_umi_counts, _clusterer, _threshold, summary, _cache))
+
+    return "".join(rows).encode(), summary
+
+
+def group_chunks(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """Join chunks of FASTA records so that records with the same DBS (last word of header) are in the same chunk"""
+    remainder = b""
+    for chunk in chunks:
+        if not remainder and chunk.startswith(b"@"):
+            raise ValueError("Input must be FASTA, FASTQ is not supported.")
+        chunk = remainder + chunk
+        split = _last_group_start(chunk)
+        remainder = chunk[split:]
+        if split > 0:
+            yield chunk[:split]
+
+    if remainder:
+        yield remainder
+
+
+def _last_group_start(chunk: bytes) -> int:
+    """Return start position of the records sharing DBS with the last record in the chunk"""
+    start = chunk.rfind(b"\n>") + 1
+    dbs = _header_dbs(chunk, start)
+    while start > 0:
+        previous = chunk.rfind(b"\n>", 0, start - 1) + 1
+        if _header_dbs(chunk, previous) != dbs:
+            return start
+        start = previous
+    return 0
 
 
-AliasType = Dict[str, List[str]]
+def _header_dbs(chunk: bytes, start: int) -> bytes:
+    return chunk[start:chunk.index(b"\n", start)].rsplit(b" ", 1)[-1]
 
 
-def correct_umis(umis: AliasType, clusterer: UMIClusterer, threshold: int, summary: Summary) -> Iterator[Sequence]:
-    umi_counts = {bytes(umi, encoding='utf-8'): len(reads) for umi, reads in umis.items()}
+def correct_reads(reads: List[Sequence], clusterer, threshold: int, summary: Summary, panel: bool = False,
+                  cache: Optional["ClusterCache"] = None) -> Iterator[Sequence]:
+    """
+    Cluster UMIs of reads sharing DBS and return reads with corrected UMIs in input order. If panel is True, UMIs are
+    clustered separately for each target given by the second last word of the read name.
+    """
+    targets = [read.name.split(" ")[-2] if panel else None for read in reads]
+    target_umi_counts = defaultdict(Counter)
+    for target, read in zip(targets, reads):
+        target_umi_counts[target][read.sequence] += 1
+
+    canonical = {target: correct_umis(umi_counts, clusterer, threshold, summary, cache)
+                 for target, umi_counts in target_umi_counts.items()}
+    for target, read in zip(targets, reads):
+        # UMIs not in any cluster are discarded by the percentile method
+        if read.sequence in canonical[target]:
+            yield Sequence(read.name, canonical[target][read.sequence])
+
+
+def collapse_umis(dbs: str, target_umi_counts: Dict[str, Dict[str, int]], clusterer, threshold: int,
+                  summary: Summary, cache: Optional["ClusterCache"] = None) -> Iterator[str]:
+    """Cluster UMIs for each target of DBS and return TSV rows with the read count for each corrected UMI"""
+    for target in sorted(target_umi_counts):
+        umi_counts = target_umi_counts[target]
+        canonical = correct_umis(umi_counts, clusterer, threshold, summary, cache)
+        corrected_counts = Counter()
+        for umi, count in umi_counts.items():
+            # UMIs not in any cluster are discarded by the percentile method
+            if umi in canonical:
+                corrected_counts[canonical[umi]] += count
+
+        for umi in sorted(corrected_counts):
+            yield f"{dbs}\t{target}\t{umi}\t{corrected_counts[umi]}\n"
+
+
+def correct_umis(umi_counts: Dict[str, int], clusterer, threshold: int, summary: Summary,
+                 cache: Optional["ClusterCache"] = None) -> Dict[str, str]:
+    """
+    Return mapping from each UMI to the canonical UMI of its cluster. UMIs are passed to the clusterer in sorted order
+    and the canonical UMI is the one with the highest count, ties broken by sort order, so the result does not depend
+    on hash seed or input order. Results are reused from the cache for groups with the same UMIs and counts.
+    """
     summary["Total UMIs"] += len(umi_counts)
+    # A single UMI always forms its own cluster
+    if len(umi_counts) == 1:
+        summary["Singleton UMI groups"] += 1
+        summary["Total clustered UMIs"] += 1
+        umi = next(iter(umi_counts))
+        return {umi: umi}
+
+    items = tuple(sorted(umi_counts.items()))
+    if cache is not None:
+        cached = cache.get(items, threshold)
+        if cached is not None:
+            summary["Cache hits"] += 1
+            summary["Total clustered UMIs"] += cached[1]
+            return cached[0]
+        summary["Cache misses"] += 1
 
+    umi_counts = {bytes(umi, encoding="utf-8"): count for umi, count in items}
+    canonical = {}
+    nr_clusters = 0
     for cluster in clusterer(umi_counts, threshold=threshold):
-        summary["Total clustered UMIs"] += 1
-        seqs = [seq.decode("utf-8") for seq in cluster]
-        canonical_sequnce = seqs[0]
+        nr_clusters += 1
+        canonical_sequence = min(cluster, key=lambda umi: (-umi_counts[umi], umi)).decode("utf-8")
+        for umi in cluster:
+            canonical[umi.decode("utf-8")] = canonical_sequence
+
+    summary["Total clustered UMIs"] += nr_clusters
+    if cache is not None:
+        cache.put(items, threshold, (canonical, nr_clusters))
+    return canonical
+
+
+class ClusterCache:
+    """
+    Least recently used cache of clustering results keyed on the UMIs with their counts, the threshold and the
+    clustering method. Holds at most max_size entries.
+    """
+    def __init__(self, cluster_method: str, max_size: int):
+        self.cluster_method = cluster_method
+        self.max_size = max_size
+        self._entries = OrderedDict()
+
+    def get(self, items: Tuple[Tuple[str, int], ...], threshold: int):
+        key = (self.cluster_method, threshold, items)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(self, items: Tuple[Tuple[str, int], ...], threshold: int, entry):
+        self._entries[(self.cluster_method, threshold, items)] = entry
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+
+# Masks for 2-bit packed integers selecting the lowest bit of each base and for computing popcount
+_LOW_BITS = np.uint64(0x5555555555555555)
+_PAIR_BITS = np.uint64(0x3333333333333333)
+_NIBBLE_BITS = np.uint64(0x0F0F0F0F0F0F0F0F)
+_BYTE_SUM = np.uint64(0x0101010101010101)
+
+
+def hamming_distances(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Return Hamming distances between 2-bit packed sequences of equal length"""
+    diff = a ^ b
+    # Set the lowest bit of each base that differs and count these bits
+    diff = (diff | (diff >> np.uint64(1))) & _LOW_BITS
+    diff = (diff & _PAIR_BITS) + ((diff >> np.uint64(2)) & _PAIR_BITS)
+    diff = (diff + (diff >> np.uint64(4))) & _NIBBLE_BITS
+    return (diff * _BYTE_SUM) >> np.uint64(56)
+
+
+def neighbor_masks(length: int, max_distance: int) -> np.ndarray:
+    """Return XOR masks changing between 1 and max_distance bases of a 2-bit packed sequence"""
+    masks = []
+    for distance in range(1, max_distance + 1):
+        for positions in combinations(range(length), distance):
+            for changes in product((1, 2, 3), repeat=distance):
+                masks.append(sum(change << (2 * position) for position, change in zip(positions, changes)))
+    return np.array(masks, dtype=np.uint64)
+
+
+class PackedUMIClusterer:
+    """
+    Drop-in replacement for UMI-tools `UMIClusterer` giving the same clusters for UMIs of equal length. UMIs are
+    2-bit packed into integers and neighbors within the Hamming distance threshold are found by comparing all pairs
+    using XOR and popcount or, for groups larger than the number of possible neighbors, by looking up all neighbors
+    generated from a table of XOR masks. UMIs that cannot be packed are clustered with UMI-tools.
+    """
+    def __init__(self, cluster_method: str = "directional"):
+        self.cluster_method = cluster_method
+        self._umi_tools = UMIClusterer(cluster_method=cluster_method)
+        self._masks: Dict[Tuple[int, int], np.ndarray] = {}
+
+    def __call__(self, umis: Dict[bytes, int], threshold: int) -> List[List[bytes]]:
+        """Return list of clusters for UMIs given as dict with read counts. The first UMI in cluster is the parent"""
+        sequences = list(umis)
+        counts = np.fromiter(umis.values(), dtype=np.int64, count=len(umis))
+        if self.cluster_method == "unique":
+            return [sequences] if len(sequences) == 1 else [[umi] for umi in sequences]
+
+        if self.cluster_method == "percentile":
+            if len(sequences) == 1:
+                return [sequences]
+            # Keep UMIs with counts above 1% of the median count
+            return [[umi] for umi, keep in zip(sequences, counts > np.median(counts) / 100) if keep]
+
+        length = len(sequences[0])
+        raw = np.frombuffer(b"".join(sequences), dtype=np.uint8)
+        if length > MAX_PACKED_LENGTH or len(raw) != length * len(sequences):
+            return self._umi_tools(umis, threshold)
+
+        codes = BASE_TO_CODE[raw.reshape(len(sequences), length)]
+        if (codes == 255).any():
+            return self._umi_tools(umis, threshold)
+
+        keys = pack_codes(codes)
+        sources, targets = self._find_edges(keys, length, threshold)
+        if self.cluster_method == "directional":
+            # Connect UMI to neighbor if its count is at least twice that of the neighbor minus one
+            keep = counts[sources] >= 2 * counts[targets] - 1
+            sources = sources[keep]
+            targets = targets[keep]
+
+        adjacency = [[] for _ in sequences]
+        for source, target in zip(sources.tolist(), targets.tolist()):
+            adjacency[source].append(target)
+
+        counts = counts.tolist()
+        components = self._connected_components(keys, counts, adjacency)
+        if self.cluster_method == "directional":
+            groups = self._group_directional(components, counts)
+        elif self.cluster_method == "adjacency":
+            groups = self._group_adjacency(components, counts, adjacency)
+        else:
+            groups = [sorted(component, key=lambda i: -counts[i]) for component in components]
+
+        return [[sequences[i] for i in group] for group in groups]
+
+    def _find_edges(self, keys: np.ndarray, length: int, threshold: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Return indices of all ordered pairs of UMIs within the Hamming distance threshold"""
+        if (length, threshold) not in self._masks:
+            self._masks[(length, threshold)] = neighbor_masks(length, threshold)
+        masks = self._masks[(length, threshold)]
+
+        if len(keys) <= len(masks):
+            within = hamming_distances(keys[:, None], keys[None, :]) <= np.uint64(threshold)
+            np.fill_diagonal(within, False)
+            return np.nonzero(within)
+
+        order = np.argsort(keys)
+        sorted_keys = keys[order]
+        neighbors = keys[:, None] ^ masks[None, :]
+        positions = np.minimum(np.searchsorted(sorted_keys, neighbors), len(keys) - 1)
+        sources, columns = np.nonzero(sorted_keys[positions] == neighbors)
+        return sources, order[positions[sources, columns]]
+
+    @staticmethod
+    def _connected_components(keys: np.ndarray, counts: List[int], adjacency: List[List[int]]) -> List[List[int]]:
+        """
+        Return UMIs reachable from each UMI in order of decreasing count, skipping UMIs already reached. UMIs within a
+        component are sorted by sequence.
+        """
+        keys = keys.tolist()
+        found = set()
+        components = []
+        for node in sorted(range(len(counts)), key=lambda i: -counts[i]):
+            if node in found:
+                continue
+            component = {node}
+            queue = [node]
+            while queue:
+                for neighbor in adjacency[queue.pop()]:
+                    if neighbor not in component:
+                        component.add(neighbor)
+                        queue.append(neighbor)
+            found.update(component)
+            components.append(sorted(component, key=keys.__getitem__))
+        return components
+
+    @staticmethod
+    def _group_directional(components: List[List[int]], counts: List[int]) -> List[List[int]]:
+        """Return components sorted by count excluding UMIs already part of a previous group"""
+        observed = set()
+        groups = []
+        for component in components:
+            group = [node for node in sorted(component, key=lambda i: -counts[i]) if node not in observed]
+            observed.update(group)
+            groups.append(group)
+        return groups
+
+    @staticmethod
+    def _group_adjacency(components: List[List[int]], counts: List[int],
+                         adjacency: List[List[int]]) -> List[List[int]]:
+        """
+        Return a group for each of the fewest UMIs with the highest counts that, together with their neighbors,
+        account for all UMIs in the component. Neighbors are assigned to the first of these UMIs they are connected to.
+        """
+        groups = []
+        for component in components:
+            if len(component) == 1:
+                groups.append(component)
+                continue
+
+            leads = []
+            covered = set()
+            for node in sorted(component, key=lambda i: -counts[i]):
+                leads.append(node)
+                covered.add(node)
+                covered.update(adjacency[node])
+                if len(covered) == len(component):
+                    break
 
-        for seq in seqs:
-            for read_name in umis[seq]:
-                yield Sequence(read_name, canonical_sequnce)
+            observed = set(leads)
+            for lead in leads:
+                groups.append([lead] + sorted(set(adjacency[lead]) - observed))
+                observed.update(adjacency[lead])
+        return groups
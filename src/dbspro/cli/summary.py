@@ -227,6 +227,10 @@ def parse_cutadapt(path, summary, sample=None):
                 if "bp" in line:
                     continue
 
+                # Skip subsection headers such as '== Read fate breakdown =='
+                if ":" not in line:
+                    continue
+
                 # Collect parameter and value
                 parameter, value = line.strip().split(":", maxsplit=1)
                 value = value.strip().replace(",", "")
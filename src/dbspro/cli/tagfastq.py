@@ -1,18 +1,38 @@
 """
 Tag FASTQ/FASTA with sequence from matching read by name
+
+If corrections from DBS clustering are given, the annotation sequences are corrected as in `dbspro correctfastq`
+before tagging so that no corrected intermediate file is needed.
+
+With --positional, records in the input and annotation files are paired by position, e.g. for positional output
+from `dbspro extract`. Empty records are skipped and tagged records are named by the annotation sequence only.
 """
+from collections import OrderedDict
 from contextlib import ExitStack
-from itertools import islice
+import heapq
+from itertools import islice, zip_longest
 import logging
-
+import os
 from pathlib import Path
+import sqlite3
+from tempfile import TemporaryDirectory
+from typing import Iterable, Iterator, List, Optional, Tuple
 
 import dnaio
+from xopen import xopen
 
-from dbspro.utils import Summary, tqdm
+from dbspro.cli.correctfastq import CorrectionTable, get_corrections, correct_records
+from dbspro.utils import Summary, tqdm, parallel_map
 
 logger = logging.getLogger(__name__)
 
+# Maximum number of sorted runs opened at once when merging. More runs are first merged in several passes.
+MAX_OPEN_RUNS = 64
+# After more than SLIDE_AFTER misses in a row, a full annotation buffer slides forward by SLIDE_STEP records for each
+# further miss in the row.
+SLIDE_AFTER = 8
+SLIDE_STEP = 16
+
 
 def add_arguments(parser):
     parser.add_argument(
@@ -27,14 +47,50 @@ def add_arguments(parser):
         "-o", "--output-fasta", type=Path, default="-",
         help="Output FASTA with corrected sequences."
     )
+    parser.add_argument(
+        "-c", "--corrections", type=Path,
+        help="Correct annotation sequences using starcode output or clusters from `dbspro clusterdbs` (.npy). "
+             "Annotations without correction are skipped."
+    )
     parser.add_argument(
         "-s", "--separator", default="_",
         help="Separetor used to connect annotation string to read name."
     )
+    parser.add_argument(
+        "--positional", action="store_true", default=False,
+        help="Pair input and annotation records by position instead of by read name."
+    )
     parser.add_argument(
         "-b", "--buffer-size", type=int, default=64,
         help="Buffer size for annotation file."
     )
+    parser.add_argument(
+        "--max-buffer-size", type=int, default=1_000_000,
+        help="Maximum number of annotation records kept in memory. Older records are spilled to disk. Default: "
+             "%(default)s"
+    )
+    parser.add_argument(
+        "--max-spill-size", type=int, default=10_000_000,
+        help="Maximum number of annotation records kept in the spill on disk. The oldest records are discarded when "
+             "the spill is full. Default: %(default)s"
+    )
+    parser.add_argument(
+        "--sort-by-barcode", action="store_true", default=False,
+        help="Sort output records by annotation sequence and then by name."
+    )
+    parser.add_argument(
+        "--max-memory", type=int, default=1024,
+        help="Approximate memory in MB used for sorting records before writing sorted runs to disk. Default: "
+             "%(default)s"
+    )
+    parser.add_argument(
+        "--tmpdir",
+        help="Directory for spilled records and sorted runs. Default: system default"
+    )
+    parser.add_argument(
+        "-j", "--threads", type=int, default=1,
+        help="Number of threads used for compression and decompression. Default: %(default)s"
+    )
 
 
 def main(args):
@@ -42,8 +98,16 @@ def main(args):
         input=args.input,
         annot=args.annot,
         output=args.output_fasta,
+        corrections=args.corrections,
+        positional=args.positional,
         separator=args.separator,
         buffer_size=args.buffer_size,
+        max_buffer_size=args.max_buffer_size,
+        max_spill_size=args.max_spill_size,
+        sort_by_barcode=args.sort_by_barcode,
+        max_memory=args.max_memory,
+        tmpdir=args.tmpdir,
+        threads=args.threads,
     )
 
 
@@ -53,12 +117,21 @@ def run_tagfastq(
     output: str,
     separator: str,
     buffer_size: int,
+    corrections: str = None,
+    positional: bool = False,
+    max_buffer_size: int = 1_000_000,
+    max_spill_size: int = 10_000_000,
+    sort_by_barcode: bool = False,
+    max_memory: int = 1024,
+    tmpdir: str = None,
+    threads: int = 1,
 ):
     logger.info("Starting")
     logger.info(f"Processing file: {input}")
     logger.info(f"Annotating with file: {annot}")
 
     summary = Summary()
+    correction_summary = Summary()
 
     logger.info("Annotating sequences and writing to output file.")
     input_format = determine_filetype(input)
@@ -67,68 +140,292 @@ def run_tagfastq(
     logger.info(f"Output file format: {output_format}")
 
     with ExitStack() as stack:
-        reader = stack.enter_context(dnaio.open(input, mode="r", fileformat=input_format))
-        writer = stack.enter_context(dnaio.open(output, mode="w", fileformat=output_format))
-        annotator = stack.enter_context(BufferedFASTAReader(annot, buffer_size=buffer_size))
-
-        for read in tqdm(reader, desc="Parsing reads"):
-            summary["Reads total"] += 1
-            sequence = annotator.get(read.id)
-            if sequence:
-                read.name = f"{read.id}{separator}{sequence}"
-                summary["Reads annotated"] += 1
+        tmp = stack.enter_context(TemporaryDirectory(dir=tmpdir))
+        table = None
+        if corrections is not None:
+            logger.info(f"Correcting annotations using: {corrections}")
+            table = get_corrections(corrections, correction_summary, Path(tmp) / "corrections.npy")
+
+        reader = stack.enter_context(dnaio.open(input, mode="r", fileformat=input_format, open_threads=threads))
+        if positional:
+            annotator = None
+            annotations = stack.enter_context(dnaio.open(annot, mode="r", fileformat=determine_filetype(annot),
+                                                         open_threads=threads))
+            if table is not None:
+                annotations = correct_records(annotations, table, correction_summary, positional=True)
+            tagged_reads = tag_reads_positional(tqdm(reader, desc="Parsing reads"), annotations, summary)
+        else:
+            annotator = stack.enter_context(BufferedFASTAReader(annot, buffer_size=buffer_size, threads=threads,
+                                                                max_buffer_size=max_buffer_size,
+                                                                max_spill_size=max_spill_size, tmpdir=tmpdir,
+                                                                corrections=table,
+                                                                correction_summary=correction_summary))
+            tagged_reads = tag_reads(tqdm(reader, desc="Parsing reads"), annotator, separator, summary)
+
+        if sort_by_barcode:
+            logger.info(f"Sorting records by barcode using {threads} worker(s).")
+            runs = write_sorted_runs(tagged_reads, tmp, max_memory, threads)
+            summary["Sorted runs"] = len(runs)
+        else:
+            writer = stack.enter_context(dnaio.open(output, mode="w", fileformat=output_format,
+                                                    open_threads=threads))
+            for _, read in tagged_reads:
                 writer.write(read)
 
+        if annotator is not None:
+            summary.update(annotator.summary)
+            if table is not None:
+                # Include all annotation records in correction statistics
+                annotator.skip_remaining()
+
+        if sort_by_barcode:
+            logger.info(f"Merging {len(runs)} sorted runs into output file.")
+            merge_sorted_runs(runs, output, output_format, tmp, threads)
+
+    if corrections is not None:
+        correction_summary.print_stats(name="dbspro.cli.correctfastq")
     summary.print_stats(name=__name__)
 
     logger.info("Finished")
 
 
+def tag_reads(reads: Iterator[dnaio.SequenceRecord], annotator: "BufferedFASTAReader", separator: str,
+              summary: Summary) -> Iterator[Tuple[str, dnaio.SequenceRecord]]:
+    """Yield annotation sequence and read with annotation added to name for reads with annotation"""
+    for read in reads:
+        summary["Reads total"] += 1
+        sequence = annotator.get(read.id)
+        if sequence:
+            read.name = f"{read.id}{separator}{sequence}"
+            summary["Reads annotated"] += 1
+            yield sequence, read
+
+
+def tag_reads_positional(reads: Iterator[dnaio.SequenceRecord], annotations: Iterator[dnaio.SequenceRecord],
+                         summary: Summary) -> Iterator[Tuple[str, dnaio.SequenceRecord]]:
+    """Yield annotation sequence and read named by annotation for pairs of non-empty records at the same position"""
+    for read, annotation in zip_longest(reads, annotations):
+        if read is None or annotation is None:
+            raise ValueError("Input and annotation files have different number of records.")
+
+        if not read.sequence:
+            continue
+
+        summary["Reads total"] += 1
+        if annotation.sequence:
+            read.name = annotation.sequence
+            summary["Reads annotated"] += 1
+            yield annotation.sequence, read
+
+
+def write_sorted_runs(tagged_reads: Iterator[Tuple[str, dnaio.SequenceRecord]], directory: str, max_memory: int,
+                      threads: int = 1) -> List[str]:
+    """
+    Split records into batches that fit in memory and write each batch sorted by barcode and name to a compressed
+    run file. Batches are sorted in parallel. Return paths to run files.
+    """
+    # Batches are held by the main process and by each pending worker job.
+    max_batch_size = max_memory * 1024 ** 2 // (2 * threads + 1)
+
+    def batches():
+        batch = []
+        size = 0
+        for barcode, read in tagged_reads:
+            batch.append((barcode, read.name, read.sequence, read.qualities or ""))
+            # Approximate size including Python object overhead
+            size += len(read.name) + len(read.sequence) + len(barcode) + 250
+            if size >= max_batch_size:
+                yield batch
+                batch = []
+                size = 0
+        if batch:
+            yield batch
+
+    items = ((batch, os.path.join(directory, f"run{i}.tsv.gz")) for i, batch in enumerate(batches()))
+    return list(parallel_map(_write_sorted_run, items, threads=threads))
+
+
+def _write_sorted_run(item: Tuple[List[Tuple[str, str, str, str]], str]) -> str:
+    records, path = item
+    records.sort()
+    with xopen(path, mode="wb", compresslevel=1) as file:
+        file.write(_format_run_records(records))
+    return path
+
+
+def _format_run_records(records: Iterable[Tuple[str, str, str, str]]) -> bytes:
+    return "".join(f"{barcode}\t{name}\t{sequence}\t{qualities}\n"
+                   for barcode, name, sequence, qualities in records).encode()
+
+
+def _read_sorted_run(file) -> Iterator[Tuple[str, str, str, str]]:
+    for line in file:
+        yield tuple(line.rstrip("\n").split("\t"))
+
+
+def merge_sorted_runs(runs: List[str], output: str, output_format: str, directory: str, threads: int = 1,
+                      max_open_runs: int = MAX_OPEN_RUNS):
+    """
+    Merge sorted run files into output. If there are more than max_open_runs runs, groups of runs are first merged
+    into new runs in the directory, in parallel, until few enough remain.
+    """
+    merge_pass = 0
+    while len(runs) > max_open_runs:
+        groups = [runs[i:i + max_open_runs] for i in range(0, len(runs), max_open_runs)]
+        logger.info(f"Merging {len(runs)} sorted runs into {len(groups)} runs.")
+        items = ((group, os.path.join(directory, f"merged{merge_pass}_{i}.tsv.gz")) for i, group in enumerate(groups))
+        runs = list(parallel_map(_merge_runs, items, threads=threads))
+        merge_pass += 1
+
+    with ExitStack() as stack:
+        files = [stack.enter_context(xopen(run, mode="r")) for run in runs]
+        writer = stack.enter_context(dnaio.open(output, mode="w", fileformat=output_format, open_threads=threads))
+        for _, name, sequence, qualities in heapq.merge(*map(_read_sorted_run, files)):
+            writer.write(dnaio.SequenceRecord(name, sequence, qualities or None))
+
+
+def _merge_runs(item: Tuple[List[str], str]) -> str:
+    """Merge sorted run files into a new run file and remove the merged runs"""
+    runs, path = item
+    with ExitStack() as stack:
+        files = [stack.enter_context(xopen(run, mode="r")) for run in runs]
+        output = stack.enter_context(xopen(path, mode="wb", compresslevel=1))
+        for records in _batched(heapq.merge(*map(_read_sorted_run, files)), 10_000):
+            output.write(_format_run_records(records))
+    for run in runs:
+        os.remove(run)
+    return path
+
+
+def _batched(iterable, size: int) -> Iterator[List]:
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
 class BufferedFASTAReader:
-    """Read FASTA file and buffer records with same read name"""
-    __slots__ = ["_file", "_iter", "_names", "_seqs", "_buffer_size", "_missed", "_count"]
+    """
+    Read FASTA file and buffer records with same read name. Records are kept in a dict ordered by file position. When
+    a record is found, older records are assumed to lack a matching read and are moved to a spill database on disk in
+    case reads are out of order. The buffer grows when there are more misses than the buffer size without a hit in
+    between, but never above max_buffer_size records. A full buffer with several misses in a row also slides forward
+    by moving its oldest records to the spill, so that records further ahead in the file are found. The spill holds
+    at most max_spill_size records, the oldest records are discarded when it is full.
+
+    If a correction table is given, records are corrected in batches as they are read and records without correction
+    are skipped.
+    """
+    __slots__ = ["_file", "_iter", "_buffer", "_buffer_size", "_max_buffer_size", "_missed", "_spill", "_pending",
+                 "summary"]
 
-    def __init__(self, file, buffer_size: int = 64):
-        self._file = dnaio.open(file, mode="r", fileformat=determine_filetype(file))
-        self._buffer_size = buffer_size
+    def __init__(self, file, buffer_size: int = 64, threads: int = 0, max_buffer_size: int = 1_000_000,
+                 max_spill_size: int = 10_000_000, tmpdir: str = None, summary: Summary = None,
+                 corrections: CorrectionTable = None, correction_summary: Summary = None):
+        self._file = dnaio.open(file, mode="r", fileformat=determine_filetype(file), open_threads=threads)
+        self._buffer_size = min(buffer_size, max_buffer_size)
+        self._max_buffer_size = max_buffer_size
         self._iter = iter(self._file)
-        self._names = []
-        self._seqs = []
+        if corrections is not None:
+            self._iter = correct_records(self._file, corrections,
+                                         correction_summary if correction_summary is not None else Summary())
+        self._buffer = OrderedDict()
         self._missed = 0
-        self._count = 0
+        self._spill = SpillDatabase(tmpdir, max_size=max_spill_size)
+        self._pending = []
+        self.summary = summary if summary is not None else Summary()
 
     def __iter__(self):
         return self
 
     def get(self, name):
-        try:
-            index = self._names.index(name)
-        except ValueError:
-            for record in islice(self._iter, self._buffer_size-len(self._names)):
-                self._count += 1
-                # If read_name in next pair then parser lines are synced --> drop buffer)
-                if record.id == name:
-                    self._names.clear()
-                    self._seqs.clear()
-                    self._missed = 0
-                    return record.sequence
-
-                self._names.append(record.id)
-                self._seqs.append(record.sequence)
-
-            self._missed += 1
+        if name in self._buffer:
+            # Records before the match are assumed to lack a matching read
+            older = []
+            record_name, sequence = self._buffer.popitem(last=False)
+            while record_name != name:
+                older.append((record_name, sequence))
+                record_name, sequence = self._buffer.popitem(last=False)
+            self._spill_records(older)
+            return self._hit(sequence, "Annotations found in buffer")
 
-        else:
-            sequence = self._seqs[index]
-            self._names = self._names[index+1:]
-            self._seqs = self._seqs[index+1:]
-            self._missed = 0
-            return sequence
+        sequence = self._read_ahead(name)
+        if sequence is not None:
+            return self._hit(sequence, "Annotations found in buffer")
 
-        if self._missed > self._buffer_size:
-            self._buffer_size *= 2
+        self._flush()
+        sequence = self._spill.pop(name)
+        if sequence is not None:
+            return self._hit(sequence, "Annotations found in spill")
+
+        # Misses are counted since the last hit or resize
+        self._missed += 1
+        if self._missed > self._buffer_size and self._buffer_size < self._max_buffer_size:
+            self._buffer_size = min(self._buffer_size * 2, self._max_buffer_size)
             logger.warning(f"Resetting buffer after {self._missed} misses buffer = {self._buffer_size}.")
             self._missed = 0
+        elif self._missed > SLIDE_AFTER and len(self._buffer) >= self._buffer_size:
+            # Read further ahead the more misses there are in a row
+            sequence = self._slide(name, SLIDE_STEP * (self._missed - SLIDE_AFTER))
+            if sequence is not None:
+                return self._hit(sequence, "Annotations found in buffer")
+
+        self.summary["Annotation misses"] += 1
+
+    def skip_remaining(self):
+        """Read remaining records in file without buffering them"""
+        for _ in self._iter:
+            pass
+
+    def _read_ahead(self, name: str) -> Optional[str]:
+        """Fill the buffer with records from the file and return the sequence if the name is found"""
+        for record in islice(self._iter, max(self._buffer_size - len(self._buffer), 0)):
+            # If read_name in next pair then parser lines are synced --> spill buffer
+            if record.id == name:
+                self._evict(len(self._buffer))
+                return record.sequence
+
+            self._buffer[record.id] = record.sequence
+        return None
+
+    def _slide(self, name: str, nr_records: int) -> Optional[str]:
+        """
+        Move up to nr_records of the oldest records to the spill while reading as many new records and return the
+        sequence if the name is found
+        """
+        while nr_records > 0 and self._buffer:
+            nr_evicted = min(nr_records, len(self._buffer))
+            self._evict(nr_evicted)
+            nr_records -= nr_evicted
+            sequence = self._read_ahead(name)
+            if sequence is not None:
+                return sequence
+            if len(self._buffer) < self._buffer_size:
+                # End of file
+                return None
+        return None
+
+    def _hit(self, sequence: str, stat: str) -> str:
+        self.summary[stat] += 1
+        self._missed = 0
+        return sequence
+
+    def _evict(self, nr_records: int):
+        """Move the oldest records in the buffer to the spill database"""
+        self._spill_records([self._buffer.popitem(last=False) for _ in range(nr_records)])
+
+    def _spill_records(self, records: List[Tuple[str, str]]):
+        self._pending.extend(records)
+        self.summary["Annotations spilled to disk"] += len(records)
+        if len(self._pending) >= 10_000:
+            self._flush()
+
+    def _flush(self):
+        if self._pending:
+            self.summary["Annotations discarded from spill"] += self._spill.add(self._pending)
+            self._pending.clear()
 
     def __enter__(self):
         return self
@@ -138,6 +435,51 @@ class BufferedFASTAReader:
 
     def close(self):
         self._file.close()
+        self._spill.close()
+
+
+class SpillDatabase:
+    """
+    SQLite database in a temporary file for records evicted from the buffer. Holds at most max_size records, discarding
+    the oldest records when full.
+    """
+    def __init__(self, tmpdir: str = None, max_size: int = 10_000_000):
+        self._dir = TemporaryDirectory(dir=tmpdir)
+        self._connection = sqlite3.connect(os.path.join(self._dir.name, "spill.sqlite"))
+        self._connection.execute("PRAGMA journal_mode = OFF")
+        self._connection.execute("PRAGMA synchronous = OFF")
+        self._connection.execute("CREATE TABLE records (name TEXT PRIMARY KEY, sequence TEXT)")
+        self._size = 0
+        self._max_size = max_size
+
+    def add(self, records: List[Tuple[str, str]]) -> int:
+        """Add records and return the number of old records discarded to stay within the maximum size"""
+        self._connection.executemany("INSERT OR REPLACE INTO records VALUES (?, ?)", records)
+        self._size += len(records)
+        if self._size <= self._max_size:
+            return 0
+
+        # Records are inserted in file order so the lowest row ids are the oldest records
+        discarded = self._connection.execute(
+            "DELETE FROM records WHERE rowid IN (SELECT rowid FROM records ORDER BY rowid LIMIT ?)",
+            (self._size - self._max_size,)
+        ).rowcount
+        self._size -= discarded
+        return discarded
+
+    def pop(self, name: str) -> Optional[str]:
+        if self._size == 0:
+            return None
+        row = self._connection.execute("SELECT sequence FROM records WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return None
+        self._connection.execute("DELETE FROM records WHERE name = ?", (name,))
+        self._size -= 1
+        return row[0]
+
+    def close(self):
+        self._connection.close()
+        self._dir.cleanup()
 
 
 def determine_filetype(file):
@@ -9,10 +9,20 @@ import operator
 import time
 import pandas as pd
 import numpy as np
-from umi_tools import UMIClusterer
-from typing import Union
+from typing import List, Optional, Union
 from scipy.stats.mstats import gmean
 from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+
+from dbspro.utils import decode_variable_length, equal_key_pairs, HammingIndex
+
+DTYPES = {
+    "Barcode": "object",
+    "Target": "object",
+    "UMI": "object",
+    "ReadCount": int,
+    "Sample": "category"
+}
 
 
 def _filter_wrapper(func):
@@ -97,62 +107,73 @@ pd.DataFrame.filter_target_count = filter_target_count
 @_filter_wrapper
 def filter_dups(df: pd.DataFrame, threshold: Union[float, int] = 2, min_len: int = 3) -> pd.DataFrame:
     """Remove barcodes that share a portion of their UMI-Targets combos based on the given threshold. If float
-    then jaccard_index is used. If int then the there must be at least this many combos in common."""
-    def nr_shared(set1, set2):
-        return set1 & set2
-
-    d = df.copy()
-    d["Target-UMI"] = d[["Target", "UMI"]].agg("-".join, axis=1)
-    bcs = d.groupby("Barcode")["Target-UMI"].apply(set)
-    bcs = dict(bcs[bcs.transform(len) >= min_len])
-
-    indptr = [0]
-    indices = []
-    data = []
-    umis = {}
-    barcodes = []
-
-    for bc, umi_set in bcs.items():
-        for umi in umi_set:
-            index = umis.setdefault(umi, len(umis))
-            indices.append(index)
-            data.append(1)
-        indptr.append(len(indices))
-        barcodes.append(bc)
-    barcodes = np.array(barcodes)
-
-    arr = csr_matrix((data, indices, indptr), dtype=int)
-    overlapps = (arr * arr.transpose())
-    bcs_rows, bcs_cols = overlapps.nonzero()
-    in_lower = bcs_rows < bcs_cols
-    bcs_rows = bcs_rows[in_lower]
-    bcs_cols = bcs_cols[in_lower]
-    nr_overlapps = np.array(overlapps[bcs_rows, bcs_cols]).flatten()
-
-    barcodes_to_remove = set()
+    then jaccard_index is used. If int then the there must be at least this many combos in common.
+
+    Candidate pairs are found through an inverted index over a prefix of each barcode's UMI-Target combos ordered from
+    rare to common. The prefix is chosen so that any pair above the threshold must share a combo within the prefix,
+    and candidates are verified by computing the exact overlap."""
+    barcode_codes, barcodes = pd.factorize(df["Barcode"])
+    combo_codes = df.groupby(["Target", "UMI"], sort=False).ngroup().to_numpy()
+    entries = np.unique(barcode_codes.astype(np.int64) * (combo_codes.max() + 1) + combo_codes)
+    entry_barcodes = entries // (combo_codes.max() + 1)
+    entry_combos = entries % (combo_codes.max() + 1)
+
+    sizes = np.bincount(entry_barcodes, minlength=len(barcodes))
+    keep = sizes[entry_barcodes] >= min_len
+    entry_barcodes = entry_barcodes[keep]
+    entry_combos = entry_combos[keep]
+
+    # Minimum overlap for a pair including each barcode to pass the threshold
     if isinstance(threshold, int):
         print(f"Filter barcodes who share >{threshold} UMI + Target combos ")
-        dups = nr_overlapps > threshold
-        dup_cols = bcs_cols[dups]
-        dup_rows = bcs_rows[dups]
-        barcodes_to_remove |= set(barcodes[dup_cols])
-        barcodes_to_remove |= set(barcodes[dup_rows])
+        min_overlap = np.full(len(barcodes), threshold + 1)
     else:
         print(f"Filter barcodes whose UMI + Target combos have a jaccard index >{threshold}")
-        bcs_col_counts = np.array(overlapps[bcs_cols, bcs_cols]).flatten()
-        bcs_rows_counts = np.array(overlapps[bcs_rows, bcs_rows]).flatten()
-        totals = bcs_col_counts + bcs_rows_counts - nr_overlapps
-        jaccard_values = nr_overlapps / totals
-        dups = jaccard_values > threshold
+        # Tolerance to not overestimate the bound due to rounding
+        min_overlap = np.floor(threshold * sizes - 1e-9).astype(int) + 1
 
-        dup_cols = bcs_cols[dups]
-        dup_rows = bcs_rows[dups]
-        barcodes_to_remove |= set(barcodes[dup_cols])
-        barcodes_to_remove |= set(barcodes[dup_rows])
+    arr = csr_matrix((np.ones(len(entry_barcodes), dtype=np.int32), (entry_barcodes, entry_combos)),
+                     shape=(len(barcodes), combo_codes.max() + 1))
+    rows, cols = _candidate_pairs(entry_barcodes, entry_combos, sizes - np.maximum(min_overlap, 1) + 1)
+
+    barcodes_to_remove = set()
+    for start in range(0, len(rows), _VERIFY_BATCH_SIZE):
+        batch_rows = rows[start:start + _VERIFY_BATCH_SIZE]
+        batch_cols = cols[start:start + _VERIFY_BATCH_SIZE]
+        nr_overlapps = np.asarray(arr[batch_rows].multiply(arr[batch_cols]).sum(axis=1)).ravel()
+        if isinstance(threshold, int):
+            dups = nr_overlapps > threshold
+        else:
+            totals = sizes[batch_rows] + sizes[batch_cols] - nr_overlapps
+            dups = nr_overlapps / totals > threshold
+
+        barcodes_to_remove |= set(barcodes[batch_cols[dups]])
+        barcodes_to_remove |= set(barcodes[batch_rows[dups]])
 
     return df[~df["Barcode"].isin(barcodes_to_remove)]
 
 
+_VERIFY_BATCH_SIZE = 1_000_000
+
+
+def _candidate_pairs(entry_barcodes: np.ndarray, entry_combos: np.ndarray, prefix_lengths: np.ndarray):
+    """Return unique pairs of barcodes that share a combo within the first prefix_lengths combos of each barcode,
+    with combos ordered by increasing frequency."""
+    frequency = np.bincount(entry_combos)
+    order = np.lexsort((entry_combos, frequency[entry_combos], entry_barcodes))
+    entry_barcodes = entry_barcodes[order]
+    entry_combos = entry_combos[order]
+
+    starts = np.searchsorted(entry_barcodes, entry_barcodes, side="left")
+    in_prefix = np.arange(len(entry_barcodes)) - starts < prefix_lengths[entry_barcodes]
+    entry_barcodes = entry_barcodes[in_prefix]
+    entry_combos = entry_combos[in_prefix]
+
+    first, second = equal_key_pairs(entry_combos)
+    pairs = np.unique(np.sort(np.stack([entry_barcodes[first], entry_barcodes[second]]), axis=0), axis=1)
+    return pairs[0], pairs[1]
+
+
 pd.DataFrame.filter_dups = filter_dups
 
 
@@ -169,26 +190,26 @@ pd.DataFrame.filter_targets = filter_targets
 def filter_connected(df: pd.DataFrame, dist: int = 2) -> pd.DataFrame:
     """Remove barcodes that are within hamming dist of eachother leving isolated sequences
     Inspired by the Abseq analysis in https://www.nature.com/articles/srep44447
-    """
-    clusterer = UMIClusterer(cluster_method="cluster")
-    # Encode each DBS for UMITools and perpare counts
-    dbs_counts = {bytes(dbs, encoding='utf-8'): sum(group["ReadCount"]) for dbs, group in df.groupby("Barcode")
-                  if len(dbs) == 20}
-
-    print(f"Pre cluster DBSs: {len(dbs_counts)}")
 
-    # Cluster DBS
-    clustered_dbss = clusterer(dbs_counts, threshold=dist)
-
-    print(f"Clustered DBSs: {len(clustered_dbss)}")
+    Barcodes are only compared to barcodes of the same length, using a pigeonhole index to find neighbors.
+    """
+    barcodes = pd.Series(df["Barcode"].unique())
+    print(f"Pre cluster DBSs: {len(barcodes)}")
 
-    # Loop over clusters and save only isolated DBSs.
     dbs_kept = set()
-    for cluster in clustered_dbss:
-        seqs = [seq.decode("utf-8") for seq in cluster]
-
-        if len(seqs) == 1:
-            dbs_kept.add(seqs[0])
+    nr_clusters = 0
+    for _, group in barcodes.groupby(barcodes.str.len()):
+        index = HammingIndex(group.tolist(), dist)
+        first, second = index.pairs()
+        graph = csr_matrix((np.ones(len(first)), (first, second)), shape=(len(group), len(group)))
+        nr_clusters += connected_components(graph, directed=False, return_labels=False)
+
+        isolated = np.ones(len(group), dtype=bool)
+        isolated[first] = False
+        isolated[second] = False
+        dbs_kept.update(group[isolated])
+
+    print(f"Clustered DBSs: {nr_clusters}")
     return df[df["Barcode"].isin(dbs_kept)]
 
 
@@ -326,3 +347,37 @@ def clr_normalize(matrix: pd.DataFrame, columns=None, on_cells: bool = False) ->
 
 
 pd.DataFrame.clr_normalize = clr_normalize
+
+###########
+# LOADING #
+###########
+
+
+def load_data(file: str, columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """Load data from `dbspro integrate` written as TSV or Parquet. Only the given columns are read if provided."""
+    if not str(file).endswith(".parquet"):
+        return pd.read_csv(file, sep="\t", dtype=DTYPES, usecols=columns)
+
+    import pyarrow.parquet as pq
+    table = pq.read_table(file, columns=columns)
+    df = pd.DataFrame({name: _column_to_numpy(table.column(name)) for name in table.column_names})
+    return df.astype({name: dtype for name, dtype in DTYPES.items() if name in df})
+
+
+def _column_to_numpy(column) -> np.ndarray:
+    """Convert Parquet column to NumPy array decoding dictionary-encoded strings and packed UMIs"""
+    import pyarrow as pa
+    if column.num_chunks == 0:
+        return np.empty(0, dtype=object if pa.types.is_dictionary(column.type) else column.type.to_pandas_dtype())
+
+    if pa.types.is_dictionary(column.type):
+        # Each row group has its own dictionary so these are unified before decoding the indices.
+        chunks = column.unify_dictionaries().chunks
+        dictionary = np.array(chunks[0].dictionary.to_pylist(), dtype=object)
+        return dictionary[np.concatenate([chunk.indices.to_numpy(zero_copy_only=False) for chunk in chunks])]
+
+    values = column.to_numpy()
+    if pa.types.is_uint64(column.type):
+        unique, inverse = np.unique(values, return_inverse=True)
+        return np.array(decode_variable_length(unique), dtype=object)[inverse]
+    return values
@@ -2,6 +2,7 @@
 Snakefile for DBS-Pro pipeline
 """
 from importlib.resources import files, as_file
+import json
 
 import pandas as pd
 from snakemake.utils import validate
@@ -19,18 +20,13 @@ samples = pd.read_csv(SAMPLE_FILE_NAME, sep="\t").set_index("Sample", drop=False
 # Get required values
 abc_len = len(abc["Sequence"].iloc[0]) - 1
 abc_umi_len = abc_len + config["umi_len"]
-dbs_n = "N"*len(config["dbs"])
 dbs_h2_abs_umi_len = len(config["dbs"]) + len(config["h2"]) + abc_len + config["umi_len"]
 
-if config["h1"] is None: # For PBA input
-    trim_outer = f"-a {config['h3']}"
-    abs_umi_adapter = f"^{dbs_n}{config['h2']}...{config['h3']}"
-else: # For DBS-Pro input
-    trim_outer = f"-g ^{config['h1']}...{config['h3']}"
-    abs_umi_adapter = f"^{config['h1']}{dbs_n}{config['h2']}...{config['h3']}"
-
 do_sampling = "subsampled." if config["subsample"] != -1 else ""
+dbs_counts_ext = "tsv" if config["dbs_cluster_method"] == "starcode" else "npy"
+dbs_clusters = "{sample}.trimmed.dbs.clusters." + ("txt.gz" if config["dbs_cluster_method"] == "starcode" else "npy")
 nr_samples = len(samples)
+data_ext = "parquet" if config["data_format"] == "parquet" else "tsv.gz"
 
 wildcard_constraints:
     sample="\w+"
@@ -39,7 +35,7 @@ wildcard_constraints:
 rule all:
     input: 
         'report.html', 
-        'data.tsv.gz', 
+        f"data.{data_ext}",
         'multiqc_report.html',
         expand("{sample}.counts.h5ad", sample=samples["Sample"])
 
@@ -82,85 +78,47 @@ rule fastqc:
         " &> {log}"
 
 
-rule trim_outer_handles:
-    """Trim outer handles leaving DBS - H2 - ABC+UMI."""
+rule extract_dbs_abc_umi:
+    """Extract DBS and ABC+UMI from reads in a single pass."""
     output:
-        reads="{sample}.trimmed.fastq.gz",
+        dbs="{sample}.trimmed.dbs.fasta.gz",
+        abc_umi="{sample}.trimmed.abc_umi.fasta.gz",
     input:
         reads=f"{{sample}}.{do_sampling}fastq.gz"
-    log: "log_files/{sample}.trimmed.log"
-    threads: max(workflow.cores / nr_samples, 4)
+    log:
+        report="log_files/{sample}.trimmed.log",
+        log="log_files/{sample}.trimmed.dbs.log",
+    threads: max(workflow.cores // nr_samples, 4)
     params:
-        trim=trim_outer,
+        h1=f"--h1 {config['h1']}" if config["h1"] is not None else "",
+        h2=config["h2"],
+        h3=config["h3"],
         err_rate=config["trim_err_rate"],
+        dbs_len=len(config["dbs"]),
+        abc_umi_len=abc_umi_len,
         min_len=dbs_h2_abs_umi_len - int(dbs_h2_abs_umi_len * 0.1),
         max_len=dbs_h2_abs_umi_len + int(dbs_h2_abs_umi_len * 0.1),
-        overlap=5
+        overlap=5,
+        barcode_pattern=f"--barcode-pattern {config['dbs']}" if config["early_barcode_filter"] else ""
     shell:
-        "cutadapt"
-        " {params.trim}"
+        "dbspro extract"
+        " {input.reads}"
+        " --dbs-output {output.dbs}"
+        " --abc-umi-output {output.abc_umi}"
+        " {params.h1}"
+        " --h2 {params.h2}"
+        " --h3 {params.h3}"
+        " --dbs-len {params.dbs_len}"
+        " --abc-umi-len {params.abc_umi_len}"
         " -e {params.err_rate}"
         " -m {params.min_len}"
         " -M {params.max_len}"
-        " --max-n 0"
         " -O {params.overlap}"
-        " -Z"
+        " {params.barcode_pattern}"
+        " --positional"
         " -j {threads}"
-        " -o {output.reads}"
-        " {input.reads}"
-        " > {log}"
-
-
-rule fastqc_trimmed:
-    output:
-        html="log_files/{sample}.trimmed_fastqc.html",
-        zip="log_files/{sample}.trimmed_fastqc.zip"
-    input:
-        reads="{sample}.trimmed.fastq.gz"
-    log: "log_files/{sample}.trimmed_fastqc.log"
-    shell:
-        "fastqc"
-        " -o log_files"
-        " -t 1"
-        " {input.reads}"
-        " &> {log}"
-
-
-rule extract_dbs_abc_umi:
-    """Extract DBS and ABC+UMI."""
-    output:
-        dbs="{sample}.trimmed.dbs.fasta.gz",
-        abc_umi="{sample}.trimmed.abc_umi.fasta.gz",
-        dbs_tmp=temp("{sample}.trimmed.dbs.txt"),
-    input:
-        reads="{sample}.trimmed.fastq.gz"
-    log: "log_files/{sample}.trimmed.dbs.log",
-    threads: max(workflow.cores // nr_samples, 4)
-    params:
-        err_rate=config["trim_err_rate"],
-        dbs_len = len(config["dbs"]),
-        abs_umi_len = abc_len + config["umi_len"],
-        handle = dbs_n + config["h2"],
-    shell:
-        # Extract DBS and ABC+UMI using cutadapt
-        "cutadapt"
-        " -g ^{params.handle}"
-        " -j {threads}"
-        " --rename {{id}}"
-        " -m {params.abs_umi_len}"
-        " -M {params.abs_umi_len}"
-        " --fasta"
-        " --discard-untrimmed"
-        " -o {output.abc_umi}"
-        " --wildcard-file {output.dbs_tmp}"
-        " -Z"
-        " {input.reads}"
-        " > {log}"
-        " && "
-        # Convert TXT file with DBS sequences to FASTA
-        "awk -F' ' '{{print \">\"$2\"\\n\"$1 }}' < {output.dbs_tmp}"
-        " | "
-        "pigz -1 > {output.dbs}"
+        " > {log.report}"
+        " 2> {log.log}"
 
 
 rule count_dbs:
@@ -168,12 +126,15 @@ rule count_dbs:
     input:
         reads="{sample}.trimmed.dbs.fasta.gz"
     output:
-        counts=temp("{sample}.trimmed.dbs.counts.tsv")
+        counts=temp("{sample}.trimmed.dbs.counts." + dbs_counts_ext)
+    log: "log_files/{sample}.trimmed.dbs.counts.log"
+    threads: max(workflow.cores // nr_samples, 4)
     shell:
-        "gunzip -c {input.reads}"
-        " | "
-        "awk -v OFS=\"\t\" '{{ if ( NR%2==0 ) {{ counts[$1]++ }} }} END {{ for (barcode in counts) print (barcode,counts[barcode]) }}'"
-        " > {output.counts}"
+        "dbspro countdbs"
+        " {input.reads}"
+        " -o {output.counts}"
+        " -j {threads}"
+        " 2> {log}"
 
 
 rule dbs_cluster:
@@ -195,126 +156,138 @@ rule dbs_cluster:
         " 2> {log} | pigz > {output.clusters}"
 
 
-rule correct_dbs:
-    """Combine DBS clustering results with original FASTA for error correction."""
+rule dbs_cluster_dbspro:
+    """Cluster DBS sequence using the built-in message passing clustering for error correction."""
     output:
-        reads="{sample}.trimmed.dbs.corrected.fasta.gz"
+        clusters="{sample}.trimmed.dbs.clusters.npy"
     input:
-        reads="{sample}.trimmed.dbs.fasta.gz",
-        clusters="{sample}.trimmed.dbs.clusters.txt.gz"
-    log: "log_files/{sample}.trimmed.dbs.corrected.log"
+        counts="{sample}.trimmed.dbs.counts.npy"
+    log: "log_files/{sample}.dbs.clusters.log"
+    threads: max(workflow.cores // nr_samples, 4)
+    params:
+        dist = config["dbs_cluster_dist"]
     shell:
-        "dbspro correctfastq"
-        " {input.reads}"
-        " {input.clusters}"
-        " --output-fasta {output.reads}"
+        "dbspro clusterdbs"
+        " {input.counts}"
+        " -o {output.clusters}"
+        " -d {params.dist}"
+        " -j {threads}"
         " 2> {log}"
 
 
 rule tagfastq:
-    """Tag ABC and UMI sequences with DBS sequence and sort by barcode."""
+    """Correct DBS sequences using the clustering results, tag ABC and UMI sequences with the corrected DBS sequence
+    and sort by barcode."""
     output:
         reads="{sample}.trimmed.abc_umi.tagged.fasta.gz"
     input:
-        dbs="{sample}.trimmed.dbs.corrected.fasta.gz",
+        dbs="{sample}.trimmed.dbs.fasta.gz",
+        clusters=dbs_clusters,
         abc_umi="{sample}.trimmed.abc_umi.fasta.gz"
     log: "log_files/{sample}.trimmed.abc_umi.tagged.log"
+    threads: max(workflow.cores // nr_samples, 4)
+    resources:
+        mem_mb=config["sort_memory"]
     shell:
         "dbspro tagfastq"
         " {input.abc_umi}"
         " {input.dbs}"
-        " -s ' '"
+        " -c {input.clusters}"
+        " --positional"
+        " --sort-by-barcode"
+        " --max-memory {resources.mem_mb}"
+        " --tmpdir ."
+        " -o {output.reads}"
+        " -j {threads}"
         " 2> {log}"
-        " | "
-        "paste - -"
-        " | "
-        "awk -F ' ' '{{OFS=\"\t\"; print $2,$0}}'"
-        " | "
-        "sort -t $'\t' -k1,1"
-        " | "
-        "cut -f 2-"
-        " | "
-        "tr '\t' '\n'"
-        " | "
-        "pigz -1 > {output.reads}"
 
 
 rule demultiplex_abc:
-    """Demultiplexes ABC sequnces and trims it to give ABC-specific UMI fastq files."""
+    """Demultiplexes ABC sequnces and trims it to give UMI fasta with the ABC target name in the header."""
     output:
-        reads=touch(expand("ABCs/{{sample}}.{name}.umi.fasta.gz", name=abc['Target']))
+        reads="{sample}.abc_umi.demultiplexed.fasta.gz"
     input:
         reads="{sample}.trimmed.abc_umi.tagged.fasta.gz"
     log: 
         log = "log_files/{sample}.abc.umi.log",
-        json = "log_files/{sample}.abc.umi.json"
+        json = "log_files/{sample}.abc.umi.json",
+        stderr = "log_files/{sample}.abc.umi.demultiplex.log"
+    threads: max(workflow.cores // nr_samples, 4)
     params:
         file=config["abc_file"],
         err_rate=config["demultiplex_err_rate"]
     shell:
-        "cutadapt"
-        " -g file:{params.file}"
-        " --no-indels"
+        "dbspro demultiplex"
+        " {input.reads}"
+        " -a {params.file}"
         " -e {params.err_rate}"
+        " --discard-untrimmed"
         " --json {log.json}"
-        " -Z"
-        " -o ABCs/{wildcards.sample}.{{name}}.umi.fasta.gz"
-        " {input.reads}"
+        " -o {output.reads}"
+        " -j {threads}"
         " > {log.log}"
+        " 2> {log.stderr}"
 
 
 rule umi_cluster:
-    """Cluster UMIs using UMI-tools API for each DBS and ABC to error correct them."""
+    """Cluster UMIs using UMI-tools methods for each DBS and ABC to error correct them and count reads per UMI."""
     output:
-        reads="ABCs/{sample}.{target}.umi.corrected.fasta.gz"
+        counts="{sample}.abc_umi.corrected.tsv.gz"
     input:
-        reads="ABCs/{sample}.{target}.umi.fasta.gz",
-    log: "log_files/{sample}.{target}.umi.corrected.log"
+        reads="{sample}.abc_umi.demultiplexed.fasta.gz"
+    log: "log_files/{sample}.umi.corrected.log"
+    threads: max(workflow.cores // nr_samples, 4)
     params:
         dist = config["abc_cluster_dist"],
         length = config["umi_len"]
-    run:
-        if params.dist > 0:
-            shell(
-                "dbspro splitcluster"
-                " {input.reads}"
-                " -o {output.reads}"
-                " -t {params.dist}"
-                " -l {params.length}"
-                " 2> {log}"
-            )
-        else: # Copy file if no clustering specified
-            shell(
-                "cp {input.reads} {output.reads}"
-            )
+    shell:
+        # No UMIs are merged when the distance is 0
+        "dbspro splitcluster"
+        " {input.reads}"
+        " -o {output.counts}"
+        " -t {params.dist}"
+        " -l {params.length}"
+        " --panel"
+        " --collapsed"
+        " -j {threads}"
+        " 2> {log}"
 
 
 rule integrate:
     """Integrate data into TSV with each DBS, ABC, UMI combination with read count for each sample."""
     output:
-        data="{sample}.data.tsv.gz"
+        data="{sample}.data." + data_ext,
+        stats="{sample}.data.stats.json"
     input:
-        abc_fastas=expand("ABCs/{{sample}}.{abc}.umi.corrected.fasta.gz", abc=abc['Target'])
+        counts="{sample}.abc_umi.corrected.tsv.gz"
     log: "log_files/{sample}.integrate.log"
+    threads: max(workflow.cores // nr_samples, 4)
     params:
         dbs = config['dbs']
     shell:
         "dbspro integrate"
         " -o {output.data}"
+        " --stats {output.stats}"
         " --barcode-pattern {params.dbs}"
-        " {input.abc_fastas}"
+        " -j {threads}"
+        " {input.counts}"
         " 2> {log}"
 
 
 rule merge_data:
     """Merge data from all samples"""
     output:
-        data = "data.tsv.gz"
+        data = f"data.{data_ext}"
     input: 
-        data_files = expand("{sample}.data.tsv.gz", sample=samples["Sample"])
-    run:
-        merged_data = pd.concat([pd.read_csv(file, sep="\t") for file in input.data_files])
-        merged_data.to_csv(output.data, sep="\t", index=False)
+        data_files = expand("{sample}.data.{ext}", sample=samples["Sample"], ext=data_ext)
+    log: "log_files/merge_data.log"
+    threads: workflow.cores
+    shell:
+        "dbspro mergedata"
+        " -o {output.data}"
+        " -j {threads}"
+        " {input.data_files}"
+        " 2> {log}"
 
 
 rule generate_h5ad:
@@ -322,50 +295,40 @@ rule generate_h5ad:
     output:
         data = "{sample}.counts.h5ad"
     input:
-        data = "{sample}.data.tsv.gz"
+        data = "{sample}.data." + data_ext
     threads: workflow.cores
     script: 
         "./scripts/generate_h5ad.py"
 
 
-rule get_preseq_vals:
-    """Prepare for running preseq"""
-    input:
-        data = "{sample}.data.tsv.gz"
-    output:
-        txt = temp("{sample}.vals.txt")
-    shell:
-        "zless {input.data} | tail -n+2 | cut -f 4 > {output.txt}"
-
-
 rule preseq:
-    """Run preseq to estimate library complexity"""
+    """Estimate library complexity in preseq format"""
     input:
-        txt = "{sample}.vals.txt"
+        stats = "{sample}.data.stats.json"
     output:
         txt = "log_files/{sample}.preseq.txt"
+    log: "log_files/{sample}.saturation.log"
     shell:
-        "preseq lc_extrap"
+        "dbspro saturation"
+        " {input.stats}"
         " -o {output.txt}"
-        " -V"
         " -e 1e+07"
-        " {input.txt}"
+        " 2> {log}"
+
 
 rule preseq_real_counts:
     """TSV with real counts for preseq MultiQC plot"""
     input:
-        data = expand("{sample}.data.tsv.gz", sample=samples["Sample"])
+        stats = expand("{sample}.data.stats.json", sample=samples["Sample"])
     output:
         tsv = "preseq_real_counts.tsv"
     run:
         with open(output.tsv, "w") as f:
             # Columns are: Sample name, number of reads, number of unique constructs.
-            for file in input.data:
-                sample = file.split(".")[0]
-                df = pd.read_csv(file, sep="\t")
-                reads = df["ReadCount"].sum()
-                constructs = len(df)
-                f.write(f"{sample}\t{reads}\t{constructs}\n")
+            for file in input.stats:
+                with open(file) as stats_file:
+                    stats = json.load(stats_file)
+                f.write(f"{stats['sample']}\t{stats['reads']}\t{stats['constructs']}\n")
 
 
 rule make_report:
@@ -374,7 +337,8 @@ rule make_report:
           html = "report.html",
           notebook = "report.ipynb",
     input:
-         data="data.tsv.gz"
+         data=f"data.{data_ext}",
+         stats=expand("{sample}.data.stats.json", sample=samples["Sample"])
     log: "log_files/make_report.log"
     run:
         with as_file(files("dbspro").joinpath("report_template.ipynb")) as report_path:
@@ -401,8 +365,7 @@ rule multiqc:
         dir=directory("multiqc_data")
     input:
         expand(rules.fastqc.output.zip, sample=samples["Sample"]),
-        expand(rules.fastqc_trimmed.output.zip, sample=samples["Sample"]),
-        expand(rules.trim_outer_handles.output.reads, sample=samples["Sample"]),
+        expand(rules.extract_dbs_abc_umi.output.dbs, sample=samples["Sample"]),
         expand(rules.preseq.output.txt, sample=samples["Sample"]),
         rules.preseq_real_counts.output.tsv,
     params:
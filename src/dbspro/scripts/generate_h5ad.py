@@ -1,5 +1,9 @@
 """
 Generate a h5ad file from the output of dbspro.
+
+The count matrix is built directly in sparse format from the integer-coded barcode and target of each row. The UMIs
+for each barcode and target are stored in `uns["target_umis"]` as arrays `obs_index`, `var_index` and `umi` with one
+entry per UMI, sorted by barcode and target.
 """
 
 import numpy as np
@@ -7,58 +11,47 @@ import pandas as pd
 import scanpy as sc
 from scipy.sparse import csr_matrix
 
-DTYPES = {
-    "Barcode": "object",
-    "Target": "object",
-    "UMI": "object",
-    "ReadCount": int,
-    "Sample": "category"
-}
+from dbspro.notebook import load_data
 
 
 def main(input_data, output_data):
-    data = pd.read_csv(input_data, sep="\t", dtype=DTYPES)
+    data = load_data(input_data)
+
+    barcode_codes, barcodes = pd.factorize(data["Barcode"], sort=True)
+    target_codes, targets = pd.factorize(data["Target"], sort=True)
 
-    counts = data.groupby(["Barcode", "Target"], as_index=False)["UMI"].count().set_index("Barcode")\
-        .pivot(columns="Target", values="UMI").fillna(0)
+    # Each row is a unique barcode, target and UMI combination so summing ones over duplicate entries gives UMI counts
+    X = csr_matrix((np.ones(len(data)), (barcode_codes, target_codes)), shape=(len(barcodes), len(targets)))
 
-    X = counts.values
-    var = pd.DataFrame(index=counts.columns.values)
-    obs = pd.DataFrame(index=counts.index)
+    var = pd.DataFrame(index=pd.Index(targets, dtype=str))
+    obs = pd.DataFrame(index=pd.Index(barcodes, dtype=str))
 
     # Add metadata
     # Get the total number of reads for each barcode
-    map_rc = data.groupby("Barcode")["ReadCount"].sum().to_dict()
-    obs["total_reads"] = obs.index.to_series().map(map_rc)
-    del map_rc
+    obs["total_reads"] = np.bincount(barcode_codes, weights=data["ReadCount"], minlength=len(barcodes))\
+        .astype(np.int64)
 
     # Get the total number of UMIs for each barcode
-    obs["total_umis"] = X.sum(axis=1)
+    obs["total_umis"] = np.asarray(X.sum(axis=1)).ravel()
 
     # Get the ratio of reads to UMIs for each barcode
     obs["reads_per_umi"] = obs["total_reads"] / obs["total_umis"]
 
     # Get the number of non-zero count targets for each barcode
-    obs["nr_targets"] = (X > 0).sum(axis=1)
-
-    # Get the set of unique UMIs for each target and each barcode
-    map_umis = data.groupby(["Barcode", "Target"], as_index=False)["UMI"]\
-        .apply(set)\
-        .set_index("Barcode")\
-        .pivot(columns="Target", values="UMI")\
-        .map(lambda x: {} if x is np.nan else x)\
-        .to_dict(orient="index")
-
-    map_umis = {k: ";".join(f"{t}:{','.join(v)}" for t, v in d.items() if v) for k, d in map_umis.items()}
-    obs["target_umis"] = obs.index.to_series().map(map_umis)
-    del map_umis
+    obs["nr_targets"] = np.diff(X.indptr)
 
     # Get the sample
     obs["sample"] = data["Sample"].iloc[0]
 
-    adata = sc.AnnData(X=csr_matrix(X), obs=obs, var=var)
-    adata.var_names = counts.columns.values
-    adata.obs_names = counts.index.values
+    # Get the UMIs for each barcode and target
+    order = np.lexsort((target_codes, barcode_codes))
+    target_umis = {
+        "obs_index": barcode_codes[order].astype(np.int32),
+        "var_index": target_codes[order].astype(np.int32),
+        "umi": data["UMI"].to_numpy()[order].astype(str),
+    }
+
+    adata = sc.AnnData(X=X, obs=obs, var=var, uns={"target_umis": target_umis})
 
     adata.write(output_data, compression="gzip")
 
@@ -1,13 +1,17 @@
 """
 Utility functions
 """
-from collections import Counter
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+import io
 import logging
 import sys
-from typing import Set
+from typing import Set, Iterator, Iterable, Callable, Optional, Tuple, Any, List, Sequence
 
 import dnaio
+import numpy as np
 import pandas as pd
+from xopen import xopen
 
 if sys.stderr.isatty():
     from tqdm import tqdm
@@ -34,6 +38,12 @@ IUPAC_MAP = {
     'V': {'G', 'C', 'A'},
     'N': {'G', 'C', 'T', 'A'}}
 
+# Lookup tables for 2-bit encoding of sequences. Invalid bases are encoded as 255.
+BASE_TO_CODE = np.full(256, 255, dtype=np.uint8)
+BASE_TO_CODE[np.frombuffer(b"ACGT", dtype=np.uint8)] = np.arange(4, dtype=np.uint8)
+CODE_TO_BASE = np.frombuffer(b"ACGT", dtype=np.uint8)
+MAX_PACKED_LENGTH = 32
+
 
 def get_abcs(abc_fasta_file: str) -> pd.DataFrame:
     """
@@ -92,3 +102,275 @@ class Summary(Counter):
 def jaccard_index(set1: Set[str], set2: Set[str]) -> float:
     """Calculate the Jaccard Index metric between two sets"""
     return len(set1 & set2) / len(set1 | set2)
+
+
+def read_chunks(file, buffer_size: int = 4 * 1024 ** 2, threads: int = 0) -> Iterator[bytes]:
+    """
+    Read FASTA/FASTQ file in raw chunks where each chunk only contain complete records.
+    :param file: Path to FASTA/FASTQ file, possibly compressed.
+    :param buffer_size: Size of chunks in bytes. Must be larger than the largest record.
+    :param threads: Threads used for decompression.
+    :return: Iterator over chunks.
+    """
+    with xopen(str(file), mode="rb", threads=threads) as f:
+        for chunk in dnaio.read_chunks(f, buffer_size):
+            # The memoryview is reused by dnaio so make a copy
+            yield bytes(chunk)
+
+
+def parse_chunk(chunk: bytes) -> Iterator[dnaio.SequenceRecord]:
+    """Parse records in chunk from read_chunks"""
+    with dnaio.open(io.BytesIO(chunk), mode="r") as reader:
+        yield from reader
+
+
+def format_records(records: Iterable[dnaio.SequenceRecord], fileformat: str = "fasta") -> bytes:
+    """Format records as FASTA/FASTQ in memory"""
+    buffer = io.BytesIO()
+    with dnaio.open(buffer, mode="w", fileformat=fileformat) as writer:
+        for record in records:
+            writer.write(record)
+    return buffer.getvalue()
+
+
+def parallel_map(func: Callable[[Any], Any], items: Iterable[Any], threads: int = 1,
+                 initializer: Optional[Callable] = None, initargs: Tuple = ()) -> Iterator[Any]:
+    """
+    Apply function to each item using a pool of worker processes and yield the results in input order. The number of
+    items submitted ahead of the result being written is bounded to keep memory use proportional to the number of
+    workers. Functions and arguments need to be picklable.
+    :param func: Function applied to each item.
+    :param items: Iterable of items, e.g. chunks from read_chunks.
+    :param threads: Number of worker processes. For one thread the items are processed in the current process.
+    :param initializer: Function called once in each worker before processing items, e.g. to set up shared state.
+    :param initargs: Arguments to initializer.
+    :return: Iterator over results.
+    """
+    if threads <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        yield from map(func, items)
+        return
+
+    max_pending = 2 * threads
+    with ProcessPoolExecutor(max_workers=threads, initializer=initializer, initargs=initargs) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+
+def encode_sequences(sequences: Sequence[str], length: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Pack DNA sequences of fixed length into 2-bit encoded unsigned 64-bit integers. The packed integers sort in the
+    same order as the sequences.
+    :param sequences: Sequences to encode.
+    :param length: Sequence length, at most 32 bp.
+    :return: Tuple with array of packed sequences and boolean array marking the sequences that could be encoded.
+    Sequences of other lengths or with other bases than A, C, G and T are invalid and set to 0.
+    """
+    if length > MAX_PACKED_LENGTH:
+        raise ValueError(f"Sequences longer than {MAX_PACKED_LENGTH} bp cannot be packed.")
+
+    nr_sequences = len(sequences)
+    valid = np.fromiter(map(len, sequences), dtype=np.int64, count=nr_sequences) == length
+    codes = np.zeros((nr_sequences, length), dtype=np.uint8)
+    if valid.any():
+        selected = sequences if valid.all() else [seq for seq, ok in zip(sequences, valid) if ok]
+        raw = np.frombuffer("".join(selected).encode("ascii", errors="replace"), dtype=np.uint8)
+        codes[valid] = BASE_TO_CODE[raw.reshape(len(selected), length)]
+        valid &= (codes != 255).all(axis=1)
+        codes[~valid] = 0
+
+    return pack_codes(codes), valid
+
+
+def pack_codes(codes: np.ndarray) -> np.ndarray:
+    """Pack 2-bit base codes of shape (nr_sequences, length) into unsigned 64-bit integers"""
+    keys = np.zeros(len(codes), dtype=np.uint64)
+    for column in codes.T:
+        keys <<= np.uint64(2)
+        keys |= column
+    return keys
+
+
+def unpack_codes(keys: np.ndarray, length: int) -> np.ndarray:
+    """Unpack unsigned 64-bit integers into 2-bit base codes of shape (nr_sequences, length)"""
+    keys = np.asarray(keys, dtype=np.uint64)
+    codes = np.empty((len(keys), length), dtype=np.uint8)
+    for i in range(length):
+        codes[:, length - 1 - i] = (keys >> np.uint64(2 * i)) & np.uint64(3)
+    return codes
+
+
+def decode_sequences(keys: np.ndarray, length: int) -> List[str]:
+    """Decode 2-bit encoded sequences from encode_sequences"""
+    bases = CODE_TO_BASE[unpack_codes(keys, length)]
+    return bases.view(f"S{length}").ravel().astype(f"U{length}").tolist()
+
+
+# Packed sequences of variable length are marked by setting the bit above the 2-bit codes.
+MAX_VARIABLE_PACKED_LENGTH = MAX_PACKED_LENGTH - 1
+_LENGTH_BITS = np.left_shift(np.uint64(1), 2 * np.arange(MAX_VARIABLE_PACKED_LENGTH + 1, dtype=np.uint64))
+
+
+def encode_variable_length(sequences: Sequence[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Pack DNA sequences of different lengths into unsigned 64-bit integers. The bit above the 2-bit encoded bases is
+    set to mark the sequence length so that sequences of different lengths get distinct keys.
+    :param sequences: Sequences to encode, at most 31 bp.
+    :return: Tuple with array of packed sequences and boolean array marking the sequences that could be encoded.
+    Empty sequences or sequences with other bases than A, C, G and T are invalid.
+    :raises ValueError: If any sequence is longer than 31 bp.
+    """
+    lengths = np.fromiter(map(len, sequences), dtype=np.int64, count=len(sequences))
+    if len(lengths) and lengths.max() > MAX_VARIABLE_PACKED_LENGTH:
+        raise ValueError(f"Sequences longer than {MAX_VARIABLE_PACKED_LENGTH} bp cannot be packed, got sequence of "
+                         f"length {lengths.max()}.")
+
+    keys = np.zeros(len(sequences), dtype=np.uint64)
+    valid = np.zeros(len(sequences), dtype=bool)
+    for length in np.unique(lengths):
+        if length == 0:
+            continue
+        selected = np.flatnonzero(lengths == length)
+        length_keys, length_valid = encode_sequences([sequences[i] for i in selected], int(length))
+        keys[selected] = length_keys | _LENGTH_BITS[length]
+        valid[selected] = length_valid
+    return keys, valid
+
+
+def packed_lengths(keys: np.ndarray) -> np.ndarray:
+    """Return sequence lengths of keys from encode_variable_length"""
+    return np.searchsorted(_LENGTH_BITS, np.asarray(keys, dtype=np.uint64), side="right") - 1
+
+
+def decode_variable_length(keys: np.ndarray) -> List[str]:
+    """Decode sequences from encode_variable_length"""
+    keys = np.asarray(keys, dtype=np.uint64)
+    lengths = packed_lengths(keys)
+    sequences = np.empty(len(keys), dtype=object)
+    for length in np.unique(lengths):
+        selected = lengths == length
+        sequences[selected] = decode_sequences(keys[selected] ^ _LENGTH_BITS[length], int(length))
+    return sequences.tolist()
+
+
+class BarcodePattern:
+    """
+    IUPAC barcode pattern compiled into a bitmask of the allowed bases at each position, so that many sequences can be
+    matched at once using NumPy.
+    """
+    def __init__(self, pattern: str):
+        self.pattern = pattern.upper()
+        # Bit i is set if the base with 2-bit code i is allowed
+        self._allowed = np.array([sum(1 << int(BASE_TO_CODE[ord(base)]) for base in IUPAC_MAP[symbol])
+                                  for symbol in self.pattern], dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.pattern)
+
+    def __call__(self, sequence: str) -> bool:
+        return bool(self.match([sequence])[0])
+
+    def match(self, sequences: Sequence[str]) -> np.ndarray:
+        """Return boolean array marking sequences matching the pattern"""
+        length = len(self)
+        matches = np.fromiter(map(len, sequences), dtype=np.int64, count=len(sequences)) == length
+        if matches.any():
+            selected = sequences if matches.all() else [seq for seq, ok in zip(sequences, matches) if ok]
+            raw = np.frombuffer("".join(selected).encode("ascii", errors="replace"), dtype=np.uint8)
+            matches[matches] = self._match_codes(BASE_TO_CODE[raw.reshape(len(selected), length)])
+        return matches
+
+    def _match_codes(self, codes: np.ndarray) -> np.ndarray:
+        # Invalid bases are encoded as 255 and do not match any position
+        bits = np.where(codes < 4, np.left_shift(np.uint8(1), codes & np.uint8(3)), np.uint8(0))
+        return ((bits & self._allowed) != 0).all(axis=1)
+
+
+def iter_equal_key_pairs(keys: np.ndarray, batch_size: int) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Yield arrays of indices i and j for all pairs of positions with equal keys, each pair given once. Pairs are
+    enumerated group by group in batches of at most batch_size pairs, so memory use does not depend on the total
+    number of pairs.
+    """
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    group_ends = np.searchsorted(sorted_keys, sorted_keys, side="right")
+    nr_pairs = group_ends - np.arange(len(keys)) - 1
+    ends = np.cumsum(nr_pairs)
+    total = int(ends[-1]) if len(ends) else 0
+    for start in range(0, total, batch_size):
+        positions = np.arange(start, min(start + batch_size, total))
+        first = np.searchsorted(ends, positions, side="right")
+        second = first + 1 + positions - (ends[first] - nr_pairs[first])
+        yield order[first], order[second]
+
+
+def equal_key_pairs(keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Return arrays of indices i and j for all pairs of positions with equal keys, each pair given once"""
+    batches = list(iter_equal_key_pairs(keys, 1_000_000))
+    if not batches:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    return np.concatenate([i for i, _ in batches]), np.concatenate([j for _, j in batches])
+
+
+class HammingIndex:
+    """
+    Index for finding all pairs of equal-length sequences within a Hamming distance. Sequences are split into at least
+    distance + 1 segments. By the pigeonhole principle, sequences within the distance are identical in at least one
+    segment, so candidates are pairs sharing a packed segment key. Candidates are verified by counting mismatches.
+    """
+    BATCH_SIZE = 1_000_000
+
+    def __init__(self, sequences: Sequence[str], distance: int):
+        self.sequences = list(sequences)
+        self.distance = distance
+        lengths = set(map(len, self.sequences))
+        if len(lengths) > 1:
+            raise ValueError("All sequences must have the same length.")
+        self.length = lengths.pop() if lengths else 0
+
+        raw = np.frombuffer("".join(self.sequences).encode("ascii", errors="replace"), dtype=np.uint8)
+        # Characters are coded by their rank so that ACGT sequences use 2 bits per base in segment keys.
+        alphabet, codes = np.unique(raw, return_inverse=True)
+        self._codes = codes.astype(np.uint8).reshape(len(self.sequences), self.length)
+        bits = max(int(np.ceil(np.log2(max(len(alphabet), 2)))), 1)
+        max_segment_length = 64 // bits
+        nr_segments = min(max(distance + 1, -(-self.length // max_segment_length)), max(self.length, 1))
+        bounds = np.linspace(0, self.length, nr_segments + 1).astype(int)
+
+        self._segment_keys = []
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            keys = np.zeros(len(self.sequences), dtype=np.uint64)
+            for column in self._codes[:, start:stop].T:
+                keys <<= np.uint64(bits)
+                keys |= column
+            self._segment_keys.append(keys)
+
+    def pairs(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Return arrays of indices i < j for all pairs of sequences within the Hamming distance"""
+        if self.length <= self.distance:
+            return np.triu_indices(len(self.sequences), k=1)
+
+        first = []
+        second = []
+        for segment, keys in enumerate(self._segment_keys):
+            for i, j in iter_equal_key_pairs(keys, self.BATCH_SIZE):
+                # Pairs sharing an earlier segment were already found
+                new = np.ones(len(i), dtype=bool)
+                for earlier in self._segment_keys[:segment]:
+                    new &= earlier[i] != earlier[j]
+                i = i[new]
+                j = j[new]
+                within = (self._codes[i] != self._codes[j]).sum(axis=1) <= self.distance
+                first.append(np.minimum(i[within], j[within]))
+                second.append(np.maximum(i[within], j[within]))
+        if not first:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        return np.concatenate(first), np.concatenate(second)
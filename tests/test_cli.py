@@ -1,6 +1,5 @@
 from pathlib import Path
 import pytest
-import os
 
 import pandas as pd
 from dbspro.__main__ import main as dbspro_main
@@ -22,13 +21,6 @@ DBS_PRO_V3_ABC_SEQUENCES = DBS_PRO_V3_DIR / "ABCs.fasta"
 EXPECTED_OUTPUT_FILES = ["report.ipynb", "data.tsv.gz", "multiqc_report.html"]
 
 
-@pytest.fixture(scope="session", autouse=True)
-def execute_before_any_test():
-    # Set PYTHONHASHSEED to 1 to make sure that the hash of a dictionary is the same
-    # Usually UMI-tools will differ in output unless this is set
-    os.environ["PYTHONHASHSEED"] = "1"
-
-
 def test_init(tmpdir):
     workdir = tmpdir / "analysis"
     init(workdir, [DBS_PRO_V1_SAMPLE1_READS], DBS_PRO_V1_ABC_SEQUENCES)
@@ -111,7 +103,7 @@ def test_output_tsv_correct_dbspro_v1(workdir_dbspro_v1):
 
     assert len(set(data["Sample"])) == 3, "Should be 3 samples"
     assert len(set(data["Target"])) == 3, "Should be 3 targets"
-    assert len(data) == 2499, "Should be 2495 rows"
+    assert len(data) == 2499, "Should be 2499 rows"
     assert sum(data["ReadCount"]) == 52998, "Should be 52998 reads"
     assert len(set(data["Barcode"])) == 2378, "Should be 2378 unique barcodes"
 
@@ -119,11 +111,11 @@ def test_output_tsv_correct_dbspro_v1(workdir_dbspro_v1):
 def test_output_tsv_correct_dbspro_v3(workdir_dbspro_v3):
     data = pd.read_csv(workdir_dbspro_v3 / "data.tsv.gz", sep="\t")
 
-    assert len(set(data["Sample"])) == 1, "Should be 3 samples"
-    assert len(set(data["Target"])) == 7, "Should be 3 targets"
+    assert len(set(data["Sample"])) == 1, "Should be 1 sample"
+    assert len(set(data["Target"])) == 7, "Should be 7 targets"
     assert len(data) == 3374, "Should be 3374 rows"
     assert sum(data["ReadCount"]) == 16482, "Should be 16482 reads"
-    assert len(set(data["Barcode"])) == 2287, "Should be 2378 unique barcodes"
+    assert len(set(data["Barcode"])) == 2287, "Should be 2287 unique barcodes"
 
 
 def test_version_exit_code_zero():
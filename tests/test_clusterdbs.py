@@ -0,0 +1,138 @@
+from collections import defaultdict
+import random
+import tracemalloc
+
+import numpy as np
+import pytest
+
+from dbspro.cli.clusterdbs import find_parents, edit_distances, PigeonholeIndex
+from dbspro.utils import encode_variable_length, decode_variable_length, encode_sequences, unpack_codes
+
+
+def levenshtein(a: str, b: str) -> int:
+    previous = list(range(len(b) + 1))
+    for i, base_a in enumerate(a, start=1):
+        current = [i]
+        for j, base_b in enumerate(b, start=1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (base_a != base_b)))
+        previous = current
+    return previous[-1]
+
+
+def mutate(rng: random.Random, sequence: str, nr_edits: int) -> str:
+    for _ in range(nr_edits):
+        position = rng.randrange(len(sequence))
+        edit = rng.choice(["substitution", "insertion", "deletion"])
+        if edit == "substitution":
+            sequence = sequence[:position] + rng.choice("ACGT") + sequence[position + 1:]
+        elif edit == "insertion":
+            sequence = sequence[:position] + rng.choice("ACGT") + sequence[position:]
+        else:
+            sequence = sequence[:position] + sequence[position + 1:]
+    return sequence
+
+
+def random_counts(rng: random.Random, nr_parents: int, nr_children: int, length: int, distance: int):
+    """Return sorted packed sequences with counts where children are parents with substitutions and indels"""
+    parents = ["".join(rng.choice("ACGT") for _ in range(length)) for _ in range(nr_parents)]
+    counts = {parent: rng.randint(5, 100) for parent in parents}
+    for _ in range(nr_children):
+        child = mutate(rng, rng.choice(parents), rng.randint(1, distance + 1))
+        counts.setdefault(child, rng.randint(1, 20))
+
+    keys, valid = encode_variable_length(list(counts))
+    assert valid.all()
+    order = np.argsort(keys)
+    return keys[order], np.array(list(counts.values()), dtype=np.uint64)[order]
+
+
+def brute_force_parents(keys, counts, distance, cluster_ratio):
+    sequences = decode_variable_length(keys)
+    parents = np.arange(len(keys))
+    for i, sequence in enumerate(sequences):
+        candidates = [
+            j for j, other in enumerate(sequences)
+            if j != i and counts[j] >= cluster_ratio * counts[i] and (counts[j] > counts[i] or keys[j] < keys[i])
+            and levenshtein(sequence, other) <= distance
+        ]
+        if candidates:
+            parents[i] = min(candidates, key=lambda j: (-int(counts[j]), int(keys[j])))
+    return parents
+
+
+@pytest.mark.parametrize("distance", [1, 2, 3])
+@pytest.mark.parametrize("cluster_ratio", [1, 5])
+def test_find_parents_matches_brute_force(distance, cluster_ratio):
+    rng = random.Random(distance * 10 + cluster_ratio)
+    for length in [8, 11, 14]:
+        keys, counts = random_counts(rng, nr_parents=15, nr_children=100, length=length, distance=distance)
+        expected = brute_force_parents(keys, counts, distance, cluster_ratio)
+
+        assert find_parents(keys, counts, distance, cluster_ratio).tolist() == expected.tolist()
+
+
+def test_find_parents_threaded():
+    rng = random.Random(1)
+    keys, counts = random_counts(rng, nr_parents=20, nr_children=200, length=12, distance=2)
+
+    assert find_parents(keys, counts, 2, 5, threads=2).tolist() == find_parents(keys, counts, 2, 5).tolist()
+
+
+def test_pigeonhole_index_finds_shifted_indel_neighbors():
+    distance = 2
+    sequences = ["ACGTTGCAAC", "CGTTGCAAC", "AACGTTGCAAC", "ACGTGCAACT", "TTACGTTGCAAC", "GGGGGGGGGG"]
+    keys, _ = encode_variable_length(sequences)
+    index = PigeonholeIndex(keys, distance)
+
+    query_keys, _ = encode_variable_length(["ACGTTGCAAC"])
+    _, hits = index.query(query_keys)
+
+    found = sorted(sequences[i] for i in hits.tolist())
+    expected = sorted(sequence for sequence in sequences if levenshtein("ACGTTGCAAC", sequence) <= distance)
+    assert found == expected
+    # Sequences with indels at the start only share the later segments after shifting
+    assert {"CGTTGCAAC", "AACGTTGCAAC", "TTACGTTGCAAC"} <= set(found)
+
+
+def test_edit_distances_matches_levenshtein():
+    rng = random.Random(0)
+    max_distance = 2
+    pairs = defaultdict(list)
+    for _ in range(2000):
+        a = "".join(rng.choice("ACGT") for _ in range(10))
+        b = mutate(rng, a, rng.randint(0, 4))
+        pairs[(len(a), len(b))].append((a, b))
+
+    for (length_a, length_b), group in pairs.items():
+        codes_a = unpack_codes(encode_sequences([a for a, _ in group], length_a)[0], length_a)
+        codes_b = unpack_codes(encode_sequences([b for _, b in group], length_b)[0], length_b)
+
+        expected = [min(levenshtein(a, b), max_distance + 1) for a, b in group]
+        assert edit_distances(codes_a, codes_b, max_distance).tolist() == expected
+
+
+def test_pigeonhole_index_memory_bounded_by_batch_size(monkeypatch):
+    # All sequences share the first segment so every query is a candidate for every indexed sequence
+    rng = random.Random(0)
+    distance = 2
+    sequences = ["AAAA" + "".join(rng.choice("ACGT") for _ in range(8)) for _ in range(3000)]
+    keys, _ = encode_variable_length(sequences)
+    index = PigeonholeIndex(keys[:1500], distance)
+    query_keys = keys[1500:]
+    nr_candidates = len(index.keys) * len(query_keys)
+    monkeypatch.setattr(PigeonholeIndex, "BATCH_SIZE", 10_000)
+
+    tracemalloc.start()
+    queries, hits = index.query(query_keys)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    # Holding all candidate pairs at once would take at least 16 bytes per pair
+    assert peak < nr_candidates * 16 / 4
+    expected = []
+    codes = unpack_codes(index.keys, 12)
+    for i, query_code in enumerate(unpack_codes(query_keys, 12)):
+        distances = edit_distances(np.repeat(query_code[None, :], len(codes), axis=0), codes, distance)
+        expected.extend((i, j) for j in np.flatnonzero(distances <= distance).tolist())
+    assert list(zip(queries.tolist(), hits.tolist())) == expected
+    assert len(expected) > 0
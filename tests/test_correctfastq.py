@@ -0,0 +1,66 @@
+import random
+import statistics
+
+import numpy as np
+import pytest
+
+from dbspro.cli.correctfastq import Histogram, CorrectionTable
+from dbspro.utils import encode_variable_length
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_histogram_matches_statistics(seed):
+    rng = random.Random(seed)
+    values = [rng.choice([1, 1, 2, 3, 10, 1000]) for _ in range(rng.randint(1, 50))]
+    histogram = Histogram()
+    for value in values[:len(values) // 2]:
+        histogram.add(value)
+    histogram.update(np.array(values[len(values) // 2:]))
+
+    assert len(histogram) == len(values)
+    for result, expected in [(histogram.mean(), statistics.mean(values)),
+                             (histogram.median(), statistics.median(values))]:
+        assert result == expected
+        assert type(result) is type(expected)
+    assert histogram.max() == max(values)
+    assert histogram.count(1) == values.count(1)
+
+
+def test_correction_table_round_trip(tmp_path):
+    corrections = {
+        "ACGTACGT": "ACGTACGA",
+        "ACGTACGA": "ACGTACGA",
+        "TTTTGGGGCC": "TTTTGGGGCA",
+        "A" * 31: "C" * 31,
+        "G": "GG",
+    }
+    raw, _ = encode_variable_length(list(corrections) + ["ACGTACGT"])
+    corrected, _ = encode_variable_length(list(corrections.values()) + ["CCCCCCCC"])
+
+    table = CorrectionTable.write(tmp_path / "table.npy", raw, corrected)
+    reloaded = CorrectionTable(tmp_path / "table.npy")
+
+    assert len(reloaded) == len(corrections)
+    assert isinstance(reloaded.raw, np.memmap)
+    assert reloaded.raw.dtype == np.uint64
+    assert np.all(reloaded.raw[1:] > reloaded.raw[:-1])
+    # The last correction is kept for duplicate raw sequences
+    missing = ["ACGTACGC", "TTTTGGGGCA", "ACGTNCGT", "", "GG", "T" * 31]
+    queries = list(corrections) + missing
+    expected = [corrections.get(sequence) for sequence in queries]
+    expected[0] = "CCCCCCCC"
+    assert table.correct(queries) == expected
+    assert reloaded.correct(queries) == expected
+
+    keys, _ = encode_variable_length(queries)
+    corrected_keys, found = reloaded.lookup(keys)
+    assert found.tolist() == [sequence in corrections for sequence in queries]
+    assert np.all(corrected_keys[~found] == 0)
+
+
+def test_empty_correction_table(tmp_path):
+    empty = np.empty(0, dtype=np.uint64)
+    table = CorrectionTable.write(tmp_path / "table.npy", empty, empty)
+
+    assert len(table) == 0
+    assert table.correct(["ACGT", ""]) == [None, None]
@@ -0,0 +1,65 @@
+import random
+from collections import Counter
+
+import numpy as np
+import pytest
+
+from dbspro.cli import countdbs
+from dbspro.cli.countdbs import run_countdbs
+from dbspro.utils import decode_variable_length
+
+
+@pytest.fixture(scope="module")
+def reads_file(tmp_path_factory):
+    rng = random.Random(0)
+    # A pool smaller than the number of reads gives duplicates both within and across chunks
+    pool = ["".join(rng.choice("ACGT") for _ in range(rng.choice([12, 14]))) for _ in range(60_000)]
+    pool.extend(["ACGTNACGTACG", ""])
+    sequences = rng.choices(pool, k=300_000)
+    path = tmp_path_factory.mktemp("countdbs") / "dbs.fasta"
+    with open(path, "w") as file:
+        for i, sequence in enumerate(sequences):
+            print(f">read{i}\n{sequence}", file=file)
+    # Empty records and records with N are not counted
+    expected = Counter(sequence for sequence in sequences if sequence and "N" not in sequence)
+    return path, expected
+
+
+def load_output(path):
+    if str(path).endswith(".npy"):
+        counts = np.load(path)
+        return dict(zip(decode_variable_length(counts["sequence"]), counts["count"].tolist()))
+    counts = {}
+    with open(path) as file:
+        for line in file:
+            sequence, count = line.split("\t")
+            assert sequence not in counts
+            counts[sequence] = int(count)
+    return counts
+
+
+@pytest.mark.parametrize("threads", [1, 2])
+@pytest.mark.parametrize("suffix", [".tsv", ".npy"])
+@pytest.mark.parametrize("max_memory", [1, 4096])
+def test_countdbs_matches_counter(tmp_path, monkeypatch, reads_file, threads, suffix, max_memory):
+    path, expected = reads_file
+    spilled = []
+    spill_counts = countdbs.spill_counts
+
+    def record_spill(counts, directory, index):
+        spilled.append(len(counts))
+        return spill_counts(counts, directory, index)
+
+    monkeypatch.setattr(countdbs, "spill_counts", record_spill)
+    output = tmp_path / f"counts{suffix}"
+
+    run_countdbs(str(path), str(output), max_memory=max_memory, tmpdir=str(tmp_path), threads=threads)
+
+    assert load_output(output) == expected
+    if max_memory == 1:
+        # Several runs are spilled and merged in more than one block
+        entries_per_block = 1024 ** 2 // (2 * countdbs.COUNTS_DTYPE.itemsize)
+        assert len(spilled) > 1
+        assert sum(spilled) > entries_per_block
+    else:
+        assert not spilled
@@ -0,0 +1,83 @@
+import random
+import subprocess
+import sys
+
+import dnaio
+import pytest
+
+from dbspro.cli.demultiplex import run_demultiplex, ABCDemultiplexer
+
+ABCS = {"ABC1": "ACGTACGTAC", "ABC2": "TTGGCCAATT", "ABC3": "ACGTACGTGG"}
+
+
+def substitute(sequence: str, position: int) -> str:
+    base = "A" if sequence[position] != "A" else "C"
+    return sequence[:position] + base + sequence[position + 1:]
+
+
+@pytest.fixture
+def fixture_files(tmp_path):
+    rng = random.Random(0)
+    prefixes = []
+    for sequence in ABCS.values():
+        # Exact match, matches with one mismatch and unmatched with two mismatches
+        prefixes.append(sequence)
+        prefixes.extend(substitute(sequence, position) for position in [0, 4, 9])
+        prefixes.append(substitute(substitute(sequence, 0), 1))
+    # One mismatch from both ABC1 and ABC3
+    prefixes.append("ACGTACGTAG")
+    prefixes.append("GGGGGGGGGG")
+
+    abc_file = tmp_path / "abc.fasta"
+    with open(abc_file, "w") as file:
+        for name, sequence in ABCS.items():
+            print(f">{name}\n^{sequence}", file=file)
+
+    reads_file = tmp_path / "reads.fasta"
+    with open(reads_file, "w") as file:
+        for i, prefix in enumerate(prefixes):
+            umi = "".join(rng.choice("ACGT") for _ in range(6))
+            print(f">read{i} DBS{i}\n{prefix}{umi}", file=file)
+    return abc_file, reads_file
+
+
+def read_records(path):
+    with dnaio.open(path) as reader:
+        return [(record.name, record.sequence) for record in reader]
+
+
+def report_summary(report: str) -> str:
+    """Return report from the summary section on, skipping lines with run details"""
+    return report[report.index("=== Summary ==="):]
+
+
+@pytest.mark.parametrize("discard_untrimmed", [False, True])
+def test_demultiplex_matches_cutadapt(tmp_path, fixture_files, capsys, discard_untrimmed):
+    abc_file, reads_file = fixture_files
+    command = [sys.executable, "-m", "cutadapt", "-g", f"file:{abc_file}", "--no-indels", "-e", "0.1",
+               "-o", str(tmp_path / "cutadapt.{name}.fasta"), str(reads_file)]
+    if discard_untrimmed:
+        command.append("--discard-untrimmed")
+    cutadapt_report = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+
+    run_demultiplex(str(reads_file), str(abc_file), str(tmp_path / "dbspro.{name}.fasta"), error_rate=0.1,
+                    discard_untrimmed=discard_untrimmed)
+    report = capsys.readouterr().out
+
+    names = list(ABCS) + ([] if discard_untrimmed else ["unknown"])
+    for name in names:
+        assert read_records(tmp_path / f"dbspro.{name}.fasta") == \
+            read_records(tmp_path / f"cutadapt.{name}.fasta"), name
+    assert report_summary(report) == report_summary(cutadapt_report)
+    assert report.startswith("This is cutadapt")
+
+
+def test_demultiplexer_classification():
+    demultiplexer = ABCDemultiplexer(list(ABCS.values()), error_rate=0.1)
+
+    assert demultiplexer("ACGTACGTACGGG") == (0, 0)
+    assert demultiplexer("TTGGCAAATTGGG") == (1, 1)
+    # Ambiguous between ABC1 and ABC3
+    assert demultiplexer("ACGTACGTAGGGG") == (None, None)
+    assert demultiplexer("AAGTACGTAAGGG") == (None, None)
+    assert demultiplexer.ambiguous == 2
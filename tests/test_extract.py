@@ -0,0 +1,64 @@
+import random
+import subprocess
+import sys
+
+import pytest
+
+from dbspro.cli.extract import run_extract
+
+H1 = "CGATGCTAATCAGATCA"
+H2 = "AAGAGTCAATAGACCATCTAACAGGATTCAGGTA"
+H3 = "CATTGCGCAATCTGCAGTAC"
+
+
+def random_sequence(rng: random.Random, length: int) -> str:
+    return "".join(rng.choice("ACGT") for _ in range(length))
+
+
+def mutate(rng: random.Random, sequence: str, nr_substitutions: int) -> str:
+    sequence = list(sequence)
+    for position in rng.sample(range(len(sequence)), nr_substitutions):
+        sequence[position] = rng.choice("ACGT".replace(sequence[position], ""))
+    return "".join(sequence)
+
+
+@pytest.fixture
+def reads_file(tmp_path):
+    rng = random.Random(0)
+    path = tmp_path / "reads.fastq"
+    with open(path, "w") as file:
+        for i in range(500):
+            insert = random_sequence(rng, 20) + H2 + random_sequence(rng, 12 + rng.choice([0, 0, 0, -10, 10]))
+            if rng.random() < 0.1:
+                position = rng.randrange(len(insert))
+                insert = insert[:position] + "N" + insert[position + 1:]
+            read = mutate(rng, H1, rng.randint(0, 4)) + insert + mutate(rng, H3, rng.randint(0, 5))
+            if rng.random() < 0.2:
+                read = random_sequence(rng, len(read))
+            print(f"@read{i}\n{read}\n+\n{'I' * len(read)}", file=file)
+    return path
+
+
+def report_summary(report: str) -> str:
+    """Return summary section of report, skipping lines with run details and adapter statistics"""
+    start = report.index("=== Summary ===")
+    end = report.index("Total written (filtered):")
+    return report[start:report.index("\n", end)]
+
+
+@pytest.mark.parametrize("max_len", [None, 70])
+def test_extract_report_matches_cutadapt(tmp_path, reads_file, capsys, max_len):
+    min_len = 60
+    command = [sys.executable, "-m", "cutadapt", "-g", f"^{H1}...{H3}", "-e", "0.2", "-m", str(min_len),
+               "--max-n", "0", "-O", "5", "-o", str(tmp_path / "trimmed.fastq"), str(reads_file)]
+    if max_len is not None:
+        command.extend(["-M", str(max_len)])
+    cutadapt_report = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+
+    run_extract(str(reads_file), str(tmp_path / "dbs.fasta"), str(tmp_path / "abc_umi.fasta"), h1=H1, h2=H2, h3=H3,
+                dbs_len=20, abc_umi_len=12, error_rate=0.2, dbs_error_rate=0.1, min_len=min_len, max_len=max_len,
+                overlap=5)
+    report = capsys.readouterr().out
+
+    assert report.startswith("This is cutadapt")
+    assert report_summary(report) == report_summary(cutadapt_report)
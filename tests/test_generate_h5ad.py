@@ -0,0 +1,59 @@
+import random
+
+import numpy as np
+import pandas as pd
+import pytest
+
+anndata = pytest.importorskip("anndata")
+pytest.importorskip("scanpy")
+
+from dbspro.scripts.generate_h5ad import main as generate_h5ad  # noqa: E402
+
+
+def dense_counts(data: pd.DataFrame) -> pd.DataFrame:
+    """Count matrix built as a dense pivot table as before the sparse construction"""
+    return data.groupby(["Barcode", "Target"], as_index=False)["UMI"].count().set_index("Barcode")\
+        .pivot(columns="Target", values="UMI").fillna(0)
+
+
+@pytest.fixture
+def data_file(tmp_path):
+    rng = random.Random(0)
+    rows = set()
+    for _ in range(300):
+        barcode = "".join(rng.choice("ACGT") for _ in range(6))
+        umi = "".join(rng.choice("ACGT") for _ in range(4))
+        rows.add((barcode, rng.choice(["ABC1", "ABC2", "ABC3", "ABC4"]), umi, rng.randint(1, 20), "sample1"))
+    data = pd.DataFrame(sorted(rows), columns=["Barcode", "Target", "UMI", "ReadCount", "Sample"])
+    path = tmp_path / "data.tsv"
+    data.to_csv(path, sep="\t", index=False)
+    return path, data
+
+
+def test_generate_h5ad_matches_dense_construction(tmp_path, data_file):
+    path, data = data_file
+    generate_h5ad(path, tmp_path / "data.h5ad")
+
+    adata = anndata.read_h5ad(tmp_path / "data.h5ad")
+
+    counts = dense_counts(data)
+    assert adata.obs_names.tolist() == counts.index.tolist()
+    assert adata.var_names.tolist() == counts.columns.tolist()
+    assert np.array_equal(adata.X.toarray(), counts.values)
+
+    read_counts = data.groupby("Barcode")["ReadCount"].sum()
+    assert adata.obs["total_reads"].tolist() == read_counts[counts.index].tolist()
+    assert adata.obs["total_umis"].tolist() == counts.values.sum(axis=1).tolist()
+    assert np.allclose(adata.obs["reads_per_umi"], read_counts[counts.index] / counts.values.sum(axis=1))
+    assert adata.obs["nr_targets"].tolist() == (counts.values > 0).sum(axis=1).tolist()
+    assert set(adata.obs["sample"]) == {"sample1"}
+
+    # UMIs for each barcode and target as given by the former per-barcode "target_umis" strings
+    target_umis = adata.uns["target_umis"]
+    umis = {}
+    for obs_index, var_index, umi in zip(target_umis["obs_index"], target_umis["var_index"], target_umis["umi"]):
+        umis.setdefault((adata.obs_names[obs_index], adata.var_names[var_index]), set()).add(umi)
+    expected = data.groupby(["Barcode", "Target"])["UMI"].apply(set).to_dict()
+    assert umis == expected
+    assert len(target_umis["umi"]) == len(data)
+    assert np.all(np.diff(target_umis["obs_index"]) >= 0)
@@ -0,0 +1,117 @@
+import json
+import random
+
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+
+from dbspro.cli import integrate
+from dbspro.cli.integrate import run_analysis, iter_batches
+from dbspro.notebook import load_data
+
+TARGETS = ["ABC1", "ABC2"]
+
+
+def random_sequence(rng: random.Random, length: int) -> str:
+    return "".join(rng.choice("ACGT") for _ in range(length))
+
+
+@pytest.fixture
+def reads():
+    """Return rows of barcode, target and UMI for each read, sorted by barcode"""
+    rng = random.Random(0)
+    barcodes = sorted(random_sequence(rng, 8) for _ in range(50))
+    umis = [random_sequence(rng, 6) for _ in range(10)]
+    rows = []
+    for barcode in barcodes:
+        for _ in range(rng.randint(1, 15)):
+            rows.append((barcode, rng.choice(TARGETS), rng.choice(umis)))
+    return rows
+
+
+def write_target_files(directory, reads):
+    """Write per-target FASTA files as from the per-target workflow and return their paths"""
+    paths = []
+    for target in TARGETS:
+        path = directory / f"sample.{target}.fasta"
+        with open(path, "w") as file:
+            for i, (barcode, read_target, umi) in enumerate(reads):
+                if read_target == target:
+                    print(f">read{i} {barcode}\n{umi}", file=file)
+        paths.append(path)
+    return paths
+
+
+def expected_data(reads):
+    data = pd.DataFrame(reads, columns=["Barcode", "Target", "UMI"])
+    data = data.groupby(["Barcode", "Target", "UMI"]).size().rename("ReadCount").reset_index()
+    data["Sample"] = "sample"
+    return data
+
+
+def test_iter_batches_keeps_barcode_groups_together(reads):
+    rows = [(barcode, target, umi, 1) for barcode, target, umi in reads]
+    batches = list(iter_batches(iter(rows), 7))
+
+    assert [row for batch in batches for row in batch] == rows
+    assert all(len(batch) >= 7 for batch in batches[:-1])
+    barcodes = [{row[0] for row in batch} for batch in batches]
+    assert sum(map(len, barcodes)) == len(set().union(*barcodes))
+
+
+@pytest.mark.parametrize("batch_size", [1, 7, 100_000])
+def test_integrate_aggregates_across_batches(tmp_path, monkeypatch, reads, batch_size):
+    monkeypatch.setattr(integrate, "BATCH_SIZE", batch_size)
+    target_files = write_target_files(tmp_path, reads)
+
+    run_analysis(target_files, tmp_path / "data.tsv", barcode_pattern=None)
+
+    data = pd.read_csv(tmp_path / "data.tsv", sep="\t")
+    expected = expected_data(reads)
+    assert data.equals(expected[data.columns])
+
+
+def test_integrate_rejects_unsorted_input(tmp_path, reads):
+    target_files = write_target_files(tmp_path, reads[::-1])
+
+    with pytest.raises(ValueError, match="not sorted"):
+        run_analysis(target_files, tmp_path / "data.tsv", barcode_pattern=None)
+
+
+@pytest.mark.parametrize("batch_size", [1, 7, 100_000])
+def test_integrate_stats_match_output(tmp_path, monkeypatch, reads, batch_size):
+    monkeypatch.setattr(integrate, "BATCH_SIZE", batch_size)
+    target_files = write_target_files(tmp_path, reads)
+
+    # Filtering by barcode pattern is applied before computing the statistics
+    run_analysis(target_files, tmp_path / "data.tsv", barcode_pattern="NNNNNNNH", stats=tmp_path / "stats.json")
+
+    data = pd.read_csv(tmp_path / "data.tsv", sep="\t")
+    with open(tmp_path / "stats.json") as file:
+        stats = json.load(file)
+    assert 0 < len(data) < len(expected_data(reads))
+    assert stats["sample"] == "sample"
+    assert stats["reads"] == data["ReadCount"].sum()
+    assert stats["constructs"] == len(data)
+    assert stats["barcodes"] == data["Barcode"].nunique()
+    assert stats["targets"] == {
+        target: {"reads": int(group["ReadCount"].sum()), "constructs": len(group)}
+        for target, group in data.groupby("Target")
+    }
+    assert stats["read_count_histogram"] == [list(item) for item in sorted(data["ReadCount"].value_counts().items())]
+
+
+@pytest.mark.parametrize("columns", [None, ["Barcode", "UMI", "ReadCount"]])
+def test_parquet_output_loads_as_tsv(tmp_path, monkeypatch, reads, columns):
+    # Several row groups with separate dictionaries
+    monkeypatch.setattr(integrate, "BATCH_SIZE", 50)
+    target_files = write_target_files(tmp_path, reads)
+    run_analysis(target_files, tmp_path / "data.tsv", barcode_pattern=None)
+    run_analysis(target_files, tmp_path / "data.parquet", barcode_pattern=None)
+
+    data = load_data(tmp_path / "data.parquet", columns=columns)
+
+    expected = load_data(tmp_path / "data.tsv", columns=columns)
+    assert pq.ParquetFile(tmp_path / "data.parquet").num_row_groups > 1
+    assert list(data.columns) == list(expected.columns)
+    pd.testing.assert_frame_equal(data, expected)
@@ -0,0 +1,65 @@
+import random
+
+import pandas as pd
+import pytest
+
+from dbspro.cli import integrate
+from dbspro.cli.integrate import run_analysis
+from dbspro.cli.mergedata import run_mergedata
+from dbspro.notebook import load_data
+
+
+@pytest.fixture
+def sample_files(tmp_path):
+    """Write collapsed UMI counts for three samples and return their paths"""
+    rng = random.Random(0)
+    paths = []
+    for sample in ["sample1", "sample2", "sample3"]:
+        rows = set()
+        for _ in range(200):
+            barcode = "".join(rng.choice("ACGT") for _ in range(8))
+            umi = "".join(rng.choice("ACGT") for _ in range(6))
+            rows.add((barcode, rng.choice(["ABC1", "ABC2"]), umi, rng.randint(1, 10)))
+        path = tmp_path / f"{sample}.abc_umi.corrected.tsv"
+        with open(path, "w") as file:
+            print("Barcode", "Target", "UMI", "ReadCount", sep="\t", file=file)
+            for row in sorted(rows):
+                print(*row, sep="\t", file=file)
+        paths.append(path)
+    return paths
+
+
+@pytest.mark.parametrize("extension", ["tsv", "tsv.gz", "parquet"])
+def test_mergedata_concatenates_samples(tmp_path, monkeypatch, sample_files, extension):
+    monkeypatch.setattr(integrate, "BATCH_SIZE", 50)
+    data_files = []
+    for path in sample_files:
+        data_files.append(tmp_path / f"{path.name.split('.')[0]}.data.{extension}")
+        run_analysis([path], data_files[-1], barcode_pattern=None)
+
+    run_mergedata(data_files, tmp_path / f"data.{extension}")
+
+    data = load_data(tmp_path / f"data.{extension}")
+    expected = pd.concat([load_data(file) for file in data_files], ignore_index=True)
+    expected["Sample"] = expected["Sample"].astype(str).astype("category")
+    pd.testing.assert_frame_equal(data, expected)
+    assert list(data["Sample"].unique()) == ["sample1", "sample2", "sample3"]
+
+
+def test_mergedata_rejects_mixed_formats(tmp_path, sample_files):
+    run_analysis([sample_files[0]], tmp_path / "sample1.data.tsv", barcode_pattern=None)
+    run_analysis([sample_files[1]], tmp_path / "sample2.data.parquet", barcode_pattern=None)
+
+    with pytest.raises(ValueError):
+        run_mergedata([tmp_path / "sample1.data.tsv", tmp_path / "sample2.data.parquet"], tmp_path / "data.tsv")
+    with pytest.raises(ValueError):
+        run_mergedata([tmp_path / "sample1.data.tsv"], tmp_path / "data.parquet")
+
+
+def test_mergedata_rejects_different_headers(tmp_path, sample_files):
+    run_analysis([sample_files[0]], tmp_path / "sample1.data.tsv", barcode_pattern=None)
+    with open(tmp_path / "sample2.data.tsv", "w") as file:
+        print("Barcode", "Target", "UMI", "ReadCount", sep="\t", file=file)
+
+    with pytest.raises(ValueError):
+        run_mergedata([tmp_path / "sample1.data.tsv", tmp_path / "sample2.data.tsv"], tmp_path / "data.tsv")
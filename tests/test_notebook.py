@@ -0,0 +1,98 @@
+import random
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.sparse import csr_matrix
+
+from dbspro.notebook import filter_dups, filter_connected
+
+
+def pairwise_filter_dups(df: pd.DataFrame, threshold, min_len: int = 3) -> pd.DataFrame:
+    """Reference implementation comparing all pairs of barcodes through a sparse matrix product"""
+    combos = df.groupby("Barcode")[["Target", "UMI"]].apply(lambda group: set(zip(group["Target"], group["UMI"])))
+    combos = combos[combos.map(len) >= min_len]
+    barcodes = np.array(combos.index)
+    combo_codes = {}
+    rows = []
+    cols = []
+    for row, barcode_combos in enumerate(combos):
+        for combo in barcode_combos:
+            rows.append(row)
+            cols.append(combo_codes.setdefault(combo, len(combo_codes)))
+    arr = csr_matrix((np.ones(len(rows), dtype=int), (rows, cols)), shape=(len(barcodes), len(combo_codes)))
+    overlaps = (arr @ arr.T).toarray()
+    sizes = np.diag(overlaps)
+    first, second = np.triu_indices(len(barcodes), k=1)
+    shared = overlaps[first, second]
+    if isinstance(threshold, int):
+        dups = shared > threshold
+    else:
+        dups = shared / (sizes[first] + sizes[second] - shared) > threshold
+    barcodes_to_remove = set(barcodes[first[dups]]) | set(barcodes[second[dups]])
+    return df[~df["Barcode"].isin(barcodes_to_remove)]
+
+
+def random_data(rng: random.Random, nr_barcodes: int) -> pd.DataFrame:
+    """Return data where some barcodes share part of their UMI-Target combos with an earlier barcode"""
+    targets = ["ABC01", "ABC02", "ABC03"]
+    barcode_combos = []
+    for _ in range(nr_barcodes):
+        combos = {(rng.choice(targets), "".join(rng.choice("ACGT") for _ in range(3)))
+                  for _ in range(rng.randint(1, 8))}
+        if barcode_combos and rng.random() < 0.05:
+            combos = set(rng.choice(barcode_combos))
+        elif barcode_combos and rng.random() < 0.3:
+            other = sorted(rng.choice(barcode_combos))
+            combos |= set(rng.sample(other, rng.randint(1, len(other))))
+        barcode_combos.append(combos)
+
+    rows = [(f"BC{i}", target, umi, rng.randint(1, 5), "sample")
+            for i, combos in enumerate(barcode_combos) for target, umi in sorted(combos)]
+    return pd.DataFrame(rows, columns=["Barcode", "Target", "UMI", "ReadCount", "Sample"])
+
+
+@pytest.mark.parametrize("threshold", [0, 1, 2, 4, 0.1, 0.3, 0.5, 0.9])
+@pytest.mark.parametrize("min_len", [1, 3])
+def test_filter_dups_matches_pairwise(threshold, min_len):
+    rng = random.Random(f"{threshold}{min_len}")
+    nr_removed = 0
+    for _ in range(5):
+        data = random_data(rng, 300)
+
+        expected = pairwise_filter_dups(data, threshold, min_len)
+        result = filter_dups(data, threshold, min_len)
+
+        pd.testing.assert_frame_equal(result, expected)
+        nr_removed += len(data) - len(expected)
+    assert nr_removed > 0
+
+
+def test_filter_connected_matches_brute_force():
+    rng = random.Random(0)
+    barcodes = []
+    # Lengths are compared separately, 19 bp do not divide evenly into segments
+    for length in [20, 19]:
+        same_length = ["".join(rng.choice("ACGT") for _ in range(length))]
+        while len(same_length) < 200:
+            if rng.random() < 0.3:
+                barcode = [rng.choice("ACGT") for _ in range(length)]
+            else:
+                barcode = list(rng.choice(same_length))
+                for position in rng.sample(range(length), rng.randint(1, 5)):
+                    barcode[position] = rng.choice("ACGTN")
+            same_length.append("".join(barcode))
+        barcodes.extend(same_length)
+    barcodes = list(dict.fromkeys(barcodes))
+    data = pd.DataFrame({"Barcode": barcodes, "Target": "ABC01", "UMI": "AAA", "ReadCount": 1, "Sample": "sample"})
+
+    isolated = [
+        barcode for barcode in barcodes
+        if not any(len(other) == len(barcode) and other != barcode and
+                   sum(a != b for a, b in zip(barcode, other)) <= 2 for other in barcodes)
+    ]
+
+    result = filter_connected(data, dist=2)
+
+    assert 0 < len(isolated) < len(barcodes)
+    assert result["Barcode"].tolist() == isolated
@@ -0,0 +1,59 @@
+from fractions import Fraction
+from math import comb
+
+import numpy as np
+import pytest
+
+from dbspro.cli.saturation import run_saturation, expected_distinct, prob_unsampled
+
+READ_COUNTS = np.array([1, 2, 3, 5, 8, 20])
+NR_CONSTRUCTS = np.array([12, 6, 4, 3, 2, 1])
+
+
+def exact_expected_distinct(read_counts, nr_constructs, depth):
+    """Expected number of distinct constructs when sampling depth reads without replacement"""
+    nr_reads = int(np.dot(read_counts, nr_constructs))
+    return sum(
+        nr * (1 - Fraction(comb(nr_reads - count, depth), comb(nr_reads, depth)))
+        for count, nr in zip(read_counts.tolist(), nr_constructs.tolist())
+    )
+
+
+def test_prob_unsampled_is_hypergeometric():
+    nr_reads = int(np.dot(READ_COUNTS, NR_CONSTRUCTS))
+    for depth in [1, 7, 50, nr_reads - 1]:
+        expected = [float(Fraction(comb(nr_reads - count, depth), comb(nr_reads, depth))) for count in READ_COUNTS]
+        assert prob_unsampled(READ_COUNTS, nr_reads, depth) == pytest.approx(expected, rel=1e-9, abs=1e-300)
+
+
+def test_interpolation_matches_exact_expectation():
+    nr_reads = int(np.dot(READ_COUNTS, NR_CONSTRUCTS))
+    depths = np.arange(nr_reads + 1)
+    expected = [float(exact_expected_distinct(READ_COUNTS, NR_CONSTRUCTS, depth)) for depth in depths]
+
+    result = expected_distinct(READ_COUNTS, NR_CONSTRUCTS, depths)
+
+    assert result == pytest.approx(expected, rel=1e-9)
+    assert result[-1] == NR_CONSTRUCTS.sum()
+
+
+def test_extrapolation_continues_interpolation():
+    nr_reads = int(np.dot(READ_COUNTS, NR_CONSTRUCTS))
+    result = expected_distinct(READ_COUNTS, NR_CONSTRUCTS, np.array([nr_reads, nr_reads + 1, 10 * nr_reads, 1e9]))
+
+    assert np.all(np.diff(result) >= 0)
+    assert result[1] - result[0] < 1
+
+
+def test_confidence_interval_contains_estimate(tmp_path):
+    histogram = tmp_path / "histogram.txt"
+    np.savetxt(histogram, np.stack([READ_COUNTS, NR_CONSTRUCTS], axis=1), fmt="%d")
+    output = tmp_path / "saturation.txt"
+
+    run_saturation(histogram, output, extrapolate=2000, step=10, bootstraps=100)
+
+    values = np.loadtxt(output, skiprows=1)
+    expected, lower, upper = values[:, 1], values[:, 2], values[:, 3]
+    assert np.all(lower <= expected)
+    assert np.all(expected <= upper)
+    assert np.any(lower < upper)
@@ -0,0 +1,182 @@
+import random
+from typing import Dict, List, Tuple
+
+import dnaio
+import pandas as pd
+import pytest
+from umi_tools import UMIClusterer
+
+from dbspro.cli.integrate import run_analysis
+from dbspro.cli.splitcluster import _init_worker, _cluster_chunk, group_chunks, PackedUMIClusterer, neighbor_masks, \
+    run_splitcluster, ClusterCache, correct_umis
+from dbspro.utils import Summary, format_records, parse_chunk
+
+
+def make_chunk(records):
+    return format_records([dnaio.SequenceRecord(name, sequence) for name, sequence in records])
+
+
+def test_cluster_chunk_flushes_trailing_group():
+    records = [
+        ("read1 AAAA", "ACGTACGT"),
+        ("read2 AAAA", "ACGTACGT"),
+        ("read3 AAAA", "ACGTACGA"),
+        ("read4 CCCC", "TTTTGGGG"),
+        ("read5 CCCC", "TTTTGGGG"),
+        ("read6 CCCC", "TTTTGGGC"),
+    ]
+    _init_worker("directional", 1)
+    corrected, summary = _cluster_chunk(make_chunk(records))
+
+    reads = [(read.name, read.sequence) for read in parse_chunk(corrected)]
+    assert reads == [
+        ("read1 AAAA", "ACGTACGT"),
+        ("read2 AAAA", "ACGTACGT"),
+        ("read3 AAAA", "ACGTACGT"),
+        ("read4 CCCC", "TTTTGGGG"),
+        ("read5 CCCC", "TTTTGGGG"),
+        ("read6 CCCC", "TTTTGGGG"),
+    ]
+    assert summary["Total clustered UMIs"] == 2
+
+
+def test_group_chunks_keeps_groups_together():
+    records = [(f"read{i} {dbs}", "ACGT") for i, dbs in enumerate(["AAAA"] * 3 + ["CCCC"] * 4 + ["GGGG"] * 2)]
+    data = make_chunk(records)
+    # Split input in chunks at every record boundary to test splitting within groups
+    boundaries = [0] + [i + 1 for i in range(len(data)) if data[i:i + 2] == b"\n>"] + [len(data)]
+    chunks = [data[start:end] for start, end in zip(boundaries, boundaries[1:])]
+
+    grouped = list(group_chunks(chunks))
+
+    assert b"".join(grouped) == data
+    groups = [{read.name.split(" ")[-1] for read in parse_chunk(chunk)} for chunk in grouped]
+    assert groups == [{"AAAA"}, {"CCCC"}, {"GGGG"}]
+
+
+def test_group_chunks_rejects_fastq():
+    chunk = format_records([dnaio.SequenceRecord("read1 AAAA", "ACGT", "IIII")], fileformat="fastq")
+    with pytest.raises(ValueError):
+        list(group_chunks([chunk]))
+
+
+def random_umi_group(rng: random.Random, nr_umis: int, length: int) -> Dict[bytes, int]:
+    """Return UMIs with counts where UMIs are often close to each other and counts are often tied"""
+    umis = ["".join(rng.choice("ACGT") for _ in range(length))]
+    while len(umis) < nr_umis:
+        umi = list(rng.choice(umis))
+        for position in rng.sample(range(length), rng.randint(1, 2)):
+            umi[position] = rng.choice("ACGT")
+        umis.append("".join(umi))
+    return {umi.encode(): rng.choice([1, 1, 2, 3, 5, 10, 50]) for umi in umis}
+
+
+def normalize(clusters: List[List[bytes]]) -> List[Tuple[bytes, List[bytes]]]:
+    """Return clusters as parent and sorted UMIs since the order of the other UMIs in a cluster is arbitrary"""
+    return sorted((cluster[0], sorted(cluster)) for cluster in clusters)
+
+
+@pytest.mark.parametrize("method", ["directional", "adjacency", "cluster", "percentile", "unique"])
+@pytest.mark.parametrize("threshold", [1, 2])
+def test_packed_clusterer_matches_umi_tools(method, threshold):
+    rng = random.Random(f"{method}{threshold}")
+    length = 5
+    packed = PackedUMIClusterer(cluster_method=method)
+    umi_tools = UMIClusterer(cluster_method=method)
+    nr_masks = len(neighbor_masks(length, threshold))
+    # Group sizes below and above the number of masks use all pairs and the mask table, respectively
+    for nr_umis in [2, 3, 5, 10, nr_masks, nr_masks + 1, 2 * nr_masks, 300]:
+        for _ in range(10):
+            umis = random_umi_group(rng, nr_umis, length)
+            assert normalize(packed(umis, threshold)) == normalize(umi_tools(umis, threshold)), (nr_umis, umis)
+
+
+def test_cluster_cache_evicts_least_recently_used():
+    cache = ClusterCache("directional", max_size=2)
+    group1 = (("AAAA", 2), ("AAAC", 1))
+    group2 = (("CCCC", 2), ("CCCA", 1))
+    cache.put(group1, 1, "entry1")
+    cache.put(group2, 1, "entry2")
+
+    # Entries are keyed on the threshold as well as the UMIs and counts
+    assert cache.get(group1, 2) is None
+    assert cache.get((("AAAA", 1), ("AAAC", 1)), 1) is None
+    assert cache.get(group1, 1) == "entry1"
+
+    # The entry for group2 is now the least recently used
+    cache.put((("GGGG", 1), ("GGGA", 1)), 1, "entry3")
+    assert cache.get(group2, 1) is None
+    assert cache.get(group1, 1) == "entry1"
+    assert cache.get((("GGGG", 1), ("GGGA", 1)), 1) == "entry3"
+
+
+def test_correct_umis_reuses_cached_result():
+    rng = random.Random(0)
+    groups = [{umi.decode(): count for umi, count in random_umi_group(rng, 6, 6).items()} for _ in range(5)]
+    clusterer = PackedUMIClusterer(cluster_method="directional")
+    cache = ClusterCache("directional", max_size=3)
+    summary = Summary()
+    uncached_summary = Summary()
+
+    # Groups in a different order, repeated groups and groups evicted before being repeated
+    for i in [0, 1, 0, 2, 3, 4, 1, 4, 0]:
+        result = correct_umis(dict(reversed(list(groups[i].items()))), clusterer, 1, summary, cache)
+        assert result == correct_umis(groups[i], clusterer, 1, uncached_summary)
+
+    assert summary["Cache hits"] == 2
+    assert summary["Cache misses"] == 7
+    assert summary["Total clustered UMIs"] == uncached_summary["Total clustered UMIs"]
+
+
+@pytest.fixture
+def panel_reads():
+    """Return reads for several targets sorted by DBS as (name, UMI) with the target as second last word of name"""
+    rng = random.Random(0)
+    targets = ["ABC1", "ABC2", "ABC3"]
+    reads = []
+    for dbs in sorted("".join(rng.choice("ACGT") for _ in range(10)) for _ in range(30)):
+        # The same UMIs are used for all targets of a DBS to check that they are clustered separately
+        umis = random_umi_group(rng, rng.randint(1, 8), 6)
+        for target in targets:
+            for umi, count in umis.items():
+                reads.extend([(target, dbs, umi.decode())] * rng.randint(0, count))
+    rng.shuffle(reads)
+    reads.sort(key=lambda read: read[1])
+    return [(f"read{i} {target} {dbs}", umi) for i, (target, dbs, umi) in enumerate(reads)]
+
+
+def write_fasta(path, records):
+    with open(path, "w") as file:
+        for name, sequence in records:
+            print(f">{name}\n{sequence}", file=file)
+
+
+def read_data(path):
+    return pd.read_csv(path, sep="\t").sort_values(["Barcode", "Target", "UMI"]).reset_index(drop=True)
+
+
+@pytest.mark.parametrize("threads", [1, 2])
+@pytest.mark.parametrize("collapsed", [False, True])
+def test_panel_matches_splitcluster_per_target(tmp_path, panel_reads, threads, collapsed):
+    # Per-target files named like sample.ABC1.fasta as in the per-target workflow
+    target_files = []
+    for target in ["ABC1", "ABC2", "ABC3"]:
+        records = [(f"{name.split(' ')[0]} {name.split(' ')[-1]}", umi) for name, umi in panel_reads
+                   if name.split(" ")[1] == target]
+        write_fasta(tmp_path / f"sample.{target}.fasta", records)
+        target_files.append(tmp_path / f"sample.{target}.corrected.fasta")
+        run_splitcluster(tmp_path / f"sample.{target}.fasta", target_files[-1], dist_threshold=1,
+                         required_length=6, clustering_method="directional")
+    run_analysis(target_files, tmp_path / "expected.tsv", barcode_pattern=None)
+
+    write_fasta(tmp_path / "sample.fasta", panel_reads)
+    output = tmp_path / ("sample.corrected.tsv" if collapsed else "sample.corrected.fasta")
+    run_splitcluster(tmp_path / "sample.fasta", output, dist_threshold=1, required_length=6,
+                     clustering_method="directional", panel=True, collapsed=collapsed, threads=threads)
+    run_analysis([output], tmp_path / "data.tsv", barcode_pattern=None, panel=True)
+
+    expected = read_data(tmp_path / "expected.tsv")
+    assert read_data(tmp_path / "data.tsv").equals(expected)
+    # Clustering merged some UMIs
+    assert expected["ReadCount"].sum() == len(panel_reads)
+    assert len(expected) < len({(name.split(" ")[1], name.split(" ")[2], umi) for name, umi in panel_reads})
@@ -0,0 +1,201 @@
+from collections import Counter
+import random
+
+import dnaio
+import numpy as np
+import pytest
+
+from dbspro.cli.clusterdbs import CLUSTERS_DTYPE
+from dbspro.cli.correctfastq import run_correctfastq
+from dbspro.cli.tagfastq import BufferedFASTAReader, SpillDatabase, write_sorted_runs, merge_sorted_runs, \
+    run_tagfastq
+from dbspro.utils import encode_variable_length
+
+
+def write_fasta(path, records):
+    with open(path, "w") as file:
+        for name, sequence in records:
+            print(f">{name}\n{sequence}", file=file)
+
+
+def test_buffered_reader_resets_misses_on_hit(tmp_path):
+    annotations = tmp_path / "annotations.fasta"
+    write_fasta(annotations, [(f"read{i}", "ACGT") for i in range(1000)])
+
+    with BufferedFASTAReader(annotations, buffer_size=4, tmpdir=tmp_path) as reader:
+        # Misses interleaved with hits should not grow the buffer
+        for i in range(1000):
+            assert reader.get(f"missing{i}") is None
+            assert reader.get(f"read{i}") == "ACGT"
+
+        assert reader._buffer_size == 4
+        assert reader.summary["Annotation misses"] == 1000
+
+
+def test_buffered_reader_grows_buffer_on_repeated_misses(tmp_path):
+    annotations = tmp_path / "annotations.fasta"
+    write_fasta(annotations, [(f"read{i}", "ACGT") for i in range(1000)])
+
+    with BufferedFASTAReader(annotations, buffer_size=4, max_buffer_size=16, tmpdir=tmp_path) as reader:
+        for i in range(100):
+            assert reader.get(f"missing{i}") is None
+
+        assert reader._buffer_size == 16
+
+
+def test_buffered_reader_recovers_reordered_chunks(tmp_path):
+    rng = random.Random(0)
+    names = [f"read{i}" for i in range(10_000)]
+    annotated = [name for name in names if rng.random() < 0.8]
+    chunks = [annotated[i:i + 500] for i in range(0, len(annotated), 500)]
+    # Chunks written out of order, e.g. by parallel workers
+    rng.shuffle(chunks)
+    annotations = tmp_path / "annotations.fasta"
+    write_fasta(annotations, [(name, "ACGT") for chunk in chunks for name in chunk])
+
+    with BufferedFASTAReader(annotations, buffer_size=16, max_buffer_size=64, tmpdir=tmp_path) as reader:
+        found = [name for name in names if reader.get(name) is not None]
+
+        assert reader._buffer_size <= 64
+    assert len(found) > 0.99 * len(annotated)
+
+
+def test_spill_database_discards_oldest_records(tmp_path):
+    spill = SpillDatabase(tmp_path, max_size=3)
+    assert spill.add([("read1", "A"), ("read2", "C")]) == 0
+    assert spill.add([("read3", "G"), ("read4", "T"), ("read5", "AA")]) == 2
+
+    assert spill.pop("read1") is None
+    assert spill.pop("read2") is None
+    assert [spill.pop(name) for name in ["read3", "read4", "read5"]] == ["G", "T", "AA"]
+    spill.close()
+
+
+def test_merge_sorted_runs_in_several_passes(tmp_path):
+    rng = random.Random(0)
+    tagged_reads = []
+    for i in range(2000):
+        barcode = "".join(rng.choice("ACGT") for _ in range(4))
+        tagged_reads.append((barcode, dnaio.SequenceRecord(f"read{i}_{barcode}", "ACGTACGT")))
+    expected = [read.name for _, read in sorted(tagged_reads, key=lambda item: (item[0], item[1].name))]
+
+    # Write more runs than can be merged in a single pass
+    runs = []
+    for i in range(0, len(tagged_reads), 100):
+        directory = tmp_path / f"batch{i}"
+        directory.mkdir()
+        runs.extend(write_sorted_runs(iter(tagged_reads[i:i + 100]), str(directory), max_memory=1))
+    assert len(runs) > 4 ** 2
+    output = tmp_path / "sorted.fasta"
+    merge_sorted_runs(runs, output, "fasta", str(tmp_path), max_open_runs=4)
+
+    with dnaio.open(output) as reader:
+        assert [read.name for read in reader] == expected
+
+
+def random_sequence(rng: random.Random, length: int) -> str:
+    return "".join(rng.choice("ACGT") for _ in range(length))
+
+
+@pytest.fixture
+def tagging_files(tmp_path):
+    """Return DBS and ABC+UMI records per read, with missing segments as None, and DBS corrections"""
+    rng = random.Random(0)
+    canonical = [random_sequence(rng, 20) for _ in range(10)]
+    corrections = {}
+    for sequence in canonical:
+        corrections[sequence] = sequence
+        for _ in range(3):
+            raw = list(sequence)
+            raw[rng.randrange(20)] = rng.choice("ACGT")
+            corrections.setdefault("".join(raw), sequence)
+
+    dbs = []
+    abc_umi = []
+    for _ in range(500):
+        # Some DBS sequences lack a correction and some reads lack either segment
+        dbs.append(rng.choice(list(corrections) + [random_sequence(rng, 20), None]))
+        abc_umi.append(random_sequence(rng, 18) if rng.random() < 0.9 else None)
+
+    starcode = tmp_path / "clusters.txt"
+    with open(starcode, "w") as file:
+        for sequence in canonical:
+            raw = [key for key, value in corrections.items() if value == sequence]
+            print(sequence, len(raw), ",".join(raw), sep="\t", file=file)
+
+    clusters = np.empty(len(corrections), dtype=CLUSTERS_DTYPE)
+    clusters["raw"] = encode_variable_length(list(corrections))[0]
+    clusters["canonical"] = encode_variable_length(list(corrections.values()))[0]
+    clusters["count"] = 1
+    clusters = clusters[np.argsort(clusters["raw"])]
+    np.save(tmp_path / "clusters.npy", clusters)
+    return dbs, abc_umi, {"txt": starcode, "npy": tmp_path / "clusters.npy"}
+
+
+def tagged_pairs(path, separator=None):
+    """Return multiset of DBS and ABC+UMI sequences from tagged reads"""
+    with dnaio.open(path) as reader:
+        return Counter((read.name.rsplit(separator, 1)[-1], read.sequence) for read in reader)
+
+
+def correct_and_tag(tmp_path, dbs_file, abc_umi_file, corrections):
+    """Tag reads using separate correctfastq and tagfastq steps"""
+    corrected = tmp_path / "corrected.fasta"
+    run_correctfastq(dbs_file, corrections, corrected, tmpdir=tmp_path)
+    output = tmp_path / "expected.fasta"
+    run_tagfastq(abc_umi_file, corrected, output, separator="_", buffer_size=64, tmpdir=tmp_path)
+    return tagged_pairs(output, "_")
+
+
+@pytest.mark.parametrize("corrections_format", ["txt", "npy"])
+@pytest.mark.parametrize("sort_by_barcode", [False, True])
+def test_tagfastq_corrections_match_correctfastq(tmp_path, tagging_files, corrections_format, sort_by_barcode):
+    dbs, abc_umi, corrections = tagging_files
+    dbs_file = tmp_path / "dbs.fasta"
+    write_fasta(dbs_file, [(f"read{i}", sequence) for i, sequence in enumerate(dbs) if sequence is not None])
+    abc_umi_file = tmp_path / "abc_umi.fasta"
+    write_fasta(abc_umi_file, [(f"read{i}", sequence) for i, sequence in enumerate(abc_umi) if sequence is not None])
+    expected = correct_and_tag(tmp_path, dbs_file, abc_umi_file, corrections[corrections_format])
+
+    output = tmp_path / "tagged.fasta"
+    run_tagfastq(abc_umi_file, dbs_file, output, separator="_", buffer_size=64,
+                 corrections=corrections[corrections_format], sort_by_barcode=sort_by_barcode, tmpdir=tmp_path)
+
+    assert tagged_pairs(output, "_") == expected
+    assert 0 < sum(expected.values()) < len(abc_umi)
+
+
+def write_positional(path, sequences):
+    """Write records without names in read order, using empty records for missing segments"""
+    write_fasta(path, [("", sequence or "") for sequence in sequences])
+
+
+@pytest.mark.parametrize("corrections_format", ["txt", "npy"])
+@pytest.mark.parametrize("sort_by_barcode", [False, True])
+def test_tagfastq_positional_matches_correctfastq(tmp_path, tagging_files, corrections_format, sort_by_barcode):
+    dbs, abc_umi, corrections = tagging_files
+    dbs_file = tmp_path / "dbs.fasta"
+    write_fasta(dbs_file, [(f"read{i}", sequence) for i, sequence in enumerate(dbs) if sequence is not None])
+    abc_umi_file = tmp_path / "abc_umi.fasta"
+    write_fasta(abc_umi_file, [(f"read{i}", sequence) for i, sequence in enumerate(abc_umi) if sequence is not None])
+    expected = correct_and_tag(tmp_path, dbs_file, abc_umi_file, corrections[corrections_format])
+
+    write_positional(tmp_path / "dbs.positional.fasta", dbs)
+    write_positional(tmp_path / "abc_umi.positional.fasta", abc_umi)
+    output = tmp_path / "tagged.fasta"
+    run_tagfastq(tmp_path / "abc_umi.positional.fasta", tmp_path / "dbs.positional.fasta", output, separator="_",
+                 buffer_size=64, corrections=corrections[corrections_format], positional=True,
+                 sort_by_barcode=sort_by_barcode, tmpdir=tmp_path)
+
+    # Positional output is named by the DBS only
+    assert tagged_pairs(output) == expected
+
+
+def test_tagfastq_positional_rejects_different_number_of_records(tmp_path, tagging_files):
+    dbs, abc_umi, _ = tagging_files
+    write_positional(tmp_path / "dbs.positional.fasta", dbs[:-1])
+    write_positional(tmp_path / "abc_umi.positional.fasta", abc_umi)
+
+    with pytest.raises(ValueError):
+        run_tagfastq(tmp_path / "abc_umi.positional.fasta", tmp_path / "dbs.positional.fasta",
+                     tmp_path / "tagged.fasta", separator="_", buffer_size=64, positional=True, tmpdir=tmp_path)
@@ -0,0 +1,71 @@
+import random
+
+import numpy as np
+import pytest
+
+from dbspro.utils import encode_variable_length, decode_variable_length, HammingIndex, iter_equal_key_pairs
+
+
+def test_encode_variable_length_roundtrip():
+    sequences = ["ACGT", "A", "T" * 31, "", "ACNT"]
+    keys, valid = encode_variable_length(sequences)
+
+    assert valid.tolist() == [True, True, True, False, False]
+    assert decode_variable_length(keys[valid]) == ["ACGT", "A", "T" * 31]
+
+
+def test_encode_variable_length_too_long():
+    with pytest.raises(ValueError):
+        encode_variable_length(["ACGT", "A" * 32])
+
+
+def random_barcodes(rng: random.Random, nr_barcodes: int, length: int, alphabet: str = "ACGT"):
+    """Return unique random barcodes where most are a few substitutions from another barcode"""
+    barcodes = ["".join(rng.choice(alphabet) for _ in range(length))]
+    while len(barcodes) < nr_barcodes:
+        if rng.random() < 0.2:
+            barcode = [rng.choice(alphabet) for _ in range(length)]
+        else:
+            barcode = list(rng.choice(barcodes))
+            for position in rng.sample(range(length), rng.randint(1, min(4, length))):
+                barcode[position] = rng.choice(alphabet)
+        barcodes.append("".join(barcode))
+    return list(dict.fromkeys(barcodes))
+
+
+@pytest.mark.parametrize("length,distance,alphabet", [
+    (20, 2, "ACGT"),  # 20 bp does not divide evenly into 3 segments
+    (11, 1, "ACGT"),
+    (10, 3, "ACGT"),
+    (14, 2, "ACGTN"),
+    (3, 3, "ACGT"),
+])
+def test_hamming_index_matches_brute_force(monkeypatch, length, distance, alphabet):
+    # Small batches to also test verifying candidates in several batches
+    monkeypatch.setattr(HammingIndex, "BATCH_SIZE", 100)
+    rng = random.Random(length * 10 + distance)
+    barcodes = random_barcodes(rng, 400, length, alphabet)
+    expected = {
+        (i, j) for i in range(len(barcodes)) for j in range(i + 1, len(barcodes))
+        if sum(a != b for a, b in zip(barcodes[i], barcodes[j])) <= distance
+    }
+
+    first, second = HammingIndex(barcodes, distance).pairs()
+    pairs = list(zip(first.tolist(), second.tolist()))
+
+    assert len(pairs) == len(set(pairs))
+    assert set(pairs) == expected
+
+
+@pytest.mark.parametrize("batch_size", [1, 7, 1000])
+def test_iter_equal_key_pairs_in_bounded_batches(batch_size):
+    rng = np.random.default_rng(0)
+    keys = rng.integers(0, 10, 60).astype(np.uint64)
+    expected = {(i, j) for i in range(len(keys)) for j in range(i + 1, len(keys)) if keys[i] == keys[j]}
+
+    batches = list(iter_equal_key_pairs(keys, batch_size))
+
+    assert all(len(i) == len(j) <= batch_size for i, j in batches)
+    pairs = [tuple(sorted(pair)) for i, j in batches for pair in zip(i.tolist(), j.tolist())]
+    assert len(pairs) == len(set(pairs))
+    assert set(pairs) == expected